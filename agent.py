@@ -1,12 +1,15 @@
 import math
 from resource import Resource
-from randomgen import PCG64
+from rng import RandomStream
 
 EMPTY_CELL = 0
 BARRIER_CELL = -1
 
 
 class Agent:
+    # Agents have no per-instance dictionary: their attributes are fixed
+    __slots__ = ("id", "fov_radius", "resources", "metabolic_rate", "strategy", "stream", "time_alive")
+
     # Constructor for an Agent.
     # - id: unique identifier for this agent
     # - fov_radius: agent's field of view; integer radius around the agent's cell 
@@ -23,35 +26,58 @@ class Agent:
         if strategy < -10 or strategy > 10:
             print("Error: unexpected strategy value. Expected [-10, 10]")
         self.strategy = strategy
-        self.generator = PCG64(seed, 0).generator
+        self.stream = RandomStream(seed)  # Same values as PCG64(seed, 0).generator
         self.time_alive = 0
 
     # Returns the best movement decision for the Agent based on the given environment 
-    # and the agent's field of vision
+    # and the agent's field of vision. The environment is a 2D array centered on the agent,
+    # such as the view returned by Universe.find_restricted_env.
     def find_best_move(self, environment):
+        agents, resources = self.scan_environment(environment)
+        return self.find_best_move_among(environment, agents, resources)
+
+    # Returns the lists of ((i, j), object) of the other agents and of the resources in the given
+    # environment, by scanning every cell of it
+    def scan_environment(self, environment):
         agents = []     # Agents in the given environment
         resources = []  # Resources in the given environment
         fov_radius = self.fov_radius
 
-        # Scores for each cell in the environment corresponding to the relative 
-        # advantage/disadvantage of moving to that cell. The higher the score, the 
-        # better an option it is.
-        scores = [[0 for x in range(2*fov_radius + 1)] for y in range(2*fov_radius + 1)]
-
         # Populate <agents> and <resources>
         for i in range(2*fov_radius + 1):
             for j in range(2*fov_radius + 1):
                 if i == fov_radius and j == fov_radius:
                     continue
-                if isinstance(environment[i][j], Agent):
-                    agents.append(((i,j), environment[i][j]))
-                if isinstance(environment[i][j], Resource):
-                    resources.append(((i,j), environment[i][j]))
-        
-        # Score each cell in the environment based on its distance to 
-        for i in range(2*fov_radius + 1):
-            for j in range(2*fov_radius + 1):
-                if  environment[i][j] == BARRIER_CELL:
+                if isinstance(environment[i, j], Agent):
+                    agents.append(((i,j), environment[i, j]))
+                if isinstance(environment[i, j], Resource):
+                    resources.append(((i,j), environment[i, j]))
+        return agents, resources
+
+    # Same as find_best_move, given the lists of ((i, j), object) of the other agents and of the
+    # resources in the environment, such as the ones returned by Universe.find_visible. Only the
+    # cells the agent can move to are read from the environment.
+    def find_best_move_among(self, environment, agents, resources):
+        return self.choose_move(self.best_moves_among(environment, agents, resources))
+
+    # Returns the moves with the best score, among which find_best_move_among draws, given the same
+    # arguments. They do not depend on the agent's random stream.
+    def best_moves_among(self, environment, agents, resources):
+        fov_radius = self.fov_radius
+
+        # Scores for each cell in the environment corresponding to the relative 
+        # advantage/disadvantage of moving to that cell. The higher the score, the 
+        # better an option it is.
+        # Agents move one cell per turn, so only the cells around the agent are ever compared in
+        # _find_best_move, and only their rows are created.
+        scores = [None for x in range(2*fov_radius + 1)]
+        for i in range(fov_radius - 1, fov_radius + 2):
+            scores[i] = [0 for y in range(2*fov_radius + 1)]
+
+        # Score each cell the agent can move to based on its distance to agents and resources.
+        for i in range(fov_radius - 1, fov_radius + 2):
+            for j in range(fov_radius - 1, fov_radius + 2):
+                if  environment[i, j] == BARRIER_CELL:
                     scores[i][j] = -math.inf
                     continue
 
@@ -67,11 +93,15 @@ class Agent:
                     distance = max(abs(x-i), abs(y-j)) # Manhattan distance with sloped movement
                     scores[i][j] += resource.get_amount() - distance
 
-        return self._find_best_move(scores) 
+        return self._best_moves(scores)
 
     # Finds the best move among a grid of scores. If multiple cells contain the best score, a 
     # random cell will be chosen and returned among these cells.
     def _find_best_move(self, scores):
+        return self.choose_move(self._best_moves(scores))
+
+    # Returns the list of the moves with the best score in a grid of scores
+    def _best_moves(self, scores):
         fov_radius = self.fov_radius
 
         # Agents move one cell per turn
@@ -92,7 +122,11 @@ class Agent:
         if best_score == -math.inf:
             print("Error: barrier block chosen in _find_best_move!")
 
-        return self.generator.choice(best_moves).tolist()
+        return best_moves
+
+    # Draws the move to make among <best_moves> from the agent's random stream
+    def choose_move(self, best_moves):
+        return list(self.stream.choice(best_moves))
     
     def set_time_alive(self, time):
         self.time_alive = time
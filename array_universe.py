@@ -0,0 +1,387 @@
+import numpy as np
+from randomgen import PCG64
+from scoring import MOVES, ScoreFields
+from rng import AgentStreams
+from initialization import initial_state
+
+# Cell kinds stored in ArrayUniverse.kind
+EMPTY_CELL = 0
+BARRIER_CELL = -1
+AGENT_CELL = 1
+RESOURCE_CELL = 2
+
+
+# Lightweight stand-in for an Agent that reads and writes the struct-of-arrays state held by an
+# ArrayUniverse. Statistics only needs these attributes and accessors, so it works unchanged.
+class AgentHandle:
+    __slots__ = ("universe", "index")
+
+    def __init__(self, universe, index):
+        self.universe = universe
+        self.index = index
+
+    @property
+    def id(self):
+        return self.index + 1
+
+    @property
+    def fov_radius(self):
+        return int(self.universe.fov[self.index])
+
+    @property
+    def resources(self):
+        return int(self.universe.agent_resources[self.index])
+
+    @property
+    def metabolic_rate(self):
+        return int(self.universe.metabolic_rate[self.index])
+
+    @property
+    def strategy(self):
+        return int(self.universe.strategy[self.index])
+
+    @property
+    def time_alive(self):
+        return int(self.universe.time_alive[self.index])
+
+    def set_time_alive(self, time):
+        self.universe.time_alive[self.index] = time
+
+    # Return the number of resources that the agent currently has
+    def get_resources(self):
+        return self.resources
+
+    # Add a given number of resources to the agents resource collection
+    def add_resources(self, amount):
+        self.universe.agent_resources[self.index] += amount
+
+    # Return the unique identifier of the agent
+    def get_id(self):
+        return self.id
+
+    # Returns the agent's field of vision
+    def get_field_of_vision(self):
+        return self.fov_radius
+
+    def print_stats(self):
+        print("Agent ", self.id)
+        print("\tField of vision    :", self.fov_radius)
+        print("\tResources          :", self.resources)
+        print("\tMetabolic rate     :", self.metabolic_rate)
+        print("\tStrategy           :", self.strategy)
+
+
+# NumPy array-backed alternative to Universe.
+#
+# The environment is split into typed arrays instead of a list of Agent/Resource objects:
+# - kind: the kind of each cell (EMPTY_CELL, AGENT_CELL, RESOURCE_CELL or BARRIER_CELL)
+# - occupant: index of the agent in each cell, or -1
+# - amount: resource amount held by each cell
+# The arrays are padded with a BARRIER_CELL halo as wide as the field of vision, so an agent's
+# view is a plain slice and never needs bounds checks. Agent state is kept as struct-of-arrays
+# indexed by agent index (agent id - 1).
+#
+# Move scores are read from ScoreFields, which is patched on every move, fight, pickup and
+# death, so scoring an agent costs the same whatever its field of vision.
+#
+# The random streams are consumed in exactly the same order as Universe, so for the same
+# arguments both produce bit-identical runs.
+#
+# Agent i breaks ties with the stream seeded with i in self.rng, like Agent.
+#
+# With compiled=True, the moves of a tick run as a single Numba-compiled kernel (see kernel.py)
+# that reads the same streams. The results are the same as the
+# pure Python update, which is used instead when Numba is not installed (self.compiled is then
+# False). The kernel does not print debug output.
+#
+# With update_rule="synchronous", every tick follows the parallel-synchronous rule of shards.py
+# instead: all agents choose their moves from the same grid, the conflicts are resolved at once and
+# the next grid is written to a second buffer that becomes the current grid at the end of the
+# tick. The agents are not shuffled, and the score fields are not used (self.fields is None). The
+# run is the same as ShardedUniverse's with the same seed. It does not use the compiled kernel and
+# does not print debug output.
+#
+# With fast_init=True, the initial draws are taken in bulk and the grids are filled at once, which
+# gives the same initial state (see initialization.py).
+class ArrayUniverse:
+    def __init__(self, num_agents, env_size, resource_prob, metabolic_rate=1, field_of_vision=1,
+                 seed=1234567, debug=False, compiled=False, update_rule="sequential", fast_init=False):
+        self.timestep = 0
+        self.env_size = env_size
+        self.debug = debug
+        self.halo = field_of_vision
+
+        size = env_size + 2*self.halo
+        inner = slice(self.halo, self.halo + env_size)
+        self.kind = np.full((size, size), BARRIER_CELL, dtype=np.int8)
+        self.kind[inner, inner] = EMPTY_CELL
+        self.occupant = np.full((size, size), -1, dtype=np.int64)
+        self.amount = np.zeros((size, size), dtype=np.int64)
+        self.num_resources = 0
+        self.fields = None
+
+        # Struct-of-arrays agent state
+        self.agent_resources = np.full(num_agents, 10, dtype=np.int64)
+        self.metabolic_rate = np.full(num_agents, metabolic_rate, dtype=np.int64)
+        self.strategy = np.zeros(num_agents, dtype=np.int64)
+        self.fov = np.full(num_agents, field_of_vision, dtype=np.int64)
+        self.position = np.zeros((num_agents, 2), dtype=np.int64)  # In padded coordinates
+        self.time_alive = np.zeros(num_agents, dtype=np.int64)
+        self.alive = np.ones(num_agents, dtype=bool)
+        self.rng = AgentStreams(num_agents)
+
+        # Indices of the agents still in the simulation, in the order they move
+        self.order = np.arange(num_agents, dtype=np.int64)
+        self.handles = [AgentHandle(self, i) for i in range(num_agents)]
+
+        # Same four streams as Universe
+        self.streams = [PCG64(seed, stream) for stream in range(4)]
+
+        if fast_init:
+            # Same initial state, drawn in bulk (see initialization.py)
+            positions, self.strategy[:], resources = initial_state(num_agents, env_size, resource_prob, seed,
+                                                                    self.streams)
+            self.kind[inner, inner][resources] = RESOURCE_CELL
+            self.amount[inner, inner][resources] = 10
+            self.num_resources = int(resources.sum())
+            self.position[:] = positions + self.halo
+            self.kind[self.position[:, 0], self.position[:, 1]] = AGENT_CELL
+            self.occupant[self.position[:, 0], self.position[:, 1]] = np.arange(num_agents)
+        else:
+            # Place agents randomly in the environment
+            for i in range(num_agents):
+                rand_start_x = self.streams[0].generator.randint(0, env_size-1, closed=True)
+                rand_start_y = self.streams[0].generator.randint(0, env_size-1, closed=True)
+                while self.kind[self.halo + rand_start_x, self.halo + rand_start_y] != EMPTY_CELL:
+                    rand_start_x = self.streams[0].generator.randint(0, env_size-1, closed=True)
+                    rand_start_y = self.streams[0].generator.randint(0, env_size-1, closed=True)
+
+                self.strategy[i] = self.get_random_strategy()
+                self.place_agent(i, self.halo + rand_start_x, self.halo + rand_start_y)
+
+            # Place resources randomly
+            for i in range(env_size):
+                for j in range(env_size):
+                    # If an agent has already been placed here
+                    if self.kind[self.halo + i, self.halo + j] != EMPTY_CELL:
+                        continue
+                    # With probability resource_prob, place a resource in this cell
+                    if self.streams[2].generator.uniform(0, 1) < resource_prob:
+                        self.kind[self.halo + i, self.halo + j] = RESOURCE_CELL
+                        self.amount[self.halo + i, self.halo + j] = 10
+                        self.num_resources += 1
+
+        self.fields = ScoreFields(self.kind, self.amount, self.halo, AGENT_CELL, RESOURCE_CELL, BARRIER_CELL)
+
+        self.compiled = False
+        if compiled:
+            import kernel
+            self.compiled = kernel.AVAILABLE
+
+        self.update_rule = update_rule
+        if update_rule == "synchronous":
+            self.compiled = False
+            self.fields = None
+            self.grids = {name: np.stack([getattr(self, name)]*2) for name in ("kind", "occupant", "amount")}
+            self.target = np.full((num_agents, 2), -1, dtype=np.int64)
+            self.set_current(0)
+        elif update_rule != "sequential":
+            raise ValueError("Unknown update rule " + repr(update_rule))
+
+    def get_random_strategy(self):
+        strategy = self.streams[1].generator.normal(loc=0.0, scale=5.0)
+        strategy = int(round(strategy))
+        if strategy < -10:
+            strategy = -10
+        if strategy > 10:
+            strategy = 10
+        return strategy
+
+    # Agents still in the simulation, in the order they last moved
+    @property
+    def agents(self):
+        return [self.handles[i] for i in self.order.tolist()]
+
+    def is_finished(self):
+        if len(self.order) == 1:
+            return True
+        return False
+
+    # Updates the agents and resources in the environment
+    def update(self, stats):
+        if self.timestep == 0:
+            stats.set_agents(self.handles)
+        self.timestep += 1
+
+        if self.update_rule == "synchronous":
+            self.end_tick(stats, self.synchronous_tick())
+            return
+
+        # Move the agents in a random order
+        self.streams[3].generator.shuffle(self.order)
+        dead = self.run_kernel() if self.compiled else self.move_agents()
+        self.end_tick(stats, dead)
+
+    # Makes grid buffer <current> the current grid (self.kind, self.occupant and self.amount)
+    def set_current(self, current):
+        self.current = current
+        for name, buffers in self.grids.items():
+            setattr(self, name, buffers[current])
+
+    # Runs a tick of the synchronous rule and returns the agents eliminated in it
+    def synchronous_tick(self):
+        import shards
+        arrays = dict(self.grids, agent_resources=self.agent_resources, metabolic_rate=self.metabolic_rate,
+                      strategy=self.strategy, position=self.position, target=self.target, alive=self.alive,
+                      rng_values=self.rng.values, rng_pos=self.rng.pos, rng_drawn=self.rng.drawn)
+        dead, collected = shards.synchronous_tick(arrays, self.current, [self.halo, self.halo + self.env_size],
+                                                  self.halo)
+        self.set_current(1 - self.current)
+        self.num_resources -= collected
+        return dead
+
+    # Reports the agents eliminated in the current turn (in the order they died) to <stats>, removes
+    # them from the simulation, and records the winner if the simulation is finished
+    def end_tick(self, stats, dead):
+        stats.update(False, self.timestep, [self.handles[i] for i in dead])
+
+        # Remove eliminated agents. If one agent is left, stop removing, remaining agent is the winner
+        removed = []
+        for index in dead:
+            self.time_alive[index] = self.timestep
+            removed.append(index)
+            if len(self.order) - len(removed) == 1:
+                break
+        if removed:
+            self.order = self.order[~np.isin(self.order, removed)]
+
+        if self.is_finished():
+            self.time_alive[self.order] = self.timestep + 1  # Record the winning agents time alive
+            stats.update(True, self.timestep+1, [])
+            if self.debug:
+                print("Simulation has ended. Agent", int(self.order[0]) + 1, "has won!")
+
+    # Moves every agent in self.order in turn and returns the agents eliminated in the current turn,
+    # in the order they died
+    def move_agents(self):
+        dead = []
+        for index in self.order.tolist():
+            # If this agent was eliminated by another agent in this timestep
+            if not self.alive[index]:
+                continue
+
+            # Update the agents resources based on the agents metabolic rate
+            self.agent_resources[index] -= self.metabolic_rate[index]
+            if self.agent_resources[index] <= 0:
+                self.kill(index, dead)
+                loc_x, loc_y = self.position[index]
+                self.clear_cell(loc_x, loc_y)
+                continue
+
+            move_x, move_y = self.find_best_move(index)
+
+            # If the agent chose to remain in the current space, no further update required
+            if move_x == 0 and move_y == 0:
+                continue
+
+            old_loc_x, old_loc_y = self.position[index].tolist()
+            self.resolve_movement(index, old_loc_x, old_loc_y, old_loc_x + move_x, old_loc_y + move_y, dead)
+        return dead
+
+    # Same as move_agents, with the compiled kernel
+    def run_kernel(self):
+        import kernel
+        fields = self.fields
+        dead = np.empty(len(self.order), dtype=np.int64)
+        counts = np.array([0, self.num_resources], dtype=np.int64)
+        start, resume_draw = 0, False
+        while start < len(self.order):
+            stopped = kernel.tick(self.order, start, resume_draw, self.alive, self.agent_resources,
+                                  self.metabolic_rate, self.strategy, self.position, self.kind, self.occupant,
+                                  self.amount, fields.agents, fields.resources, fields.flipped, fields.barrier,
+                                  self.halo, self.rng.values, self.rng.pos, dead, counts)
+            if stopped < len(self.order):
+                # The agent ran out of pre-drawn randomness in the middle of breaking a tie
+                self.rng.refill(int(self.order[stopped]))
+            start, resume_draw = stopped, True
+        self.num_resources = int(counts[1])
+        return dead[:counts[0]].tolist()
+
+    # Returns the best move for the agent at <index> based on the cells within its field of vision
+    def find_best_move(self, index):
+        x, y = self.position[index]
+        return self.choose_move(index, self.fields.scores(x, y, self.strategy[index]))
+
+    # Returns the scores of every move for every agent still in the simulation, in the order of
+    # self.order, computed at once from the current state of the environment
+    def score_all(self):
+        positions = self.position[self.order]
+        return self.fields.batch_scores(positions[:, 0], positions[:, 1], self.strategy[self.order])
+
+    # Picks the best of the scored moves, breaking ties with the agent's own stream
+    def choose_move(self, index, scores):
+        best_moves = np.flatnonzero(scores == scores.max()).tolist()
+        return MOVES[best_moves[self.rng.randint(index, len(best_moves))]]
+
+    # Resolves the movement of an agent from its current location to a new location
+    def resolve_movement(self, index, old_x, old_y, new_x, new_y, dead):
+        if self.debug:
+            print("Agent", index + 1, "wants to move from (", old_x - self.halo, ",", old_y - self.halo,
+                  ") to (", new_x - self.halo, ",", new_y - self.halo, ")")
+
+        new_kind = self.kind[new_x, new_y]
+
+        # If the agent is moving to attack another agent
+        if new_kind == AGENT_CELL:
+            self.resolve_agent_collision(index, int(self.occupant[new_x, new_y]), new_x, new_y, dead)
+
+        # If the agent is moving to collect a resource
+        elif new_kind == RESOURCE_CELL:
+            self.resolve_resource_collision(index, new_x, new_y)
+
+        # If the agent is moving into an empty cell
+        else:
+            self.place_agent(index, new_x, new_y)
+
+        # Set the agents old location to be an empty cell
+        self.clear_cell(old_x, old_y)
+
+    def resolve_agent_collision(self, attacker, defender, new_x, new_y, dead):
+        # Attacker wins the fight
+        if self.agent_resources[attacker] > self.agent_resources[defender]:
+            winner, loser = attacker, defender
+        # Defender wins the fight
+        else:
+            winner, loser = defender, attacker
+
+        # The winner consumes the loser's resources
+        self.agent_resources[winner] += self.agent_resources[loser]
+        self.kill(loser, dead)
+        self.place_agent(winner, new_x, new_y)
+        if self.debug:
+            print("Agent", winner + 1, "killed Agent", loser + 1)
+
+    # Resolve a collision between an agent and a resource cell
+    def resolve_resource_collision(self, index, new_x, new_y):
+        self.agent_resources[index] += self.amount[new_x, new_y]
+        self.fields.add_resource(new_x, new_y, self.amount[new_x, new_y], -1)
+        self.amount[new_x, new_y] = 0
+        self.num_resources -= 1
+        self.place_agent(index, new_x, new_y)
+
+    def place_agent(self, index, x, y):
+        if self.fields is not None and self.kind[x, y] != AGENT_CELL:
+            self.fields.add_agent(x, y, 1)
+        self.kind[x, y] = AGENT_CELL
+        self.occupant[x, y] = index
+        self.position[index] = (x, y)
+
+    def clear_cell(self, x, y):
+        if self.kind[x, y] == AGENT_CELL:
+            self.fields.add_agent(x, y, -1)
+        self.kind[x, y] = EMPTY_CELL
+        self.occupant[x, y] = -1
+
+    def kill(self, index, dead):
+        self.alive[index] = False
+        dead.append(index)
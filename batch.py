@@ -0,0 +1,185 @@
+import copy
+import numpy as np
+from array_universe import ArrayUniverse, EMPTY_CELL, AGENT_CELL, RESOURCE_CELL
+from scoring import MOVE_X, MOVE_Y
+from statistics import Statistics
+from rng import AgentStreams
+
+
+# Advances one ArrayUniverse per seed in lockstep.
+#
+# The grid, agent and score field arrays of all members are stacked along a leading batch
+# dimension. Each tick, every member shuffles its agents with its own stream, then the batch moves
+# the k-th agent of every member at once for k = 0, 1, ...: metabolism, scoring, tie-breaking,
+# movement, fights and resource pickups are single NumPy operations over the members, so the
+# Python overhead of a step is paid once for the whole batch instead of once per run. Only the
+# members that are not finished take part in a tick, so finished runs stop costing time.
+#
+# Every member follows the sequential update rule with its own random streams, so member b gives
+# exactly the same run as a standalone Universe (or ArrayUniverse) with seed=seeds[b]. The agent
+# streams of all members are held in a single AgentStreams.
+#
+# self.members holds the member universes, whose arrays are views into the stacked arrays, and
+# self.stats their Statistics.
+class UniverseBatch:
+    def __init__(self, seeds, num_agents, env_size, resource_prob, metabolic_rate=1, field_of_vision=1):
+        self.members = [ArrayUniverse(num_agents, env_size, resource_prob, metabolic_rate=metabolic_rate,
+                                      field_of_vision=field_of_vision, seed=seed, fast_init=True) for seed in seeds]
+        self.stats = [Statistics() for member in self.members]
+        self.r = field_of_vision
+
+        # Stack the state of the members, and make the members use views into the stacked arrays
+        for name in ("kind", "occupant", "amount", "agent_resources", "metabolic_rate", "strategy", "position",
+                     "time_alive", "alive"):
+            stacked = np.stack([getattr(member, name) for member in self.members])
+            setattr(self, name, stacked)
+            for b, member in enumerate(self.members):
+                setattr(member, name, stacked[b])
+        self.agent_field = np.stack([member.fields.agents for member in self.members])
+        self.resource_field = np.stack([member.fields.resources for member in self.members])
+        for b, member in enumerate(self.members):
+            member.fields.agents = self.agent_field[b]
+            member.fields.resources = self.resource_field[b]
+        self.num_resources = np.array([member.num_resources for member in self.members], dtype=np.int64)
+        self.flipped = self.members[0].fields.flipped
+
+        # Score fields of the whole batch, read with the row of each agent's member. The barriers are
+        # the same in every member.
+        self.fields = copy.copy(self.members[0].fields)
+        self.fields.agents, self.fields.resources = self.agent_field, self.resource_field
+
+        self.rng = AgentStreams(num_agents, batch_size=len(self.members))
+        for b, member in enumerate(self.members):
+            member.rng.values, member.rng.pos, member.rng.drawn = self.rng.values[b], self.rng.pos[b], self.rng.drawn[b]
+
+    def is_finished(self):
+        return all(member.is_finished() for member in self.members)
+
+    # Runs every member to completion and returns their Statistics
+    def run(self):
+        while not self.is_finished():
+            self.update()
+        return self.stats
+
+    # Updates every member that is not finished by one tick
+    def update(self):
+        active = [b for b, member in enumerate(self.members) if not member.is_finished()]
+        if not active:
+            return
+
+        # Move the agents of every member in a random order, drawn from the member's own stream
+        orders = np.full((len(active), max(len(self.members[b].order) for b in active)), -1, dtype=np.int64)
+        for row, b in enumerate(active):
+            member = self.members[b]
+            if member.timestep == 0:
+                self.stats[b].set_agents(member.handles)
+            member.timestep += 1
+            member.streams[3].generator.shuffle(member.order)
+            orders[row, :len(member.order)] = member.order
+
+        # Agents eliminated in the current turn in each member, in the order they died
+        dead = {b: [] for b in active}
+        members = np.array(active, dtype=np.int64)
+        for k in range(orders.shape[1]):
+            rows, agents = members, orders[:, k]
+            present = agents >= 0
+            rows, agents = rows[present], agents[present]
+            # If this agent was eliminated by another agent in this timestep
+            alive = self.alive[rows, agents]
+            rows, agents = rows[alive], agents[alive]
+            if len(rows):
+                self.step(rows, agents, dead)
+
+        for b in active:
+            self.members[b].num_resources = int(self.num_resources[b])
+            self.members[b].end_tick(self.stats[b], dead[b])
+
+    # Moves agent agents[j] of member rows[j] for every j, like ArrayUniverse.move_agents does for a
+    # single agent
+    def step(self, rows, agents, dead):
+        # Update the agents resources based on the agents metabolic rate
+        self.agent_resources[rows, agents] -= self.metabolic_rate[rows, agents]
+        starving = self.agent_resources[rows, agents] <= 0
+        if starving.any():
+            self.kill(rows[starving], agents[starving], dead)
+            x, y = self.position[rows[starving], agents[starving]].T
+            self.clear_cells(rows[starving], x, y)
+            rows, agents = rows[~starving], agents[~starving]
+
+        x, y = self.position[rows, agents].T
+        scores = self.fields.batch_scores(x, y, self.strategy[rows, agents], rows)
+
+        # Pick among the best moves, in the order of MOVES, with each agent's own generator
+        moves = self.rng.choose_best(agents, scores, rows)
+
+        # If the agent chose to remain in the current space, no further update required
+        moving = moves != 0
+        rows, agents, x, y, moves = rows[moving], agents[moving], x[moving], y[moving], moves[moving]
+        new_x, new_y = x + MOVE_X[moves], y + MOVE_Y[moves]
+        new_kind = self.kind[rows, new_x, new_y]
+
+        # Agents moving to attack another agent. The one with more resources wins, ties go to the defender
+        fight = new_kind == AGENT_CELL
+        if fight.any():
+            fight_rows, fight_x, fight_y = rows[fight], new_x[fight], new_y[fight]
+            attackers = agents[fight]
+            defenders = self.occupant[fight_rows, fight_x, fight_y]
+            attacker_wins = self.agent_resources[fight_rows, attackers] > self.agent_resources[fight_rows, defenders]
+            winners = np.where(attacker_wins, attackers, defenders)
+            losers = np.where(attacker_wins, defenders, attackers)
+            self.agent_resources[fight_rows, winners] += self.agent_resources[fight_rows, losers]
+            self.kill(fight_rows, losers, dead)
+            self.occupant[fight_rows, fight_x, fight_y] = winners
+            self.position[fight_rows, winners] = np.stack([fight_x, fight_y], axis=1)
+
+        # Agents moving to collect a resource
+        pickup = new_kind == RESOURCE_CELL
+        if pickup.any():
+            pickup_rows, pickup_x, pickup_y = rows[pickup], new_x[pickup], new_y[pickup]
+            amounts = self.amount[pickup_rows, pickup_x, pickup_y]
+            self.agent_resources[pickup_rows, agents[pickup]] += amounts
+            self.add_resources(pickup_rows, pickup_x, pickup_y, -amounts)
+            self.amount[pickup_rows, pickup_x, pickup_y] = 0
+            self.num_resources[pickup_rows] -= 1
+
+        # Agents moving into an empty cell or onto the resource they collected
+        place = ~fight
+        if place.any():
+            place_rows, place_agents, place_x, place_y = rows[place], agents[place], new_x[place], new_y[place]
+            self.kind[place_rows, place_x, place_y] = AGENT_CELL
+            self.occupant[place_rows, place_x, place_y] = place_agents
+            self.position[place_rows, place_agents] = np.stack([place_x, place_y], axis=1)
+            self.add_agents(place_rows, place_x, place_y, 1)
+
+        # Set the agents old location to be an empty cell
+        self.clear_cells(rows, x, y)
+
+    def kill(self, rows, agents, dead):
+        self.alive[rows, agents] = False
+        for b, i in zip(rows.tolist(), agents.tolist()):
+            dead[b].append(i)
+
+    def clear_cells(self, rows, x, y):
+        self.kind[rows, x, y] = EMPTY_CELL
+        self.occupant[rows, x, y] = -1
+        self.add_agents(rows, x, y, -1)
+
+    # Indices of the kernel-sized windows centered on (x[j], y[j]) in member rows[j], for every j
+    def windows(self, rows, x, y, channels):
+        offsets = np.arange(-self.r, self.r + 1)
+        return (rows[:, None, None, None], channels[None, :, None, None],
+                (x[:, None] + offsets)[:, None, :, None], (y[:, None] + offsets)[:, None, None, :])
+
+    # Same as ScoreFields.add_agent, for one cell in each of the given members
+    def add_agents(self, rows, x, y, delta):
+        window = self.windows(rows, x, y, np.arange(len(self.flipped)))
+        self.agent_field[window] += delta*self.flipped[None]
+
+    # Same as ScoreFields.add_resource, for one cell in each of the given members. <amounts> is
+    # negative when resources are consumed.
+    def add_resources(self, rows, x, y, amounts):
+        sign = np.sign(amounts)[:, None, None, None]
+        window = self.windows(rows, x, y, np.arange(1, len(self.flipped)))
+        self.resource_field[window] += sign*self.flipped[None, 1:]
+        window = self.windows(rows, x, y, np.arange(1))
+        self.resource_field[window] += amounts[:, None, None, None]
@@ -0,0 +1,345 @@
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from randomgen import PCG64
+from array_universe import ArrayUniverse
+from collect_stats import collect_stats, default_values
+from move_cache import MoveCache
+from regeneration import Constant, Diffusion, Logistic, ResourceField, Respawn
+from resource import Resource
+from rng import AgentStreams, RandomStream
+from scoring import MOVES
+from shards import ShardedUniverse
+from statistics import Statistics
+from universe import Universe
+
+
+# Runs <universe> for at most <ticks> updates and returns the average time per update in seconds
+def time_per_tick(universe, ticks):
+    stats = Statistics()
+    start = time.perf_counter()
+    while not universe.is_finished() and universe.timestep < ticks:
+        universe.update(stats)
+    return (time.perf_counter() - start)/max(universe.timestep, 1)
+
+
+# How the cost of a tick scales with the field of vision, for the object-based Universe (which
+# scores moves by scanning the window) and ArrayUniverse (which reads them from ScoreFields)
+def bench_fov_scaling(fov_values=range(1, 11), ticks=50, args=None):
+    args = args or {"num_agents": 100, "env_size": 30, "resource_prob": 0.4, "seed": 0}
+    print("fov  Universe (ms/tick)  ArrayUniverse (ms/tick)  speedup")
+    for fov in fov_values:
+        universe_time = time_per_tick(Universe(field_of_vision=fov, **args), ticks)
+        array_time = time_per_tick(ArrayUniverse(field_of_vision=fov, **args), ticks)
+        print("%3d  %19.3f  %23.3f  %6.1fx" % (fov, 1000*universe_time, 1000*array_time, universe_time/array_time))
+
+
+# Cost of finding the agents and resources in an agent's field of vision on a large sparse grid, by
+# scanning its window and with the spatial indexes of Universe
+def bench_visibility(fov_values=(5, 10, 20, 30), num_agents=500, env_size=500, resource_prob=0.01, repeat=3):
+    print("fov  scan (us/agent)  index (us/agent)  speedup")
+    for fov in fov_values:
+        universe = Universe(num_agents, env_size, resource_prob, field_of_vision=fov, seed=0)
+
+        def scan():
+            for agent in universe.agents:
+                agent.scan_environment(universe.find_restricted_env(agent))
+
+        def index():
+            for agent in universe.agents:
+                universe.find_visible(agent)
+
+        scan_time = time_call(scan, repeat)/num_agents
+        index_time = time_call(index, repeat)/num_agents
+        print("%3d  %15.3f  %16.3f  %6.1fx" % (fov, 1e6*scan_time, 1e6*index_time, scan_time/index_time))
+
+
+# Returns the average time in seconds of a call to <function>
+def time_call(function, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function()
+    return (time.perf_counter() - start)/repeat
+
+
+# Cost of setting up the agent random streams, and of breaking a tie between moves, with a PCG64
+# generator per agent (as agents used to) and with the buffered streams of rng.py
+def bench_rng(num_agents=630, repeat=20):
+    print("Setting up %d agent streams (ms)" % num_agents)
+    print("  PCG64(seed, 0).generator per agent : %8.3f" %
+          (1000*time_call(lambda: [PCG64(i, 0).generator for i in range(num_agents)], repeat)))
+    print("  RandomStream per agent             : %8.3f" %
+          (1000*time_call(lambda: [RandomStream(i) for i in range(num_agents)], repeat)))
+    print("  AgentStreams                       : %8.3f" % (1000*time_call(lambda: AgentStreams(num_agents), repeat)))
+
+    print("Breaking a tie between n moves (us)")
+    print("  n  generator.choice  RandomStream.choice  AgentStreams.randint")
+    generator = PCG64(0, 0).generator
+    stream = RandomStream(0)
+    streams = AgentStreams(1)
+    for n in range(1, len(MOVES) + 1):
+        moves = MOVES[:n]
+        print("  %d  %15.3f  %19.3f  %20.3f" % (n, 1e6*time_call(lambda: generator.choice(moves).tolist(), 1000*repeat),
+                                               1e6*time_call(lambda: stream.choice(moves), 1000*repeat),
+                                               1e6*time_call(lambda: streams.randint(0, n), 1000*repeat)))
+
+
+# Cost of a tick of resource regeneration on an env_size x env_size grid with a resource in a
+# fraction resource_prob of the cells and num_agents agents: calling Resource.update on every
+# resource object, and applying each rule of regeneration.py to a ResourceField
+def bench_regeneration(env_size=1000, resource_prob=0.4, num_agents=1000, repeat=5):
+    generator = PCG64(0, 4).generator
+    present = generator.random_sample((env_size, env_size)) < resource_prob
+    agents = np.column_stack(np.nonzero(~present))[:num_agents]
+    print("Regenerating resources on a %dx%d grid (ms/tick)" % (env_size, env_size))
+    resources = [Resource(10, lambda: 1) for i in range(int(present.sum()))]
+    print("  Resource.update per object : %8.3f" %
+          (1000*time_call(lambda: [resource.update() for resource in resources], repeat)))
+    rules = {"Constant": Constant(0.1), "Logistic": Logistic(0.1), "Diffusion": Diffusion(0.1),
+             "Respawn": Respawn(0.001)}
+    for name, rule in rules.items():
+        field = ResourceField(env_size, [rule], generator)
+        field.amount[present] = 5
+        field.visible[present] = 5
+        print("  %-26s : %8.3f" % (name, 1000*time_call(lambda: field.step(agents), repeat)))
+
+
+# Time of complete runs of Universe without and with a move cache, and the hit rate of the cache,
+# for configurations of the sweeps
+def bench_move_cache(configs=None, seeds=range(10)):
+    configs = configs or [{"num_agents": 100, "env_size": 30, "resource_prob": 0.4},
+                          {"num_agents": 315, "env_size": 30, "resource_prob": 0.4},
+                          {"num_agents": 100, "env_size": 30, "resource_prob": 0.9},
+                          {"num_agents": 100, "env_size": 30, "resource_prob": 0.4, "metabolic_rate": 5}]
+    print("%-58s  no cache (s)  cache (s)  hit rate  patterns" % "config")
+    for config in configs:
+        cache = MoveCache()
+        times = []
+        for move_cache in (None, cache):
+            start = time.perf_counter()
+            for seed in seeds:
+                universe = Universe(seed=seed, fast_init=True, move_cache=move_cache, **config)
+                stats = Statistics()
+                while not universe.is_finished():
+                    universe.update(stats)
+            times.append(time.perf_counter() - start)
+        print("%-58s  %12.2f  %9.2f  %8.3f  %8d" % (" ".join("%s=%g" % item for item in config.items()), times[0],
+                                                      times[1], cache.hit_rate(), len(cache.table)))
+
+
+# Construction time and peak memory (as traced by tracemalloc) of a universe of each backend with
+# an env_size x env_size grid, with the default and the bulk (fast_init) initial draws
+def bench_construction(env_size=1000, num_agents=1000, resource_prob=0.4, repeat=1):
+    print("Constructing a %dx%d universe with %d agents" % (env_size, env_size, num_agents))
+    print("backend        init     time (s)  peak memory (MB)")
+    for backend in (Universe, ArrayUniverse):
+        for fast_init in (False, True):
+            construct = lambda: backend(num_agents, env_size, resource_prob, seed=0, fast_init=fast_init)
+            seconds = best_time(construct, repeat)
+            tracemalloc.start()
+            universe = construct()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del universe
+            print("%-13s  %-7s  %8.4f  %16.1f" % (backend.__name__, "fast" if fast_init else "default", seconds,
+                                                 peak/1e6))
+
+
+# Cost of a tick of ArrayUniverse with the sequential and the synchronous update rules
+def bench_update_rules(sizes=((315, 30), (2000, 100), (20000, 300)), ticks=20):
+    print("agents  env_size  sequential (ms/tick)  synchronous (ms/tick)  speedup")
+    for num_agents, env_size in sizes:
+        times = [time_per_tick(ArrayUniverse(num_agents, env_size, 0.4, seed=0, update_rule=rule), ticks)
+                 for rule in ("sequential", "synchronous")]
+        print("%6d  %8d  %20.2f  %21.2f  %6.1fx" % (num_agents, env_size, 1000*times[0], 1000*times[1],
+                                                   times[0]/times[1]))
+
+
+# Cost of setting up a ShardedUniverse and of a tick of the parallel-synchronous rule on a single
+# large grid, with one shard per worker process
+def bench_shards(env_size=2000, num_agents=200000, workers=(1, 2, 4), ticks=5):
+    print("Sharded universe of %dx%d cells with %d agents" % (env_size, env_size, num_agents))
+    print("workers  setup (s)  tick (s)")
+    for count in workers:
+        start = time.perf_counter()
+        with ShardedUniverse(num_agents, env_size, 0.4, seed=0, shards=count, workers=count) as universe:
+            setup = time.perf_counter() - start
+            stats = Statistics()
+            universe.update(stats)  # The first tick also starts the workers
+            tick = time_call(lambda: universe.update(stats), ticks)
+        print("%7d  %9.2f  %8.3f" % (count, setup, tick))
+
+
+# The values each parameter takes in the benchmark suite, covering the ranges of the collect_stats
+# sweeps: 5% to 70% of a 30x30 grid for num_agents, and fields of vision from 1 to 5. Like the
+# sweeps, one parameter is varied at a time while the others keep their default values.
+SCALES = {
+    "env_size": [15, 30, 60],
+    "num_agents": [45, 315, 630],
+    "field_of_vision": [1, 3, 5],
+}
+
+# Metrics whose names end with this suffix are rates (higher is better), every other metric is a
+# time in seconds (lower is better)
+RATE_SUFFIX = "_per_sec"
+
+
+# Returns the smallest of <repeat> timings of <function>, in seconds, which is the least affected
+# by other processes running on the machine
+def best_time(function, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+# Returns the configurations of the suite, one per scaled parameter value, with their names
+def suite_configs():
+    configs = []
+    for parameter, values in SCALES.items():
+        for value in values:
+            config = {name: default_values[name] for name in ("num_agents", "env_size", "resource_prob",
+                                                              "metabolic_rate", "field_of_vision")}
+            config[parameter] = value
+            configs.append(("%s=%s" % (parameter, value), config))
+    return configs
+
+
+# Ticks per second of Universe.update over the first <ticks> ticks, and wall time of a full run.
+# Both are the best of <repeat> runs.
+def bench_update(config, ticks=50, repeat=3, seed=0):
+    def run(max_ticks):
+        universe = Universe(seed=seed, **config)
+        stats = Statistics()
+        while not universe.is_finished() and universe.timestep < max_ticks:
+            universe.update(stats)
+        return universe.timestep
+
+    num_ticks = run(ticks)
+    run_ticks = run(float("inf"))
+    run_time = best_time(lambda: run(float("inf")), repeat)
+    return {"ticks" + RATE_SUFFIX: num_ticks/best_time(lambda: run(ticks), repeat), "run_time": run_time,
+            "run_ticks" + RATE_SUFFIX: run_ticks/run_time}
+
+
+# Calls per second of find_restricted_env, Agent.find_best_move and Agent._find_best_move for every
+# agent of a freshly initialized universe (best of <repeat> rounds)
+def bench_agent_calls(config, repeat=20, seed=0):
+    universe = Universe(seed=seed, **config)
+    agents = list(universe.agents)
+    environments = [universe.find_restricted_env(agent) for agent in agents]
+    # All moves tie, the worst case for _find_best_move
+    size = 2*config["field_of_vision"] + 1
+    scores = [[0 for j in range(size)] for i in range(size)]
+
+    def restricted_env():
+        for agent in agents:
+            universe.find_restricted_env(agent)
+
+    def find_best_move():
+        for agent, environment in zip(agents, environments):
+            agent.find_best_move(environment)
+
+    def _find_best_move():
+        for agent in agents:
+            agent._find_best_move(scores)
+
+    return {
+        "find_restricted_env_calls" + RATE_SUFFIX: len(agents)/best_time(restricted_env, repeat),
+        "find_best_move_calls" + RATE_SUFFIX: len(agents)/best_time(find_best_move, repeat),
+        "_find_best_move_calls" + RATE_SUFFIX: len(agents)/best_time(_find_best_move, repeat),
+    }
+
+
+# Wall time of collect_stats over N seeds for every value of a parameter of the sweeps, on a
+# single process (best of <repeat> calls). Every call memoizes its moves in a new cache, so the
+# time does not depend on what ran before.
+def bench_collect_stats(toVary="field_of_vision", values=(1, 3, 5), N=4, repeat=3):
+    return {"run_time": best_time(lambda: collect_stats(toVary, list(values), dict(default_values), N=N),
+                                  repeat)}
+
+
+# Runs the whole suite and returns its results, a dictionary mapping each benchmark name to its
+# metrics, along with a description of the machine it ran on. Runs and collect_stats calls are
+# timed as the best of <repeat>, and the calls of the agents as the best of <calls_repeat> rounds.
+def run_suite(ticks=50, repeat=3, calls_repeat=20, N=4):
+    results = dict()
+    for name, config in suite_configs():
+        print("Benchmarking", name)
+        results["Universe.update[%s]" % name] = bench_update(config, ticks, repeat)
+        results["Agent[%s]" % name] = bench_agent_calls(config, calls_repeat)
+    print("Benchmarking collect_stats")
+    results["collect_stats[field_of_vision]"] = bench_collect_stats(N=N, repeat=repeat)
+    return {
+        "machine": {"python": sys.version.split()[0], "platform": platform.platform(),
+                    "processor": platform.processor()},
+        "results": results,
+    }
+
+
+# Returns the regressions of <current> with respect to <baseline> (both as returned by run_suite):
+# a list of (benchmark, metric, baseline value, current value) for every metric that got worse by
+# more than <threshold> (a fraction, 0.1 is 10%). Benchmarks missing from either side are skipped.
+def compare_results(baseline, current, threshold=0.1):
+    regressions = []
+    for name, metrics in baseline["results"].items():
+        for metric, old in metrics.items():
+            new = current["results"].get(name, {}).get(metric)
+            if new is None:
+                continue
+            if metric.endswith(RATE_SUFFIX):
+                regressed = new < old*(1 - threshold)
+            else:
+                regressed = new > old*(1 + threshold)
+            if regressed:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def print_results(results):
+    for name, metrics in results["results"].items():
+        print(name)
+        for metric, value in metrics.items():
+            print("  %-32s %14.4f" % (metric, value))
+
+
+# Usage:
+#   python benchmarks.py                                     fov scaling, visibility and RNG benchmarks
+#   python benchmarks.py suite <baseline.json>               runs the suite and saves it as a baseline
+#   python benchmarks.py compare <baseline.json> [threshold] runs the suite and reports (with exit
+#                                                            status 1) every metric that regressed
+#                                                            by more than threshold (0.1 by default)
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "suite":
+        results = run_suite()
+        print_results(results)
+        with open(sys.argv[2], "w") as file:
+            json.dump(results, file, indent=2)
+    elif len(sys.argv) > 2 and sys.argv[1] == "compare":
+        with open(sys.argv[2]) as file:
+            baseline = json.load(file)
+        threshold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+        results = run_suite()
+        print_results(results)
+        regressions = compare_results(baseline, results, threshold)
+        for name, metric, old, new in regressions:
+            print("REGRESSION %s %s: %.4f -> %.4f (%+.1f%%)" % (name, metric, old, new, 100*(new - old)/old))
+        print(len(regressions), "regressions above", "%g%%" % (100*threshold))
+        sys.exit(1 if regressions else 0)
+    elif len(sys.argv) > 3 and sys.argv[1] == "shards":
+        bench_shards(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        bench_fov_scaling()
+        bench_visibility()
+        bench_rng()
+        bench_regeneration()
+        bench_update_rules()
+        bench_construction()
+        bench_construction(env_size=30, num_agents=630, resource_prob=0.4, repeat=20)
+        bench_move_cache()
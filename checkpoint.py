@@ -0,0 +1,161 @@
+import json
+import numpy as np
+from agent import Agent
+from rng import BLOCK_SIZE, draw_block
+from statistics import Statistics
+from universe import Universe
+
+# Binary checkpoint of a Universe (and of the Statistics of its run) between two updates.
+#
+# The file starts with MAGIC, the length of a JSON header as a little-endian uint64 and the header.
+# The header holds the scalars (timestep, sizes, the exact state of the four PCG64 streams) and,
+# for every array, its dtype, shape and offset in the file. The arrays follow, each one written in
+# a single block aligned on ALIGNMENT bytes, so they can be memory-mapped when loading.
+#
+# Agents are stored by index (id - 1), alive or dead, so the statistics of the run can be restored:
+# - order: indices of the living agents in the order of Universe.agents (the order they are
+#   shuffled from in the next update)
+# - dead: indices of the dead agents in the order they died
+# - agent_* arrays: state of every agent; agent_position is -1 for dead agents, and agent_drawn and
+#   agent_pos are the position of the agent's random stream (see rng.RandomStream)
+# - resource_position and resource_amount: location and amount of every resource
+# - grid: the environment with its barrier halo, as cell kinds (GRID_* below)
+#
+# Loading a checkpoint gives a universe that continues exactly like the one that was saved.
+MAGIC = b"CAUNIV01"
+ALIGNMENT = 64
+
+GRID_BARRIER = -1
+GRID_EMPTY = 0
+GRID_AGENT = 1
+GRID_RESOURCE = 2
+
+
+def pad(offset):
+    return -offset % ALIGNMENT
+
+
+# Saves <universe> and the Statistics <stats> of its run to <path>. The dead agents are read from
+# <stats>, so the statistics must be a Statistics: a StreamingStatistics (as used by
+# collect_stats.py and sweep.py) only keeps aggregates and raises a TypeError.
+def save_checkpoint(path, universe, stats):
+    if not isinstance(stats, Statistics):
+        raise TypeError("Checkpoints need the Statistics of the run, not a " + type(stats).__name__)
+    if universe.resource_field is not None:
+        raise ValueError("Universes with regeneration cannot be checkpointed")
+    agents = sorted(list(universe.agents) + list(stats.dead_agents), key=Agent.get_id)
+    positions = np.full((len(agents), 2), -1, dtype=np.int64)
+    for agent, (x, y) in universe.agents_loc.items():
+        positions[agent.get_id() - 1] = (x, y)
+
+    # The resources are read from the spatial index rather than by scanning the environment
+    resources = [(x, y, resource.get_amount()) for row in universe.resource_index.buckets for bucket in row
+                 for resource, (x, y) in bucket.items()]
+    resources = np.array(resources, dtype=np.int64).reshape(-1, 3)
+
+    grid = np.full(universe.environment.shape, GRID_BARRIER, dtype=np.int8)
+    grid[universe.halo:universe.halo + universe.env_size, universe.halo:universe.halo + universe.env_size] = GRID_EMPTY
+    grid[resources[:, 0], resources[:, 1]] = GRID_RESOURCE
+    alive = positions[positions[:, 0] >= 0]
+    grid[alive[:, 0], alive[:, 1]] = GRID_AGENT
+
+    arrays = {
+        "grid": grid,
+        "order": np.array([agent.get_id() - 1 for agent in universe.agents], dtype=np.int64),
+        "dead": np.array([agent.get_id() - 1 for agent in stats.dead_agents], dtype=np.int64),
+        "agent_resources": np.array([agent.resources for agent in agents], dtype=np.int64),
+        "agent_metabolic_rate": np.array([agent.metabolic_rate for agent in agents], dtype=np.int64),
+        "agent_strategy": np.array([agent.strategy for agent in agents], dtype=np.int64),
+        "agent_time_alive": np.array([agent.time_alive for agent in agents], dtype=np.int64),
+        "agent_position": positions,
+        "agent_drawn": np.array([agent.stream.drawn for agent in agents], dtype=np.int64),
+        "agent_pos": np.array([agent.stream.pos for agent in agents], dtype=np.int64),
+        "resource_position": resources[:, :2],
+        "resource_amount": resources[:, 2],
+    }
+
+    header = {
+        "timestep": universe.timestep,
+        "env_size": universe.env_size,
+        "field_of_vision": universe.halo,
+        "stats_started": bool(stats.living_agents),
+        "stop_reason": universe.stop_reason,
+        "last_event": universe.last_event,
+        "streams": [stream.state for stream in universe.streams],
+        "arrays": dict(),
+    }
+    # The offsets depend on the length of the header, so they are computed for a header long enough
+    # to hold them
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": 0}
+    length = len(json.dumps(header)) + 32*len(arrays)
+    offset = len(MAGIC) + 8 + length
+    for name, array in arrays.items():
+        offset += pad(offset)
+        header["arrays"][name]["offset"] = offset
+        offset += array.nbytes
+    encoded = json.dumps(header).encode().ljust(length)
+
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint64(length).tobytes())
+        file.write(encoded)
+        for name, array in arrays.items():
+            file.write(b"\0"*pad(file.tell()))
+            np.ascontiguousarray(array).tofile(file)
+
+
+# Returns the header and the arrays of the checkpoint at <path>. With mmap=True, the arrays are
+# read-only memory maps of the file.
+def read_checkpoint(path, mmap=True):
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a universe checkpoint")
+        length = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(length).decode())
+        arrays = dict()
+        for name, spec in header["arrays"].items():
+            dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+            if mmap and 0 not in shape:
+                arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=spec["offset"], shape=shape)
+            else:
+                file.seek(spec["offset"])
+                arrays[name] = np.fromfile(file, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return header, arrays
+
+
+# Loads the checkpoint at <path> and returns the universe and the Statistics of its run, which
+# continue exactly like the ones that were saved. The statistics are always a Statistics.
+def load_checkpoint(path, mmap=True, debug=False, sink=None, stopping_rules=(), move_cache=None):
+    header, arrays = read_checkpoint(path, mmap)
+    env_size, halo = header["env_size"], header["field_of_vision"]
+
+    agents = []
+    for i in range(len(arrays["agent_resources"])):
+        agent = Agent(id=i+1, fov_radius=halo, resources=int(arrays["agent_resources"][i]),
+                      metabolic_rate=int(arrays["agent_metabolic_rate"][i]), strategy=int(arrays["agent_strategy"][i]),
+                      seed=i)
+        agent.time_alive = int(arrays["agent_time_alive"][i])
+        drawn, pos = int(arrays["agent_drawn"][i]), int(arrays["agent_pos"][i])
+        if drawn:
+            agent.stream.values = draw_block(i, drawn - BLOCK_SIZE).tolist()
+            agent.stream.drawn = drawn
+            agent.stream.pos = pos
+        agents.append(agent)
+
+    universe = Universe.from_state(env_size, halo, header["timestep"], header["streams"], header["stop_reason"],
+                                   header["last_event"], debug=debug, sink=sink, stopping_rules=stopping_rules,
+                                   move_cache=move_cache)
+    for i in arrays["order"].tolist():
+        x, y = arrays["agent_position"][i].tolist()
+        universe.place_agent(agents[i], x, y)
+    for (x, y), amount in zip(arrays["resource_position"].tolist(), arrays["resource_amount"].tolist()):
+        universe.place_resource(x, y, amount)
+
+    stats = Statistics()
+    if header["stats_started"]:
+        stats.set_agents(agents)
+        for i in arrays["dead"].tolist():
+            del stats.living_agents[agents[i]]
+            stats.dead_agents.append(agents[i])
+    return universe, stats
@@ -1,5 +1,13 @@
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from universe import Universe
-from statistics import Statistics
+from move_cache import MoveCache, start_worker, worker_cache
+from batch import UniverseBatch
+from statistics import StreamingStatistics
+from columnar import EXTENSION, RunTable, load_runs, win_counts
 
 # The simulation allows various values to be changed.
 # To avoid trying to explore the full variable space,
@@ -18,56 +26,247 @@ default_values = {
 }
 
 
-def printWinCountsToFile(win_counts_list, toVary):
-    with open("output/" + toVary + ".txt", "w") as file:
+# Runs N simulations (with seeds 0 to N-1) for each of the values of the <toVary> parameter and
+# writes one row per run, with its parameters, winner, run length and lifespans, to the table at
+# <path> (output/<toVary>.parquet, or output/<toVary>.npzdir without pyarrow, by default). The win
+# counts of collect_stats are computed from it (with columnar.win_counts) and written next to the
+# table (output/<toVary>.txt by default), one line of 21 counts per value, which analysis.R reads
+# when it cannot read the table. With stopping rules, the default table is
+# output/<toVary>_stopped<extension> instead (see default_path).
+def collect_runs(toVary, values, args, N=100, workers=1, path=None, stopping_rules=()):
+    from sweep import PARAMETERS, run_sweep
+    configs = [dict({parameter: args[parameter] for parameter in PARAMETERS}, **{toVary: value}) for value in values]
+    path = path or default_path(toVary, stopping_rules)
+    table = RunTable(path)
+    run_sweep(configs, range(N), None, workers, table, stopping_rules)
+    table.close()
+    printWinCountsToFile(win_counts(load_runs(path), toVary, values), os.path.splitext(path)[0] + ".txt")
+
+
+# Default path of the table of collect_runs. A run that a stopping rule ends with several winners
+# is counted in the bucket of the average of their strategies, which may not be the strategy of
+# any of them, so the tables of runs with stopping rules are kept apart from the default ones that
+# analysis.R reads.
+def default_path(toVary, stopping_rules=()):
+    return os.path.join("output", toVary + ("_stopped" if stopping_rules else "") + EXTENSION)
+
+
+# Writes the win counts of each value to <path>, one line per value
+def printWinCountsToFile(win_counts_list, path):
+    with open(path, "w") as file:
         for win_counts in win_counts_list:
             file.write(" ".join([str(i) for i in win_counts]))
             file.write("\n")
-        file.close()
-
-
-def collect_stats(toVary, values, args, N=100):
-    win_counts_list = []
-    for j in range(len(values)):
-        print("\tSimulating", toVary, "=", values[j])
-        args[toVary] = values[j]
-        win_counts = [0 for i in range(21)]
-        for i in range(N):
-            stats = Statistics()
-            universe = Universe(num_agents=args["num_agents"], env_size=args["env_size"],
-                                resource_prob=args["resource_prob"], metabolic_rate=args["metabolic_rate"],
-                                field_of_vision=args["field_of_vision"], seed=i, debug=False)
-            while not universe.is_finished():
-                universe.update(stats)
-            win_counts[int(stats.avg_win_strategy)+10] += 1
-
-        win_counts_list.append(win_counts)
+
+
+# Runs a single simulation to completion (or until one of the stopping rules fires, see
+# stopping.py) and returns the (average) strategy of the winning agent(s). The initial draws are
+# taken in bulk and the moves are memoized in <move_cache> (or in the cache of the worker process
+# when run in a pool started with move_cache.start_worker), which gives the same run (see
+# initialization.py and move_cache.py).
+def run_simulation(args, seed, stopping_rules=(), move_cache=None):
+    if move_cache is None:
+        move_cache = worker_cache()
+    stats = StreamingStatistics()
+    universe = Universe(num_agents=args["num_agents"], env_size=args["env_size"],
+                        resource_prob=args["resource_prob"], metabolic_rate=args["metabolic_rate"],
+                        field_of_vision=args["field_of_vision"], seed=seed, debug=False,
+                        stopping_rules=stopping_rules, fast_init=True, move_cache=move_cache)
+    while not universe.is_finished():
+        universe.update(stats)
+    return stats.avg_win_strategy
+
+
+# Runs the simulations with the given seeds in lockstep as a single UniverseBatch and returns the
+# (average) strategy of the winning agent(s) of each, in the order of the seeds
+def run_batch(args, seeds):
+    batch = UniverseBatch(seeds, num_agents=args["num_agents"], env_size=args["env_size"],
+                          resource_prob=args["resource_prob"], metabolic_rate=args["metabolic_rate"],
+                          field_of_vision=args["field_of_vision"])
+    return [stats.avg_win_strategy for stats in batch.run()]
+
+
+# Runs N simulations (with seeds 0 to N-1) for each of the values of the <toVary> parameter and
+# returns, for each value, the number of times each strategy has won.
+# With workers > 1, the (value, seed) runs are spread over a pool of worker processes and merged
+# into the histograms as they finish. Every run only depends on its arguments and seed, and
+# histogram counts do not depend on the order they are added in, so the output is the same as
+# the serial run for any number of workers.
+# With batched=True, the N runs of each value are simulated together as a UniverseBatch (one job
+# per value), which gives the same results.
+# With stopping rules (see stopping.py), the runs end as soon as one of them fires and the agents
+# still living are the winners. A run with several winners is counted once, in the bucket of the
+# average of their strategies (truncated toward zero), which may not be the strategy of any of
+# them. UniverseBatch does not support stopping rules.
+def collect_stats(toVary, values, args, N=100, workers=1, batched=False, stopping_rules=()):
+    if batched and stopping_rules:
+        raise ValueError("Stopping rules are not supported with batched=True")
+    win_counts_list = [[0 for i in range(21)] for j in range(len(values))]
+    if workers == 1:
+        move_cache = MoveCache()
+        for j in range(len(values)):
+            print("\tSimulating", toVary, "=", values[j])
+            args[toVary] = values[j]
+            results = run_batch(args, range(N)) if batched else \
+                [run_simulation(args, i, stopping_rules, move_cache) for i in range(N)]
+            for result in results:
+                win_counts_list[j][int(result)+10] += 1
+        return win_counts_list
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker) as executor:
+        jobs = dict()
+        for j in range(len(values)):
+            print("\tSimulating", toVary, "=", values[j])
+            args[toVary] = values[j]
+            if batched:
+                jobs[executor.submit(run_batch, dict(args), range(N))] = j
+                continue
+            for i in range(N):
+                jobs[executor.submit(run_simulation, dict(args), i, stopping_rules)] = j
+        for job in as_completed(jobs):
+            results = job.result() if batched else [job.result()]
+            for result in results:
+                win_counts_list[jobs[job]][int(result)+10] += 1
     return win_counts_list
 
 
-# # Number of agents: With respect to environment size, from 5% to 70%
-# print("Varying number of agents: With respect to environment size, from 5% to 70%")
-# values = [int(30*30*(i+1)*0.05) for i in range(14)]
-# win_counts_list = collect_stats(toVary="num_agents", values=values, args=default_values)
-# printWinCountsToFile(win_counts_list, "num_agents")
-#
-#
-# # Resource abundance: Controlled by resource_prob variable from 0.1 to 0.9
-# print("Varying resource abundance: Controlled by resource_prob variable from 0.1 to 0.9")
-# values = [(i+1)*0.1 for i in range(9)]
-# win_counts_list = collect_stats(toVary="resource_prob", values=values, args=default_values)
-# printWinCountsToFile(win_counts_list, "resource_prob")
-
-
-# Field of vision: Varying from 1 to 5
-print("Varying field of vision: varying from 1 to 5")
-values = [i + 1 for i in range(5)]
-win_counts_list = collect_stats(toVary="field_of_vision", values=values, args=default_values)
-printWinCountsToFile(win_counts_list, "field_of_vision")
-
-
-# # Metabolic rate: Varying from 1 to 10
-# print("Varying metabolic rate: Varying from 1 to 10")
-# values = [i + 1 for i in range(10)]
-# win_counts_list = collect_stats(toVary="metabolic_rate", values=values, args=default_values)
-# printWinCountsToFile(win_counts_list, "metabolic_rate")
+# Quantile z of the standard normal distribution such that P(-z < X < z) = confidence
+def normal_quantile(confidence):
+    low, high = 0.0, 10.0
+    for i in range(60):
+        z = (low + high)/2
+        if math.erf(z/math.sqrt(2)) < confidence:
+            low = z
+        else:
+            high = z
+    return (low + high)/2
+
+
+# Width of the widest Wilson score interval of the proportions of <counts> (a histogram of n runs),
+# at the confidence of the normal quantile z
+def ci_width(counts, z=1.96):
+    n = sum(counts)
+    if n == 0:
+        return 1.0
+    width = 0
+    for count in counts:
+        p = count/n
+        width = max(width, 2*z*math.sqrt(p*(1-p)/n + z*z/(4*n*n))/(1 + z*z/n))
+    return width
+
+
+# Strategy that has won the most runs in a histogram (the lowest one on ties)
+def mode(counts):
+    return counts.index(max(counts)) - 10
+
+
+# Like collect_stats, but rather than running N seeds for every value, runs them in batches of
+# batch_size seeds until the win-count histogram of the value has converged: until the widest
+# confidence interval of its proportions (ci_width) is at most target_width, or, with
+# mode_patience, until its mode has not changed for mode_patience batches. A value is also stopped
+# after max_runs runs, and no more than budget runs (if given) are simulated in total.
+# Values are simulated in rounds of one batch per value that has not converged. Since converged
+# values drop out, the later rounds only simulate the values that are still uncertain, and when the
+# budget does not cover a whole round it goes to the values with the widest intervals first.
+# The seeds of a value are always 0, 1, 2, ..., so its histogram is the one collect_stats gives
+# with N set to its number of runs. Every decision is returned as a dictionary (and written as a
+# JSON line to <log>, if given) with the round, the value, its number of runs, interval width and
+# mode, and the decision: "continue", "converged", "max_runs" or "budget". The decisions only
+# depend on the results, so they are the same for any number of workers.
+# Returns the histograms, the number of runs of every value and the decisions.
+def collect_stats_adaptive(toVary, values, args, batch_size=20, target_width=0.2, confidence=0.95,
+                           mode_patience=None, max_runs=1000, budget=None, workers=1, log=None,
+                           stopping_rules=()):
+    z = normal_quantile(confidence)
+    win_counts_list = [[0 for i in range(21)] for j in range(len(values))]
+    runs = [0 for j in values]
+    modes = [[] for j in values]
+    active = list(range(len(values)))
+    decisions = []
+    log_file = open(log, "w") if log is not None else None
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=start_worker) if workers > 1 else None
+    move_cache = MoveCache()
+    step = 0
+    try:
+        while active:
+            # The values with the widest intervals get the budget first
+            active.sort(key=lambda j: (-ci_width(win_counts_list[j], z), j))
+            batches = []
+            for j in active:
+                size = min(batch_size, max_runs - runs[j])
+                if budget is not None:
+                    size = min(size, budget - sum(runs) - sum(len(seeds) for k, seeds in batches))
+                if size > 0:
+                    batches.append((j, range(runs[j], runs[j] + size)))
+
+            jobs = []
+            for j, seeds in batches:
+                print("\tSimulating", toVary, "=", values[j], "seeds", seeds.start, "to", seeds.stop - 1)
+                job_args = dict(args, **{toVary: values[j]})
+                for i in seeds:
+                    if executor is None:
+                        jobs.append((j, run_simulation(job_args, i, stopping_rules, move_cache)))
+                    else:
+                        jobs.append((j, executor.submit(run_simulation, job_args, i, stopping_rules)))
+            for j, result in jobs:
+                result = result if executor is None else result.result()
+                win_counts_list[j][int(result)+10] += 1
+                runs[j] += 1
+
+            still_active = []
+            for j in sorted(active):
+                width = ci_width(win_counts_list[j], z)
+                modes[j].append(mode(win_counts_list[j]))
+                stable = mode_patience is not None and len(modes[j]) > mode_patience and \
+                    len(set(modes[j][-mode_patience-1:])) == 1
+                if width <= target_width or stable:
+                    decision = "converged"
+                elif runs[j] >= max_runs:
+                    decision = "max_runs"
+                elif budget is not None and sum(runs) >= budget:
+                    decision = "budget"
+                else:
+                    decision = "continue"
+                    still_active.append(j)
+                record = {"round": step, "value": values[j], "runs": runs[j], "width": width,
+                          "mode": modes[j][-1], "decision": decision}
+                decisions.append(record)
+                if log_file is not None:
+                    log_file.write(json.dumps(record) + "\n")
+                    log_file.flush()
+            active = still_active
+            step += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if log_file is not None:
+            log_file.close()
+    return win_counts_list, runs, decisions
+
+
+if __name__ == "__main__":
+    # Number of worker processes to run the simulations on, all cores by default
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+
+    # # Number of agents: With respect to environment size, from 5% to 70%
+    # print("Varying number of agents: With respect to environment size, from 5% to 70%")
+    # values = [int(30*30*(i+1)*0.05) for i in range(14)]
+    # collect_runs(toVary="num_agents", values=values, args=default_values, workers=workers)
+    #
+    #
+    # # Resource abundance: Controlled by resource_prob variable from 0.1 to 0.9
+    # print("Varying resource abundance: Controlled by resource_prob variable from 0.1 to 0.9")
+    # values = [(i+1)*0.1 for i in range(9)]
+    # collect_runs(toVary="resource_prob", values=values, args=default_values, workers=workers)
+
+
+    # Field of vision: Varying from 1 to 5
+    print("Varying field of vision: varying from 1 to 5")
+    values = [i + 1 for i in range(5)]
+    collect_runs(toVary="field_of_vision", values=values, args=default_values, workers=workers)
+
+
+    # # Metabolic rate: Varying from 1 to 10
+    # print("Varying metabolic rate: Varying from 1 to 10")
+    # values = [i + 1 for i in range(10)]
+    # collect_runs(toVary="metabolic_rate", values=values, args=default_values, workers=workers)
@@ -0,0 +1,117 @@
+import os
+import numpy as np
+
+# Run results are written as tables with one row per run and one column per field. A path ending
+# in .parquet is written as a Parquet file with pyarrow (one row group per batch), which pandas
+# (pandas.read_parquet) and R (arrow::read_parquet) load without parsing. pyarrow is optional:
+# any other path is written as a directory of uncompressed NPZ files, one per batch, with the
+# same columns (named .npzdir by default, since it is not an NPZ file itself). Both are read back
+# with load_runs.
+try:
+    import pyarrow
+    import pyarrow.parquet
+    PARQUET = True
+except ImportError:
+    PARQUET = False
+
+# Extension of the tables written by default, Parquet when pyarrow is installed
+EXTENSION = ".parquet" if PARQUET else ".npzdir"
+
+# Columns of a run table, with their types. The first ones are the parameters of the run
+# (sweep.PARAMETERS) and its seed.
+COLUMNS = [
+    ("num_agents", np.int64),
+    ("env_size", np.int64),
+    ("resource_prob", np.float64),
+    ("metabolic_rate", np.int64),
+    ("field_of_vision", np.int64),
+    ("seed", np.int64),
+    ("timesteps", np.int64),
+    ("winner", np.int64),                   # Id of the winning agent (the first one if there are several)
+    ("avg_win_strategy", np.float64),
+    ("avg_win_metabolic_rate", np.float64),
+    ("lifespan_defensive", np.float64),     # Average lifespans of the agents of each strategy class
+    ("lifespan_neutral", np.float64),
+    ("lifespan_aggressive", np.float64),
+    ("stop_reason", str),                   # Universe.stop_reason
+]
+
+
+# Returns the row of a run result record (as returned by sweep.simulate)
+def to_row(record):
+    row = dict(record["config"])
+    row.update(seed=record["seed"], timesteps=record["timesteps"], winner=record.get("winner", -1),
+               stop_reason=record.get("stop_reason", "last_agent"),
+               avg_win_strategy=record["avg_win_strategy"], avg_win_metabolic_rate=record["avg_win_metabolic_rate"])
+    row["lifespan_defensive"], row["lifespan_neutral"], row["lifespan_aggressive"] = record["avg_lifespans"]
+    return row
+
+
+# Writes run result records to a table at <path>, batch_size rows at a time
+class RunTable:
+    def __init__(self, path, batch_size=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.parts = 0
+        self.writer = None
+        if path.endswith(".parquet"):
+            if not PARQUET:
+                raise ImportError("pyarrow is required to write " + path)
+            schema = pyarrow.schema([(name, pyarrow.string() if dtype is str else pyarrow.from_numpy_dtype(dtype))
+                                     for name, dtype in COLUMNS])
+            self.writer = pyarrow.parquet.ParquetWriter(path, schema)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if name.startswith("part-") and name.endswith(".npz"):
+                    os.remove(os.path.join(path, name))
+
+    def add(self, record):
+        self.rows.append(to_row(record))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    # Writes the rows added since the last batch
+    def flush(self):
+        if not self.rows:
+            return
+        columns = {name: np.array([row[name] for row in self.rows], dtype=dtype) for name, dtype in COLUMNS}
+        if self.writer is not None:
+            self.writer.write_table(pyarrow.table(columns))
+        else:
+            np.savez(os.path.join(self.path, "part-%05d.npz" % self.parts), **columns)
+        self.parts += 1
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+# Returns the table at <path> as a dictionary mapping each column name to a NumPy array
+def load_runs(path):
+    if path.endswith(".parquet"):
+        table = pyarrow.parquet.read_table(path)
+        return {name: table.column(name).to_numpy() for name, dtype in COLUMNS}
+    parts = sorted(name for name in os.listdir(path) if name.startswith("part-") and name.endswith(".npz"))
+    columns = {name: [] for name, dtype in COLUMNS}
+    for part in parts:
+        with np.load(os.path.join(path, part)) as arrays:
+            for name in columns:
+                columns[name].append(arrays[name])
+    return {name: np.concatenate(columns[name]) if columns[name] else np.empty(0, dtype=dtype)
+            for name, dtype in COLUMNS}
+
+
+# Returns, for each of the given values of parameter <toVary>, the number of times each strategy
+# has won among the runs of <runs> (as returned by load_runs), the histograms of collect_stats.
+# A run stopped with several winners (see stopping.py) is counted in the bucket of their average
+# strategy.
+def win_counts(runs, toVary, values):
+    win_counts_list = []
+    for value in values:
+        strategies = runs["avg_win_strategy"][runs[toVary] == value]
+        win_counts_list.append(np.bincount(strategies.astype(np.int64) + 10, minlength=21).tolist())
+    return win_counts_list
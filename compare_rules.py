@@ -0,0 +1,100 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from array_universe import ArrayUniverse
+from collect_stats import default_values
+from statistics import StreamingStatistics
+
+# Compares the win counts of the sequential update rule (Universe, and ArrayUniverse by default)
+# with those of the synchronous rule (ArrayUniverse(..., update_rule="synchronous"), see
+# shards.py) on the sweeps of collect_stats.py, with the same seeds.
+
+# Values of the parameters varied by collect_stats.py
+SWEEPS = {
+    "num_agents": [int(30*30*(i+1)*0.05) for i in range(14)],
+    "resource_prob": [(i+1)*0.1 for i in range(9)],
+    "field_of_vision": [i + 1 for i in range(5)],
+    "metabolic_rate": [i + 1 for i in range(10)],
+}
+UPDATE_RULES = ["sequential", "synchronous"]
+
+
+# Runs a single simulation with the given update rule to completion and returns the (average)
+# strategy of the winning agent(s) and the length of the run
+def run_rule(args, seed, update_rule):
+    stats = StreamingStatistics()
+    universe = ArrayUniverse(num_agents=args["num_agents"], env_size=args["env_size"],
+                             resource_prob=args["resource_prob"], metabolic_rate=args["metabolic_rate"],
+                             field_of_vision=args["field_of_vision"], seed=seed, update_rule=update_rule,
+                             fast_init=True)
+    while not universe.is_finished():
+        universe.update(stats)
+    return stats.avg_win_strategy, universe.timestep
+
+
+# Total variation distance between the win-count histograms <a> and <b>, from 0 (the same
+# distribution) to 1 (no strategy wins under both)
+def total_variation(a, b):
+    return sum(abs(x/sum(a) - y/sum(b)) for x, y in zip(a, b))/2
+
+
+# Chi-square statistic of the test that histograms <a> and <b> come from the same distribution,
+# and its number of degrees of freedom
+def chi_square(a, b):
+    statistic, bins = 0.0, 0
+    for x, y in zip(a, b):
+        if x + y == 0:
+            continue
+        bins += 1
+        expected_x = (x + y)*sum(a)/(sum(a) + sum(b))
+        expected_y = (x + y)*sum(b)/(sum(a) + sum(b))
+        statistic += (x - expected_x)**2/expected_x + (y - expected_y)**2/expected_y
+    return statistic, max(bins - 1, 0)
+
+
+# Runs N simulations (with seeds 0 to N-1) for each of the values of the <toVary> parameter under
+# both rules, and returns, for each value, a dictionary with the win counts of each rule, the mean
+# winning strategy and run length of each rule, and the total variation distance and chi-square
+# statistic between the win counts
+def compare_rules(toVary, values, args, N=100, workers=1):
+    jobs = [(dict(args, **{toVary: value}), seed, rule) for value in values for rule in UPDATE_RULES
+            for seed in range(N)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run_rule, *zip(*jobs)))
+    else:
+        results = [run_rule(*job) for job in jobs]
+
+    comparison = []
+    for j, value in enumerate(values):
+        row = {"value": value}
+        for k, rule in enumerate(UPDATE_RULES):
+            runs = results[(j*len(UPDATE_RULES) + k)*N:(j*len(UPDATE_RULES) + k + 1)*N]
+            win_counts = [0 for i in range(21)]
+            for strategy, timesteps in runs:
+                win_counts[int(strategy)+10] += 1
+            row[rule] = win_counts
+            row[rule + "_mean_strategy"] = sum(strategy for strategy, timesteps in runs)/N
+            row[rule + "_mean_timesteps"] = sum(timesteps for strategy, timesteps in runs)/N
+        row["distance"] = total_variation(row["sequential"], row["synchronous"])
+        row["chi_square"], row["degrees_of_freedom"] = chi_square(row["sequential"], row["synchronous"])
+        comparison.append(row)
+    return comparison
+
+
+def print_comparison(toVary, comparison):
+    print("%-15s  mean strategy (seq/sync)  mean ticks (seq/sync)  distance  chi-square (dof)" % toVary)
+    for row in comparison:
+        print("%-15g  %11.2f / %-10.2f  %9.1f / %-9.1f  %8.3f  %10.1f (%d)" % (
+            row["value"], row["sequential_mean_strategy"], row["synchronous_mean_strategy"],
+            row["sequential_mean_timesteps"], row["synchronous_mean_timesteps"], row["distance"],
+            row["chi_square"], row["degrees_of_freedom"]))
+        for rule in UPDATE_RULES:
+            print("  %-11s %s" % (rule, " ".join("%3d" % count for count in row[rule])))
+
+
+if __name__ == "__main__":
+    # python compare_rules.py [N] [workers] [parameter ...]
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    for toVary in sys.argv[3:] or list(SWEEPS):
+        print_comparison(toVary, compare_rules(toVary, SWEEPS[toVary], dict(default_values), N, workers))
@@ -0,0 +1,49 @@
+import math
+import numpy as np
+from randomgen import PCG64
+
+# Universes place their agents by rejection sampling, two randint calls per attempt, and then roll
+# a uniform draw for every free cell, one call at a time. With fast_init=True they take the same
+# draws in bulk instead: a batch of draws of the same distribution gives the same values as the
+# same number of single draws, so the initial state (positions, strategies and resources) is
+# exactly the one of the default initialization, and so is every run.
+#
+# Stream semantics of the bulk draws, from the universe's streams 0 to 2:
+# 0. Pairs of randint(0, env_size-1) are drawn in batches large enough to hold num_agents
+#    distinct cells in most cases, and agent i takes the i-th distinct cell drawn. Cells drawn
+#    again, like rejected attempts, are skipped.
+# 1. One normal(0, 5) per agent, rounded and clipped to [-10, 10].
+# 2. One uniform(0, 1) per free cell in row-major order; a cell holds a resource when its draw is
+#    below resource_prob.
+# Only the positions of streams 0 to 2 after initialization differ from the default: the last
+# batch of stream 0 usually holds draws that are never used. Neither universe draws from these
+# streams after initialization, but their positions are saved with checkpoints.
+
+
+# Returns the initial state of a universe with the given parameters and seed (or drawn from
+# <streams>, the universe's streams 0 to 2): the positions of the agents (without the halo), their
+# strategies and a mask of the resource cells
+def initial_state(num_agents, env_size, resource_prob, seed, streams=None):
+    if streams is None:
+        streams = [PCG64(seed, stream) for stream in range(3)]
+    cells = env_size*env_size
+    drawn = np.empty(0, dtype=np.int64)
+    first = np.empty(0, dtype=np.int64)
+    while len(first) < num_agents:
+        # Expected number of draws to reach num_agents distinct cells, with a margin
+        missing = num_agents - len(first)
+        expected = cells*math.log(cells/max(cells - num_agents, 0.5)) - len(drawn)
+        count = max(int(1.1*expected), missing) + 16
+        xy = streams[0].generator.randint(0, env_size-1, size=2*count, closed=True).reshape(-1, 2)
+        drawn = np.concatenate([drawn, xy[:, 0]*env_size + xy[:, 1]])
+        first = np.sort(np.unique(drawn, return_index=True)[1])
+    agent_cells = drawn[first[:num_agents]]
+    positions = np.stack([agent_cells // env_size, agent_cells % env_size], axis=1)
+
+    strategies = np.clip(np.round(streams[1].generator.normal(loc=0.0, scale=5.0, size=num_agents)), -10, 10)
+
+    free = np.ones(cells, dtype=bool)
+    free[agent_cells] = False
+    resources = np.zeros(cells, dtype=bool)
+    resources[free] = streams[2].generator.uniform(0, 1, size=int(free.sum())) < resource_prob
+    return positions, strategies.astype(np.int64), resources.reshape(env_size, env_size)
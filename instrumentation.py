@@ -0,0 +1,76 @@
+import csv
+import time
+
+# Phases of Universe.update that are timed, in the order they appear in a row
+PHASES = ["metabolism", "find_restricted_env", "find_best_move", "resolve_movement", "removal"]
+METABOLISM, FIND_RESTRICTED_ENV, FIND_BEST_MOVE, RESOLVE_MOVEMENT, REMOVAL = range(len(PHASES))
+
+# Events that are counted every tick
+COUNTERS = ["fights", "pickups", "deaths"]
+
+# Columns of a tick row: the timestep, the number of agents at the start of the tick, the time in
+# seconds spent in each phase and the event counts
+FIELDS = ["timestep", "agents"] + PHASES + COUNTERS
+
+
+# Adds the time elapsed since <start> to phase <phase> of <times> and returns the current time, to
+# start timing the next phase
+def lap(times, phase, start):
+    now = time.perf_counter()
+    times[phase] += now - start
+    return now
+
+
+# Sinks receive one row (a dictionary with the keys in FIELDS) at the end of every tick of a
+# Universe created with sink=<the sink>. Universe only times its phases when it has a sink.
+
+# Keeps every row in memory, in self.rows
+class MemorySink:
+    def __init__(self):
+        self.rows = []
+
+    def record(self, row):
+        self.rows.append(row)
+
+    # Returns the sum of every column over all the recorded ticks (except timestep and agents)
+    def totals(self):
+        return {field: sum(row[field] for row in self.rows) for field in PHASES + COUNTERS}
+
+    def close(self):
+        pass
+
+
+# Writes every row to a CSV file with a header line. Rows are flushed when the sink is closed.
+class CSVSink:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+        self.writer.writeheader()
+
+    def record(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+# Calls <callback> with every row
+class CallbackSink:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, row):
+        self.callback(row)
+
+    def close(self):
+        pass
+
+
+# Prints the events of every tick, used by Universe(debug=True)
+class PrintSink:
+    def record(self, row):
+        print("Timestep", row["timestep"], ":", row["agents"], "agents,", row["fights"], "fights,",
+              row["pickups"], "pickups,", row["deaths"], "deaths")
+
+    def close(self):
+        pass
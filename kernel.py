@@ -0,0 +1,160 @@
+import numpy as np
+from array_universe import EMPTY_CELL, AGENT_CELL, RESOURCE_CELL
+from scoring import MOVE_X, MOVE_Y, SELF_DISTANCE
+
+# The tick kernel is compiled with Numba when it is installed. Without it, AVAILABLE is False and
+# ArrayUniverse runs its pure Python update instead.
+try:
+    from numba import njit
+    AVAILABLE = True
+    jit = njit(cache=True)
+except ImportError:
+    AVAILABLE = False
+
+    def jit(function):
+        return function
+
+# Same as AgentStreams.randint for the stream of agent <index>, except that it returns -1 if the
+# block of the stream runs out; the values consumed so far stay consumed.
+@jit
+def bounded(n, index, rng_values, rng_pos):
+    high = n - 1
+    if high == 0:
+        return 0
+    mask = high
+    mask |= mask >> 1
+    mask |= mask >> 2
+    mask |= mask >> 4
+    mask |= mask >> 8
+    mask |= mask >> 16
+    while True:
+        pos = rng_pos[index]
+        if pos == rng_values.shape[1]:
+            return -1
+        rng_pos[index] = pos + 1
+        value = np.int64(rng_values[index, pos]) & mask
+        if value <= high:
+            return value
+
+
+# Same as ScoreFields.add_agent and ScoreFields.add_resource
+@jit
+def add_to_field(field, flipped, x, y, r, first, weight, delta):
+    for k in range(first, field.shape[0]):
+        for a in range(2*r + 1):
+            for b in range(2*r + 1):
+                field[k, x-r+a, y-r+b] += delta*flipped[k, a, b]
+    if first == 1:
+        for a in range(2*r + 1):
+            for b in range(2*r + 1):
+                field[0, x-r+a, y-r+b] += delta*weight
+
+
+@jit
+def clear_agent(x, y, kind, occupant, agent_field, flipped, r):
+    kind[x, y] = EMPTY_CELL
+    occupant[x, y] = -1
+    add_to_field(agent_field, flipped, x, y, r, 0, 0, -1)
+
+
+@jit
+def kill(index, alive, dead, counts):
+    alive[index] = False
+    dead[counts[0]] = index
+    counts[0] += 1
+
+
+# Moves every agent of order[start:] in turn: metabolism, scoring, tie-breaking, movement, fights
+# and resource pickups, exactly like ArrayUniverse.move_agents.
+#
+# Returns len(order) once every agent has moved. If the block of an agent's stream runs out while
+# breaking a tie, returns the position of that agent in <order> instead: the caller must refill
+# the block and call the kernel again from that position with resume_draw=True, which skips the
+# metabolism the agent already went through.
+#
+# counts[0] is the number of agents in <dead>, counts[1] the number of resources left.
+@jit
+def tick(order, start, resume_draw, alive, agent_resources, metabolic_rate, strategy, position,
+         kind, occupant, amount, agent_field, resource_field, flipped, barrier, r,
+         rng_values, rng_pos, dead, counts):
+    ties = np.empty(len(MOVE_X), dtype=np.int64)
+    for i in range(start, len(order)):
+        index = order[i]
+        # If this agent was eliminated by another agent in this timestep
+        if not alive[index]:
+            continue
+        x = position[index, 0]
+        y = position[index, 1]
+
+        # Update the agents resources based on the agents metabolic rate
+        if not (resume_draw and i == start):
+            agent_resources[index] -= metabolic_rate[index]
+            if agent_resources[index] <= 0:
+                kill(index, alive, dead, counts)
+                clear_agent(x, y, kind, occupant, agent_field, flipped, r)
+                continue
+
+        # Score the moves and keep the best ones, in the order of MOVES
+        s = strategy[index]
+        best_score = 0
+        num_ties = 0
+        for m in range(len(MOVE_X)):
+            if barrier[x + MOVE_X[m], y + MOVE_Y[m]]:
+                continue
+            score = resource_field[0, x, y] - resource_field[1 + m, x, y]
+            if s != 0:
+                distances = agent_field[1 + m, x, y] - SELF_DISTANCE[m]
+                score += s*(agent_field[0, x, y] - 1) + (distances if s < 0 else -distances)
+            if num_ties == 0 or score > best_score:
+                best_score = score
+                ties[0] = m
+                num_ties = 1
+            elif score == best_score:
+                ties[num_ties] = m
+                num_ties += 1
+
+        choice = bounded(num_ties, index, rng_values, rng_pos)
+        if choice < 0:
+            return i
+        m = ties[choice]
+
+        # If the agent chose to remain in the current space, no further update required
+        if MOVE_X[m] == 0 and MOVE_Y[m] == 0:
+            continue
+        new_x = x + MOVE_X[m]
+        new_y = y + MOVE_Y[m]
+
+        # If the agent is moving to attack another agent
+        if kind[new_x, new_y] == AGENT_CELL:
+            defender = occupant[new_x, new_y]
+            if agent_resources[index] > agent_resources[defender]:
+                winner, loser = index, defender
+            else:
+                winner, loser = defender, index
+            agent_resources[winner] += agent_resources[loser]
+            kill(loser, alive, dead, counts)
+            occupant[new_x, new_y] = winner
+
+        # If the agent is moving to collect a resource
+        elif kind[new_x, new_y] == RESOURCE_CELL:
+            agent_resources[index] += amount[new_x, new_y]
+            add_to_field(resource_field, flipped, new_x, new_y, r, 1, amount[new_x, new_y], -1)
+            amount[new_x, new_y] = 0
+            counts[1] -= 1
+            add_to_field(agent_field, flipped, new_x, new_y, r, 0, 0, 1)
+            winner = index
+
+        # If the agent is moving into an empty cell
+        else:
+            add_to_field(agent_field, flipped, new_x, new_y, r, 0, 0, 1)
+            winner = index
+
+        kind[new_x, new_y] = AGENT_CELL
+        occupant[new_x, new_y] = winner
+        position[winner, 0] = new_x
+        position[winner, 1] = new_y
+
+        # Set the agents old location to be an empty cell
+        clear_agent(x, y, kind, occupant, agent_field, flipped, r)
+
+    return len(order)
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from agent import Agent, EMPTY_CELL
+from resource import Resource
+
+# Memoized move choices for agents with a field of vision of 1. Such an agent scores its moves from
+# the 9 cells of its view only, so the moves with the best score (before the agent's random stream
+# breaks the tie) only depend on its strategy and on the kind of every cell of the view, and on
+# the amount of the resources in it. Most views of a run are the same few patterns, so their best
+# moves are kept in a table keyed by an integer encoding of the strategy and the view:
+# - every cell is a 4-bit code: 0 for an empty cell, 1 for a barrier, 2 for an agent and
+#   2 + amount for a resource
+# - the codes of the cells, in row-major order, follow the strategy (offset by 10 to be positive)
+# Views with a resource of more than MAX_AMOUNT units (or less than 1) cannot be encoded, and
+# are scored in full every time.
+#
+# The table is bounded: it keeps the <capacity> most recently used patterns, and the counters tell
+# how many lookups were hits, misses (scored and added to the table) and fallbacks (not encoded).
+# The table only depends on the scoring rule, so one cache can be shared by the universes of a
+# batch of runs.
+BITS = 4
+MAX_AMOUNT = (1 << BITS) - 3
+AGENT_CODE = 2
+
+
+# Returns the key of the view <environment> of an agent with the given strategy, or None if the
+# view cannot be encoded
+def encode(environment, strategy):
+    key = strategy + 10
+    for cell in environment.ravel().tolist():
+        if isinstance(cell, Agent):
+            code = AGENT_CODE
+        elif isinstance(cell, Resource):
+            amount = cell.get_amount()
+            if not 1 <= amount <= MAX_AMOUNT:
+                return None
+            code = AGENT_CODE + amount
+        else:
+            code = 0 if cell == EMPTY_CELL else 1
+        key = (key << BITS) | code
+    return key
+
+
+class MoveCache:
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.evictions = 0
+
+    # Same as agent.find_best_move_among(environment, *find_visible(agent)), where environment is
+    # the agent's view and find_visible returns the agents and resources in it, such as
+    # Universe.find_visible. The agent draws from its stream exactly as without the cache.
+    def find_best_move(self, agent, environment, find_visible):
+        key = encode(environment, agent.strategy) if agent.fov_radius == 1 else None
+        if key is None:
+            self.fallbacks += 1
+            return agent.find_best_move_among(environment, *find_visible(agent))
+
+        best_moves = self.table.get(key)
+        if best_moves is None:
+            self.misses += 1
+            best_moves = agent.best_moves_among(environment, *find_visible(agent))
+            self.table[key] = best_moves
+            if len(self.table) > self.capacity:
+                self.table.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            self.table.move_to_end(key)
+        return agent.choose_move(best_moves)
+
+    # Fraction of the lookups answered from the table
+    def hit_rate(self):
+        lookups = self.hits + self.misses + self.fallbacks
+        return self.hits/lookups if lookups else 0.0
+
+    def clear(self):
+        self.table.clear()
+        self.hits = self.misses = self.fallbacks = self.evictions = 0
+
+
+# Cache of a worker process of a pool started with initializer=start_worker, shared by the runs
+# of that worker for the lifetime of the pool. It is None in other processes.
+_worker_cache = None
+
+
+# Initializer of the worker processes of a pool
+def start_worker():
+    global _worker_cache
+    _worker_cache = MoveCache()
+
+
+def worker_cache():
+    return _worker_cache
@@ -0,0 +1,86 @@
+import numpy as np
+
+# Regrowing resources. Rather than calling Resource.update (and its regenerate function) on every
+# resource object, the amount of every cell of the environment is kept in a float array, and growth
+# rules update the whole array with a few NumPy operations per tick. A cell holds a resource (an
+# object of the Universe) while its amount is at least 1, and the amount of the resource is the
+# integer part of the cell's amount. After the rules are applied, only the cells whose integer
+# amount changed are written back to the Universe.
+#
+# A rule has an apply(amount, free, generator) method that updates <amount> in place, where <free>
+# is False for the cells occupied by an agent and <generator> is the regeneration's random stream.
+# Cells occupied by an agent hold no resource: their amount is set to 0 after the rules are applied.
+
+
+# Every free cell grows by <rate> per tick, up to <capacity>
+class Constant:
+    def __init__(self, rate, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+
+    def apply(self, amount, free, generator):
+        amount += self.rate
+        np.minimum(amount, self.capacity, out=amount)
+
+
+# Every cell with a positive amount grows logistically towards <capacity>, so depleted cells stay
+# empty unless another rule seeds them
+class Logistic:
+    def __init__(self, rate, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+
+    def apply(self, amount, free, generator):
+        amount += self.rate*amount*(1 - amount/self.capacity)
+
+
+# Every cell moves <rate> of the difference between the average of its four neighbours and its own
+# amount towards it. The edges of the environment do not let resources through.
+class Diffusion:
+    def __init__(self, rate):
+        self.rate = rate
+
+    def apply(self, amount, free, generator):
+        padded = np.pad(amount, 1, mode="edge")
+        neighbours = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+        amount += self.rate*(neighbours/4 - amount)
+
+
+# Every free cell without a resource gets one of <size> with probability <prob>
+class Respawn:
+    def __init__(self, prob, size=10):
+        self.prob = prob
+        self.size = size
+
+    def apply(self, amount, free, generator):
+        spawned = (generator.random_sample(amount.shape) < self.prob) & free & (amount < 1)
+        amount[spawned] = self.size
+
+
+# Amounts of the cells of an env_size x env_size environment, grown by <rules> in order every tick.
+# Locations exclude the barrier halo of the Universe.
+class ResourceField:
+    def __init__(self, env_size, rules, generator):
+        self.rules = list(rules)
+        self.generator = generator
+        self.amount = np.zeros((env_size, env_size))
+        self.visible = np.zeros((env_size, env_size), dtype=np.int64)  # Amounts of the resources in the Universe
+
+    # Sets the amount of cell (x, y), for a resource placed or collected in the Universe
+    def set(self, x, y, amount):
+        self.amount[x, y] = amount
+        self.visible[x, y] = amount
+
+    # Applies the rules for one tick, with agents at the locations <agents> (an array of (x, y)), and
+    # returns the cells whose resource changed (an array of (x, y)) and their new amounts (0 for no
+    # resource)
+    def step(self, agents):
+        free = np.ones(self.amount.shape, dtype=bool)
+        free[agents[:, 0], agents[:, 1]] = False
+        for rule in self.rules:
+            rule.apply(self.amount, free, self.generator)
+        self.amount[~free] = 0
+        visible = self.amount.astype(np.int64)
+        changed = np.argwhere(visible != self.visible)
+        self.visible = visible
+        return changed, visible[changed[:, 0], changed[:, 1]]
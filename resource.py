@@ -1,10 +1,18 @@
+# A universe holds one Resource per cell with resources, so resources have no per-instance
+# dictionary, and resources that do not regenerate share no function either (fn is None)
 class Resource:
-    def __init__(self, initial, fn=lambda x: 0):
+    __slots__ = ("amount", "regenerate")
+
+    def __init__(self, initial, fn=None):
         self.amount = initial
         self.regenerate = fn
 
     def update(self):
-        self.amount += self.regenerate()
+        if self.regenerate is not None:
+            self.amount += self.regenerate()
 
     def get_amount(self):
         return self.amount
+
+    def set_amount(self, amount):
+        self.amount = amount
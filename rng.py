@@ -0,0 +1,153 @@
+import numpy as np
+from randomgen import PCG64
+
+# Every agent breaks ties with its own PCG64(seed, 0) stream. Instead of building a generator per
+# agent and calling generator.choice for every move, the streams are read from blocks of pre-drawn
+# values: BLOCK_SIZE raw 64-bit draws at a time, split into the 32-bit values the generator would
+# return (lower half first). RandomGenerator.randint(0, n) (and therefore choice over n options)
+# is masked rejection sampling on these 32-bit values, which randint below reproduces exactly.
+BLOCK_SIZE = 16
+
+# First block of the streams seeded 0, 1, ..., shared by all universes since agent streams only
+# depend on the agent index. Only the first CACHED_STREAMS streams are kept (2 MB), which covers
+# the universes of the sweeps; the blocks of larger universes are drawn again for each of them, so
+# they are freed with the universe.
+CACHED_STREAMS = 1 << 14
+_first_blocks = np.empty((0, 2*BLOCK_SIZE), dtype=np.uint32)
+
+
+# Splits raw 64-bit draws into 32-bit values, lower half first
+def split(raw):
+    return np.stack([raw & np.uint64(0xFFFFFFFF), raw >> np.uint64(32)], axis=-1).reshape(-1).astype(np.uint32)
+
+
+# Returns the block of 32-bit values of stream <seed> that starts after <drawn> raw draws
+def draw_block(seed, drawn):
+    generator = PCG64(seed, 0)
+    if drawn:
+        generator.advance(drawn)
+    return split(generator.random_raw(BLOCK_SIZE))
+
+
+# Returns the first blocks of the streams seeded 0 to num_streams-1
+def first_blocks(num_streams):
+    global _first_blocks
+    cached = min(num_streams, CACHED_STREAMS)
+    if len(_first_blocks) < cached:
+        missing = [draw_block(seed, 0) for seed in range(len(_first_blocks), cached)]
+        _first_blocks = np.concatenate([_first_blocks, np.array(missing, dtype=np.uint32)])
+    if num_streams <= len(_first_blocks):
+        return _first_blocks[:num_streams]
+    missing = [draw_block(seed, 0) for seed in range(len(_first_blocks), num_streams)]
+    return np.concatenate([_first_blocks, np.array(missing, dtype=np.uint32).reshape(-1, 2*BLOCK_SIZE)])
+
+
+# Returns the mask used to draw an integer in [0, high]
+def bit_mask(high):
+    return (1 << high.bit_length()) - 1
+
+
+# A single stream, for an Agent. The first block is only read on the first draw.
+class RandomStream:
+    __slots__ = ("seed", "values", "pos", "drawn")
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.values = None
+        self.pos = 0
+        self.drawn = 0
+
+    # Same as PCG64(seed, 0).generator.randint(0, n)
+    def randint(self, n):
+        high = n - 1
+        if high == 0:
+            return 0
+        mask = bit_mask(high)
+        while True:
+            if self.values is None or self.pos == 2*BLOCK_SIZE:
+                cached = self.drawn == 0 and self.seed < len(_first_blocks)
+                self.values = (_first_blocks[self.seed] if cached else draw_block(self.seed, self.drawn)).tolist()
+                self.pos = 0
+                self.drawn += BLOCK_SIZE
+            value = self.values[self.pos] & mask
+            self.pos += 1
+            if value <= high:
+                return value
+
+    # Same as PCG64(seed, 0).generator.choice(options), returning the option itself
+    def choice(self, options):
+        return options[self.randint(len(options))]
+
+
+# The streams of all the agents of a universe (or, with a batch size, of a batch of universes) as
+# struct-of-arrays, so they can also be read by the compiled kernel and by UniverseBatch. The
+# stream of agent i is seeded with i.
+# - values: the current block of each stream
+# - pos: position of the next value in the block
+# - drawn: number of raw draws taken from each stream so far
+class AgentStreams:
+    def __init__(self, num_agents, batch_size=None):
+        shape = (num_agents,) if batch_size is None else (batch_size, num_agents)
+        self.values = np.broadcast_to(first_blocks(num_agents), shape + (2*BLOCK_SIZE,)).copy()
+        self.pos = np.zeros(shape, dtype=np.int64)
+        self.drawn = np.full(shape, BLOCK_SIZE, dtype=np.int64)
+
+    # Streams held in existing arrays (such as shared memory), which are read and updated in place
+    @classmethod
+    def from_arrays(cls, values, pos, drawn):
+        streams = cls.__new__(cls)
+        streams.values, streams.pos, streams.drawn = values, pos, drawn
+        return streams
+
+    # Replaces the block of stream <index> (an agent index, or a (member, agent index) pair) by the
+    # next one
+    def refill(self, index):
+        seed = index[-1] if isinstance(index, tuple) else index
+        self.values[index] = draw_block(seed, int(self.drawn[index]))
+        self.pos[index] = 0
+        self.drawn[index] += BLOCK_SIZE
+
+    # Same as RandomStream.randint, for stream <index>
+    def randint(self, index, n):
+        high = n - 1
+        if high == 0:
+            return 0
+        mask = bit_mask(high)
+        while True:
+            pos = int(self.pos[index])
+            if pos == 2*BLOCK_SIZE:
+                self.refill(index)
+                pos = 0
+            self.pos[index] = pos + 1
+            value = int(self.values[index][pos]) & mask
+            if value <= high:
+                return value
+
+    # Same as randint(indices[j], n[j]) for every j at once, or randint((rows[j], indices[j]), n[j])
+    # for the streams of a batch. The streams must be distinct.
+    def draw(self, indices, n, rows=None):
+        choice = np.zeros(len(indices), dtype=np.int64)
+        high = (n - 1).astype(np.uint32)
+        mask = high.copy()
+        for shift in (1, 2, 4, 8, 16):
+            mask |= mask >> np.uint32(shift)
+
+        pending = np.flatnonzero(n > 1)
+        while len(pending):
+            index = (indices[pending],) if rows is None else (rows[pending], indices[pending])
+            for j in np.flatnonzero(self.pos[index] == 2*BLOCK_SIZE).tolist():
+                self.refill(tuple(int(i[j]) for i in index))
+            pos = self.pos[index]
+            self.pos[index] = pos + 1
+            value = self.values[index + (pos,)] & mask[pending]
+            accepted = value <= high[pending]
+            choice[pending[accepted]] = value[accepted]
+            pending = pending[~accepted]
+        return choice
+
+    # Returns, for every j, the column of one of the highest scores of scores[j], drawn from
+    # stream indices[j] (or (rows[j], indices[j])) like ArrayUniverse.choose_move does
+    def choose_best(self, indices, scores, rows=None):
+        is_best = scores == scores.max(axis=1)[:, None]
+        choice = self.draw(indices, is_best.sum(axis=1), rows)
+        return np.argmax(is_best & (np.cumsum(is_best, axis=1) == choice[:, None] + 1), axis=1)
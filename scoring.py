@@ -0,0 +1,141 @@
+import numpy as np
+
+# Agents move one cell per turn. The order matters: ties are broken by drawing an index into
+# the list of best moves, so it must match Agent._find_best_move exactly.
+MOVES = [(0, 0), (-1, 0), (-1, 1), (-1, -1), (0, 1), (0, -1), (1, -1), (1, 1)]
+MOVE_X = np.array([move[0] for move in MOVES])
+MOVE_Y = np.array([move[1] for move in MOVES])
+
+# Distance from each move cell back to the agent's own cell
+SELF_DISTANCE = np.maximum(np.abs(MOVE_X), np.abs(MOVE_Y))
+
+# Type of the score fields. A sum covers at most (2r+1)^2 cells, each adding a resource amount or
+# a distance of at most 2r+1, so 32-bit integers hold them and halve the memory of the fields.
+FIELD_DTYPE = np.int32
+
+
+# Returns the stack of kernels used to build the score fields for a field of vision of radius r.
+# Channel 0 counts the cells in the window, channel 1 + m holds the Chebyshev distance
+# ("Manhattan distance with sloped movement") from each cell of the window to the cell the agent
+# reaches with MOVES[m].
+def move_kernels(r):
+    offsets = np.arange(-r, r+1)
+    kernels = np.ones((1 + len(MOVES), 2*r + 1, 2*r + 1), dtype=FIELD_DTYPE)
+    for m, (move_x, move_y) in enumerate(MOVES):
+        kernels[1 + m] = np.maximum(np.abs(offsets - move_x)[:, None], np.abs(offsets - move_y)[None, :])
+    return kernels
+
+
+# Running sums from which the score of every move of every agent can be read in O(1).
+#
+# Agent.find_best_move scores a move cell by summing, over every agent and resource in the
+# window, a term that only depends on the occupant and on its distance to that cell. The sums
+# are therefore correlations of the occupancy grids with the kernels of move_kernels(r):
+# - agents[0]: number of agents in the window around a cell
+# - agents[1 + m]: sum of the distances from those agents to the cell reached with MOVES[m]
+# - resources[0]: sum of the resource amounts in the window
+# - resources[1 + m]: sum of the distances from those resources to the cell reached with MOVES[m]
+# Every move, fight, pickup and death changes one cell, and the sums are patched by adding a
+# kernel-sized slice instead of being recomputed. All values are integers, so scores are exact.
+#
+# The grids must be padded with a halo at least r wide so kernel slices never leave the array.
+class ScoreFields:
+    def __init__(self, kind, amount, fov_radius, agent_cell, resource_cell, barrier_cell):
+        self.r = fov_radius
+        self.kernels = move_kernels(fov_radius)
+        self.flipped = self.kernels[:, ::-1, ::-1].copy()
+        self.barrier = kind == barrier_cell
+
+        is_agent = (kind == agent_cell).astype(FIELD_DTYPE)
+        is_resource = (kind == resource_cell).astype(FIELD_DTYPE)
+        resource_amount = np.where(kind == resource_cell, amount, 0).astype(FIELD_DTYPE)
+        self.agents = correlate(is_agent, self.kernels, fov_radius)
+        self.resources = correlate(is_resource, self.kernels, fov_radius)
+        self.resources[0] = correlate(resource_amount, self.kernels[:1], fov_radius)[0]
+
+    # Record that an agent arrived at (delta=1) or left (delta=-1) cell (x, y)
+    def add_agent(self, x, y, delta):
+        r = self.r
+        self.agents[:, x-r:x+r+1, y-r:y+r+1] += delta*self.flipped
+
+    # Record that a resource of the given amount appeared at (delta=1) or was consumed
+    # (delta=-1) at cell (x, y)
+    def add_resource(self, x, y, amount, delta):
+        r = self.r
+        window = self.resources[:, x-r:x+r+1, y-r:y+r+1]
+        window[0] += delta*amount
+        window[1:] += delta*self.flipped[1:]
+
+    # Returns the scores of the moves in MOVES for an agent at (x, y) with the given strategy
+    def scores(self, x, y, strategy):
+        resources = self.resources[:, x, y]
+        scores = (resources[0] - resources[1:]).astype(np.float64)
+
+        # More aggressive agents will score movement toward agents higher than more defensive agents.
+        # The agent itself is part of the sums and is taken back out.
+        if strategy != 0:
+            agents = self.agents[:, x, y]
+            distances = agents[1:] - SELF_DISTANCE
+            scores += strategy*(agents[0] - 1) + (distances if strategy < 0 else -distances)
+
+        scores[self.barrier[x + MOVE_X, y + MOVE_Y]] = -np.inf
+        return scores
+
+    # Returns a (len(xs), len(MOVES)) array holding the scores of every move for every agent at
+    # once, given their positions and strategies. When the fields of a batch of grids are stacked
+    # along a leading dimension (see batch.py), rows[j] is the grid of agent j.
+    def batch_scores(self, xs, ys, strategies, rows=None):
+        if rows is None:
+            resources, agents = self.resources[:, xs, ys].T, self.agents[:, xs, ys].T
+        else:
+            resources, agents = self.resources[rows, :, xs, ys], self.agents[rows, :, xs, ys]
+        blocked = self.barrier[xs[:, None] + MOVE_X, ys[:, None] + MOVE_Y]
+        return self.sum_scores(resources, agents, strategies, blocked)
+
+    # Returns the scores of the moves of agents with the given strategies from the sums of the
+    # fields at their cells, resources[j] and agents[j] (one column per channel). blocked[j, m] is
+    # True if MOVES[m] of agent j leads into a barrier.
+    @staticmethod
+    def sum_scores(resources, agents, strategies, blocked):
+        scores = (resources[:, :1] - resources[:, 1:]).astype(np.float64)
+
+        # More aggressive agents will score movement toward agents higher than more defensive agents.
+        # The agent itself is part of the sums and is taken back out.
+        distances = agents[:, 1:] - SELF_DISTANCE
+        sign = np.where(strategies < 0, 1, -1)[:, None]
+        agent_scores = strategies[:, None]*(agents[:, :1] - 1) + sign*distances
+        scores += np.where(strategies[:, None] != 0, agent_scores, 0)
+
+        scores[blocked] = -np.inf
+        return scores
+
+
+# Returns the same scores as ScoreFields.batch_scores for agents at (xs, ys) with the given
+# strategies, from the same sums computed from the kind and amount grids directly by gathering each
+# agent's window rather than kept as running sums. It costs (2r+1)^2 per agent and needs no state, so it suits grids
+# that change everywhere at once, or that are too large for a score field per kernel.
+def window_scores(kind, amount, xs, ys, strategies, r, agent_cell, resource_cell, barrier_cell):
+    kernels = move_kernels(r).reshape(1 + len(MOVES), -1).T.astype(np.float64)
+    offsets = np.arange(-r, r+1)
+    window_x, window_y = (xs[:, None] + offsets)[:, :, None], (ys[:, None] + offsets)[:, None, :]
+    window = kind[window_x, window_y].reshape(len(xs), kernels.shape[0])
+    is_resource = window == resource_cell
+
+    # The values are small integers, so the float sums are exact
+    resources = is_resource.astype(np.float64) @ kernels
+    resources[:, 0] = np.where(is_resource, amount[window_x, window_y].reshape(len(xs), kernels.shape[0]), 0).sum(axis=1)
+    agents = (window == agent_cell).astype(np.float64) @ kernels
+    return ScoreFields.sum_scores(resources, agents, strategies,
+                                  kind[xs[:, None] + MOVE_X, ys[:, None] + MOVE_Y] == barrier_cell)
+
+
+# Correlates <grid> with every kernel of the stack: out[k, c] = sum over o of grid[c + o]*kernels[k, o].
+# Only cells at least r away from the border are computed, the rest are left at zero.
+def correlate(grid, kernels, r):
+    out = np.zeros((len(kernels),) + grid.shape, dtype=FIELD_DTYPE)
+    height, width = grid.shape
+    inner = out[:, r:height-r, r:width-r]
+    for i in range(2*r + 1):
+        for j in range(2*r + 1):
+            inner += kernels[:, i, j, None, None]*grid[i:i+height-2*r, j:j+width-2*r]
+    return out
@@ -0,0 +1,312 @@
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from array_universe import AgentHandle, EMPTY_CELL, BARRIER_CELL, AGENT_CELL, RESOURCE_CELL
+from rng import AgentStreams, BLOCK_SIZE
+from scoring import MOVE_X, MOVE_Y, window_scores
+from initialization import initial_state
+
+# Single runs on grids too large for one core, split into horizontal shards that are updated by
+# worker processes.
+#
+# In Universe, every agent sees the moves of the agents that moved before it in the shuffled
+# order, so a tick cannot be split between processes. ShardedUniverse uses another update rule
+# instead, the parallel-synchronous rule, in which the outcome of a tick does not depend on any
+# order:
+# 1. Metabolism: every agent loses its metabolic rate, and the agents left with no resources die
+#    and leave their cells.
+# 2. Moves: every agent still alive scores its moves on the grid left by step 1, like
+#    Agent.find_best_move, and breaks ties with its own random stream (as in Universe). All agents
+#    choose from the same grid.
+# 3. Conflicts: the contenders for a cell are the agents moving into it, and its occupant if it
+#    does not move. The contender with the most resources takes the cell, the resources of the
+#    other contenders (who die) and the resource in the cell. Ties go to the occupant, then to the
+#    agent with the lowest id. Agents that swap cells pass each other. The grid of the next tick
+#    is written to a second buffer, which becomes the current grid at the end of the tick.
+# The agents that died in a tick are reported to the statistics in the order of their ids, those
+# that starved first. The shuffle stream is not used.
+#
+# The environment is split into shards of consecutive rows. A shard owns the agents in its rows
+# and the cells of its rows. Steps 1 and 3 only write to the cells and agents of a shard (every
+# agent contends for exactly one cell, so the agents that move into a shard from the rows next to
+# it are updated by that shard alone), and step 2 reads the rows of the neighbouring shards, up to
+# a field of vision away, only after every shard has finished step 1. ArrayUniverse(...,
+# update_rule="synchronous") runs the same steps on a single shard. The processes wait for every
+# shard to finish a step before the next one starts, and the arrays are shared between them
+# through shared memory. Since no step depends on the order the agents are processed in, a run
+# only depends on its seed: it is the same for any number of shards and of worker processes.
+#
+# The universe starts in the same state as Universe (and ArrayUniverse) with the same seed, but
+# the initial draws are always taken in bulk (see initialization.py).
+
+# Arrays shared with the workers, with their types. The grids have two buffers, the current one and
+# the one of the next tick.
+GRIDS = ["kind", "occupant", "amount"]
+SHARED = {
+    "kind": np.int8,            # Cell kinds, padded with a barrier halo as wide as the field of vision
+    "occupant": np.int32,       # Index of the agent in each cell, or -1
+    "amount": np.int32,         # Resource amount of each cell
+    "agent_resources": np.int64,
+    "metabolic_rate": np.int64,
+    "strategy": np.int64,
+    "position": np.int64,       # (x, y) in padded coordinates
+    "target": np.int64,         # Cell every agent moves to in step 2, (-1, -1) for agents not moving this tick
+    "alive": np.bool_,
+    "rng_values": np.uint32,    # AgentStreams arrays
+    "rng_pos": np.int64,
+    "rng_drawn": np.int64,
+}
+
+
+# Returns the shape of shared array <name> for a padded grid of size x size cells
+def shared_shape(name, size, num_agents):
+    if name in GRIDS:
+        return (2, size, size)
+    if name in ("position", "target"):
+        return (num_agents, 2)
+    if name == "rng_values":
+        return (num_agents, 2*BLOCK_SIZE)
+    return (num_agents,)
+
+
+# Arrays of the worker process, views into the shared memory
+_arrays = None
+_memory = None
+
+
+def attach(specs):
+    global _arrays, _memory
+    _memory = [shared_memory.SharedMemory(name=name) for name, dtype, shape in specs.values()]
+    _arrays = {key: np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+               for (key, (name, dtype, shape)), memory in zip(specs.items(), _memory)}
+
+
+# Returns the agents of the shard of rows [start, stop) that are alive
+def owned(arrays, start, stop):
+    x = arrays["position"][:, 0]
+    return np.flatnonzero(arrays["alive"] & (x >= start) & (x < stop))
+
+
+# Step 1, for the shard of rows [start, stop) of grid buffer <current>. Returns the agents that
+# starved.
+def metabolism(arrays, current, start, stop):
+    agents = owned(arrays, start, stop)
+    resources = arrays["agent_resources"]
+    resources[agents] -= arrays["metabolic_rate"][agents]
+    starved = agents[resources[agents] <= 0]
+    arrays["alive"][starved] = False
+    x, y = arrays["position"][starved].T
+    arrays["kind"][current, x, y] = EMPTY_CELL
+    arrays["occupant"][current, x, y] = -1
+    return starved
+
+
+# Step 2, for the shard of rows [start, stop) of grid buffer <current>
+def choose_moves(arrays, current, start, stop, r):
+    agents = owned(arrays, start, stop)
+    x, y = arrays["position"][agents].T
+    scores = window_scores(arrays["kind"][current], arrays["amount"][current], x, y, arrays["strategy"][agents], r,
+                           AGENT_CELL, RESOURCE_CELL, BARRIER_CELL)
+
+    # Pick among the best moves, in the order of MOVES, with each agent's own stream
+    streams = AgentStreams.from_arrays(arrays["rng_values"], arrays["rng_pos"], arrays["rng_drawn"])
+    moves = streams.choose_best(agents, scores)
+    arrays["target"][agents] = np.stack([x + MOVE_X[moves], y + MOVE_Y[moves]], axis=1)
+
+
+# Step 3, for the cells of rows [start, stop): reads grid buffer <current> and writes these rows of
+# the other buffer. Returns the agents that lost a fight and the number of resources collected.
+def resolve_conflicts(arrays, current, start, stop):
+    kind, occupant, amount = (arrays[name][current] for name in GRIDS)
+    next_kind, next_occupant, next_amount = (arrays[name][1 - current] for name in GRIDS)
+    target = arrays["target"]
+    contenders = np.flatnonzero((target[:, 0] >= start) & (target[:, 0] < stop))
+    x, y = target[contenders].T
+    defending = occupant[x, y] == contenders
+    resources = arrays["agent_resources"][contenders]
+
+    # The first contender of every cell, by most resources, then occupant first, then lowest id,
+    # takes the cell
+    cells = x*kind.shape[1] + y
+    order = np.lexsort((contenders, ~defending, -resources, cells))
+    contenders, x, y, resources = contenders[order], x[order], y[order], resources[order]
+    first = np.flatnonzero(np.diff(cells[order], prepend=-1))
+    winners, x, y = contenders[first], x[first], y[first]
+    is_winner = np.zeros(len(contenders), dtype=bool)
+    is_winner[first] = True
+    losers = contenders[~is_winner]
+    collected = kind[x, y] == RESOURCE_CELL
+
+    # Every agent of the shard leaves its cell, unless it wins the cell it stays in
+    rows = slice(start, stop)
+    next_kind[rows] = np.where(kind[rows] == AGENT_CELL, EMPTY_CELL, kind[rows])
+    next_occupant[rows] = -1
+    next_amount[rows] = amount[rows]
+
+    arrays["agent_resources"][winners] = np.add.reduceat(resources, first) + amount[x, y]
+    arrays["alive"][losers] = False
+    arrays["position"][winners] = np.stack([x, y], axis=1)
+    next_kind[x, y] = AGENT_CELL
+    next_occupant[x, y] = winners
+    next_amount[x, y] = 0
+    return losers, int(collected.sum())
+
+
+# Runs <step> of the parallel-synchronous rule for one shard of <arrays> (those of the worker
+# process by default)
+def run_step(step, current, start, stop, r, arrays=None):
+    arrays = _arrays if arrays is None else arrays
+    if step == "metabolism":
+        return metabolism(arrays, current, start, stop)
+    if step == "choose_moves":
+        return choose_moves(arrays, current, start, stop, r)
+    return resolve_conflicts(arrays, current, start, stop)
+
+
+# Runs a tick of the parallel-synchronous rule on <arrays> (with the shared array names), with the
+# steps of the shards of rows [bounds[k], bounds[k+1]) run by <executor> if given. Returns the
+# agents that died, in the order they are reported, and the number of resources collected. The
+# next grid is in buffer 1 - current.
+def synchronous_tick(arrays, current, bounds, r, executor=None):
+    shards = list(zip(bounds[:-1], bounds[1:]))
+
+    def run(step):
+        if executor is None:
+            return [run_step(step, current, start, stop, r, arrays) for start, stop in shards]
+        jobs = [executor.submit(run_step, step, current, start, stop, r) for start, stop in shards]
+        return [job.result() for job in jobs]
+
+    starved = np.sort(np.concatenate(run("metabolism")))
+    run("choose_moves")
+    results = run("resolve_conflicts")
+    arrays["target"][:] = -1
+    losers = np.sort(np.concatenate([result[0] for result in results]))
+    return starved.tolist() + losers.tolist(), sum(result[1] for result in results)
+
+
+# Unlinks the shared memory segments <memory>. Views into them may still be alive (when the
+# universe is garbage collected or the process exits without close()), in which case the segments
+# of this process are only unmapped with the views, but they are removed from /dev/shm anyway.
+def release(memory):
+    for segment in memory:
+        try:
+            segment.close()
+        except BufferError:
+            pass
+        segment.unlink()
+    memory.clear()
+
+
+# Universe updated with the parallel-synchronous rule, split into <shards> shards of rows that are
+# updated by <workers> worker processes (in this process with workers=1). It has the interface of
+# ArrayUniverse (agents, is_finished, update) and its agents are AgentHandles, so Statistics and
+# StreamingStatistics work unchanged. close() releases the workers and the shared memory; it is
+# called at the end of a with block, and the shared memory is also released if the universe is
+# garbage collected, the process exits or the constructor fails before close() is called.
+class ShardedUniverse:
+    def __init__(self, num_agents, env_size, resource_prob, metabolic_rate=1, field_of_vision=1,
+                 seed=1234567, shards=1, workers=1):
+        self.timestep = 0
+        self.env_size = env_size
+        self.halo = field_of_vision
+        size = env_size + 2*self.halo
+
+        self.memory = []
+        self.finalizer = weakref.finalize(self, release, self.memory)
+        specs = dict()
+        self.arrays = dict()
+        for name, dtype in SHARED.items():
+            shape = shared_shape(name, size, num_agents)
+            memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*np.dtype(dtype).itemsize, 1))
+            self.memory.append(memory)
+            specs[name] = (memory.name, dtype, shape)
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        for name, array in self.arrays.items():
+            setattr(self, name, array)
+
+        positions, strategies, resources = initial_state(num_agents, env_size, resource_prob, seed)
+        inner = slice(self.halo, self.halo + env_size)
+        self.kind[:] = BARRIER_CELL
+        self.kind[:, inner, inner] = np.where(resources, RESOURCE_CELL, EMPTY_CELL)
+        self.amount[:] = 0
+        self.amount[:, inner, inner] = np.where(resources, 10, 0)
+        self.occupant[:] = -1
+        self.position[:] = positions + self.halo
+        self.kind[:, self.position[:, 0], self.position[:, 1]] = AGENT_CELL
+        self.occupant[:, self.position[:, 0], self.position[:, 1]] = np.arange(num_agents)
+        self.set_current(0)
+        self.num_resources = int(resources.sum())
+        self.agent_resources[:] = 10
+        self.metabolic_rate[:] = metabolic_rate
+        self.strategy[:] = strategies
+        self.target[:] = -1
+        self.alive[:] = True
+        streams = AgentStreams(num_agents)
+        self.rng_values[:], self.rng_pos[:], self.rng_drawn[:] = streams.values, streams.pos, streams.drawn
+
+        self.fov = np.full(num_agents, field_of_vision, dtype=np.int64)
+        self.time_alive = np.zeros(num_agents, dtype=np.int64)
+        self.order = np.arange(num_agents, dtype=np.int64)
+        self.handles = [AgentHandle(self, i) for i in range(num_agents)]
+
+        # Rows [bounds[k], bounds[k+1]) of the padded grid belong to shard k
+        self.bounds = (self.halo + np.linspace(0, env_size, shards + 1).astype(np.int64)).tolist()
+        self.executor = None
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=attach, initargs=(specs,))
+
+    # Agents still in the simulation
+    @property
+    def agents(self):
+        return [self.handles[i] for i in self.order.tolist()]
+
+    def is_finished(self):
+        return len(self.order) == 1
+
+    # Makes grid buffer <current> the current grid (self.kind, self.occupant and self.amount)
+    def set_current(self, current):
+        self.current = current
+        for name in GRIDS:
+            setattr(self, name, self.arrays[name][current])
+
+    # Updates the agents and resources in the environment with the parallel-synchronous rule
+    def update(self, stats):
+        if self.timestep == 0:
+            stats.set_agents(self.handles)
+        self.timestep += 1
+
+        dead, collected = synchronous_tick(self.arrays, self.current, self.bounds, self.halo, self.executor)
+        self.set_current(1 - self.current)
+        self.num_resources -= collected
+        stats.update(False, self.timestep, [self.handles[i] for i in dead])
+
+        # Remove eliminated agents. If one agent is left, stop removing, remaining agent is the winner
+        removed = []
+        for index in dead:
+            self.time_alive[index] = self.timestep
+            removed.append(index)
+            if len(self.order) - len(removed) == 1:
+                break
+        if removed:
+            self.order = self.order[~np.isin(self.order, removed)]
+
+        if self.is_finished():
+            self.time_alive[self.order] = self.timestep + 1  # Record the winning agents time alive
+            stats.update(True, self.timestep+1, [])
+
+    # Stops the worker processes and releases the shared memory
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.arrays = None
+        for name in SHARED:
+            setattr(self, name, None)
+        self.finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
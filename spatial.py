@@ -0,0 +1,53 @@
+# Index of the positions of objects (agents or resources) in the environment, so the objects in
+# an agent's field of vision can be found without scanning every cell of it.
+#
+# The environment is divided into square buckets of bucket_size cells, each holding a dict that
+# maps the objects in it to their location. A query only reads the buckets that overlap the
+# window, so with buckets about as wide as the window its cost is proportional to the number of
+# objects near the agent rather than to the number of cells in its field of vision. The index is
+# updated one object at a time when objects are placed, moved or removed.
+class SpatialIndex:
+    # - size: number of rows (and columns) of the environment, including its barrier halo
+    # - bucket_size: number of rows (and columns) of cells in a bucket
+    def __init__(self, size, bucket_size):
+        self.bucket_size = bucket_size
+        num_buckets = (size + bucket_size - 1)//bucket_size
+        self.buckets = [[dict() for j in range(num_buckets)] for i in range(num_buckets)]
+
+    def bucket(self, x, y):
+        return self.buckets[x//self.bucket_size][y//self.bucket_size]
+
+    def add(self, obj, x, y):
+        self.bucket(x, y)[obj] = (x, y)
+
+    def remove(self, obj, x, y):
+        del self.bucket(x, y)[obj]
+
+    def move(self, obj, old_x, old_y, new_x, new_y):
+        old_bucket = self.bucket(old_x, old_y)
+        new_bucket = self.bucket(new_x, new_y)
+        if old_bucket is not new_bucket:
+            del old_bucket[obj]
+        new_bucket[obj] = (new_x, new_y)
+
+    # Returns the number of objects in the buckets that overlap the window of radius <r> centered on
+    # (x, y), which is what a query on that window costs
+    def count(self, x, y, r):
+        size = self.bucket_size
+        return sum(len(bucket) for row in self.buckets[(x-r)//size:(x+r)//size + 1]
+                   for bucket in row[(y-r)//size:(y+r)//size + 1])
+
+    # Returns a list of ((i, j), obj) for every object in the window of radius <r> centered on
+    # (x, y), where (i, j) is the location of the object in the window (as in the view returned by
+    # Universe.find_restricted_env)
+    def query(self, x, y, r):
+        size = self.bucket_size
+        found = []
+        for row in self.buckets[(x-r)//size:(x+r)//size + 1]:
+            for bucket in row[(y-r)//size:(y+r)//size + 1]:
+                for obj, (obj_x, obj_y) in bucket.items():
+                    i = obj_x - x + r
+                    j = obj_y - y + r
+                    if 0 <= i <= 2*r and 0 <= j <= 2*r:
+                        found.append(((i, j), obj))
+        return found
@@ -1,11 +1,8 @@
-import copy
-
-
 class Statistics:
     def __init__(self):
         self.final = False  # True if the simulation has completed
 
-        self.living_agents = list()     # Living agents in the simulation
+        self.living_agents = dict()     # Living agents in the simulation (a dict used as an ordered set)
         self.dead_agents = list()       # Agents who have died in the simulation
         self.aggressive_agents = list() # All aggressive agents that participated in the simulation
         self.defensive_agents = list()  # All defensive agents that participated in the simulation
@@ -21,13 +18,13 @@ class Statistics:
             self.compute_statistics()
             return
         for dead_agent in dead_agents:
-            self.living_agents.remove(dead_agent)
+            del self.living_agents[dead_agent]
             self.dead_agents.append(dead_agent)
             if len(self.living_agents) == 1:
                 break
     
     def set_agents(self, agents):
-        self.living_agents = copy.copy(agents)
+        self.living_agents = dict.fromkeys(agents)
         for agent in self.living_agents:
             if agent.strategy < 0:
                 self.defensive_agents.append(agent)
@@ -71,3 +68,147 @@ class Statistics:
         print("Avg Neutral Agent Lifespan:", self.avg_lifespans[1])
         print("Avg Aggressive Agent Lifespan:", self.avg_lifespans[2])
         print("--------------------------------")
+
+
+# Strategies range from -10 to 10, aggregates are kept for each of them
+NUM_STRATEGIES = 21
+
+
+# Returns the strategy class of a strategy, the index of the class in avg_lifespans: 0 for
+# defensive, 1 for neutral and 2 for aggressive
+def strategy_class(strategy):
+    return 0 if strategy < 0 else 2 if strategy > 0 else 1
+
+
+# Same statistics as Statistics, computed from running aggregates instead of lists of agents: each
+# death is folded into the aggregates of the agent's strategy when it is reported, and no agent is
+# referenced afterwards, so the memory used only depends on the number of strategies and on the
+# number of lifespan buckets. The winners are the agents still counted as living when the
+# simulation ends.
+#
+# Aggregates per strategy (indexed by strategy + 10):
+# - counts: number of agents
+# - living, living_metabolic_rate: number of living agents and sum of their metabolic rates
+# - lifespan_sums: sum of lifespans
+# - lifespan_histogram: number of agents whose lifespan is in each bucket of bucket_width ticks
+# and, over the runs, win_counts: number of runs won by each (average) strategy, like the histograms
+# of collect_stats.
+#
+# Statistics of separate runs (for example from different worker processes) are combined with
+# merge, which adds up the aggregates.
+class StreamingStatistics:
+    def __init__(self, bucket_width=10):
+        self.final = False  # True if the simulation has completed
+        self.bucket_width = bucket_width
+
+        self.num_living = 0
+        self.counts = [0 for s in range(NUM_STRATEGIES)]
+        self.living = [0 for s in range(NUM_STRATEGIES)]
+        self.living_metabolic_rate = [0 for s in range(NUM_STRATEGIES)]
+        self.lifespan_sums = [0 for s in range(NUM_STRATEGIES)]
+        self.lifespan_histogram = [[] for s in range(NUM_STRATEGIES)]
+
+        self.runs = 0
+        self.winners = 0
+        self.win_strategy_sum = 0
+        self.win_metabolic_rate_sum = 0
+        self.win_counts = [0 for s in range(NUM_STRATEGIES)]
+
+        self.avg_win_strategy = 0
+        self.avg_win_metabolic_rate = 0
+        self.avg_lifespans = [0, 0, 0]   # Average defensive, neutral, and aggressive lifespans
+
+    def update(self, final, time, dead_agents):
+        self.final = final
+        if final:
+            self.add_winners(time)
+            self.compute_statistics()
+            return
+        for dead_agent in dead_agents:
+            s = dead_agent.strategy + 10
+            self.living[s] -= 1
+            self.living_metabolic_rate[s] -= dead_agent.metabolic_rate
+            self.num_living -= 1
+            self.add_lifespans(s, time, 1)
+            if self.num_living == 1:
+                break
+
+    def set_agents(self, agents):
+        for agent in agents:
+            s = agent.strategy + 10
+            self.counts[s] += 1
+            self.living[s] += 1
+            self.living_metabolic_rate[s] += agent.metabolic_rate
+            self.num_living += 1
+
+    def add_lifespans(self, s, lifespan, count):
+        self.lifespan_sums[s] += count*lifespan
+        histogram = self.lifespan_histogram[s]
+        bucket = lifespan//self.bucket_width
+        if bucket >= len(histogram):
+            histogram.extend(0 for i in range(bucket + 1 - len(histogram)))
+        histogram[bucket] += count
+
+    # Folds the agents still living at the end of the run, the winners, into the aggregates
+    def add_winners(self, time):
+        winners = sum(self.living)
+        win_strategy_sum = sum((s - 10)*self.living[s] for s in range(NUM_STRATEGIES))
+        for s in range(NUM_STRATEGIES):
+            if self.living[s]:
+                self.add_lifespans(s, time, self.living[s])
+        self.runs += 1
+        self.winners += winners
+        self.win_strategy_sum += win_strategy_sum
+        self.win_metabolic_rate_sum += sum(self.living_metabolic_rate)
+        self.win_counts[int(win_strategy_sum/winners) + 10] += 1
+
+    def compute_statistics(self):
+        if self.winners:
+            self.avg_win_strategy = self.win_strategy_sum/self.winners
+            self.avg_win_metabolic_rate = self.win_metabolic_rate_sum/self.winners
+        for c in range(3):
+            strategies = [s for s in range(NUM_STRATEGIES) if strategy_class(s - 10) == c]
+            count = sum(self.counts[s] for s in strategies)
+            if count > 0:
+                self.avg_lifespans[c] = sum(self.lifespan_sums[s] for s in strategies)/count
+
+    # Adds the aggregates of <other> (with the same bucket width) to these ones. The averages are
+    # then over the agents and winners of all the merged runs. The merged statistics are final when
+    # those of every merged run are; empty statistics (never given agents) do not count.
+    def merge(self, other):
+        empty = self.runs == 0 and not any(self.counts)
+        for s in range(NUM_STRATEGIES):
+            self.counts[s] += other.counts[s]
+            self.living[s] += other.living[s]
+            self.living_metabolic_rate[s] += other.living_metabolic_rate[s]
+            self.lifespan_sums[s] += other.lifespan_sums[s]
+            self.win_counts[s] += other.win_counts[s]
+            histogram = self.lifespan_histogram[s]
+            histogram.extend(0 for i in range(len(other.lifespan_histogram[s]) - len(histogram)))
+            for bucket, count in enumerate(other.lifespan_histogram[s]):
+                histogram[bucket] += count
+        self.num_living += other.num_living
+        self.runs += other.runs
+        self.winners += other.winners
+        self.win_strategy_sum += other.win_strategy_sum
+        self.win_metabolic_rate_sum += other.win_metabolic_rate_sum
+        self.final = other.final if empty else self.final and other.final
+        self.compute_statistics()
+        return self
+
+    # Returns the survival curve of the agents of the given strategies (all of them by default):
+    # the number of agents still alive at the start of each lifespan bucket, that is at ticks 0,
+    # bucket_width, 2*bucket_width, ...
+    def survival_curve(self, strategies=range(-10, 11)):
+        histograms = [self.lifespan_histogram[strategy + 10] for strategy in strategies]
+        deaths = [sum(histogram[bucket] for histogram in histograms if bucket < len(histogram))
+                  for bucket in range(max(len(histogram) for histogram in histograms))]
+        alive = sum(self.counts[strategy + 10] for strategy in strategies)
+        curve = []
+        for count in deaths:
+            curve.append(alive)
+            alive -= count
+        return curve
+
+    def print(self):
+        Statistics.print(self)
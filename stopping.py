@@ -0,0 +1,68 @@
+import numpy as np
+from statistics import strategy_class
+
+# Rules that end a run before a single agent is left, passed to Universe(..., stopping_rules=[...]).
+# After every update, the universe checks its rules in order and stops at the first one that fires,
+# recording its name in Universe.stop_reason ("last_agent" when a single agent is left). The agents
+# still living when a run stops are its winners.
+#
+# Rules only read the universe, so the same rules can be used for any number of runs.
+
+
+# Stops after a fixed number of ticks
+class MaxTicks:
+    name = "max_ticks"
+
+    def __init__(self, ticks):
+        self.ticks = ticks
+
+    def fired(self, universe):
+        return universe.timestep >= self.ticks
+
+
+# Stops when every living agent is in the same strategy class (defensive, neutral or aggressive),
+# so the class of the winner is already decided
+class OneStrategyClass:
+    name = "one_strategy_class"
+
+    def fired(self, universe):
+        return len(set(strategy_class(agent.strategy) for agent in universe.agents)) == 1
+
+
+# Stops when no resources are left and no agent can reach another one before one of them starves,
+# so no agent can gain resources anymore and the agents only starve one by one. An agent with r
+# resources and metabolic rate m moves ceil(r/m) - 1 more times, and every move brings two agents
+# at most one cell closer, so two agents that are further apart than the sum of their remaining
+# moves can never fight. Resources can reappear in a universe with regeneration, so the rule never
+# fires there.
+class Unreachable:
+    name = "unreachable"
+
+    def fired(self, universe):
+        if universe.resources or universe.resource_field is not None:
+            return False
+        positions = np.array([universe.agents_loc[agent] for agent in universe.agents])
+        moves = np.array([-(-agent.resources//agent.metabolic_rate) - 1 for agent in universe.agents])
+        distances = np.abs(positions[:, None, :] - positions[None, :, :]).max(axis=2)
+        reachable = distances <= moves[:, None] + moves[None, :]
+        np.fill_diagonal(reachable, False)
+        return not reachable.any()
+
+
+# Stops when no agent has died, fought or collected a resource for <patience> ticks
+class Stagnation:
+    name = "stagnation"
+
+    def __init__(self, patience):
+        self.patience = patience
+
+    def fired(self, universe):
+        return universe.timestep - universe.last_event >= self.patience
+
+
+# Returns the default rules: the "outcome decided" rules, with stagnation and an optional tick budget
+def default_rules(max_ticks=None, patience=100):
+    rules = [OneStrategyClass(), Unreachable(), Stagnation(patience)]
+    if max_ticks is not None:
+        rules.append(MaxTicks(max_ticks))
+    return rules
@@ -0,0 +1,152 @@
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from universe import Universe
+from move_cache import MoveCache, start_worker, worker_cache
+from statistics import StreamingStatistics
+from collect_stats import default_values
+from columnar import RunTable
+
+# The parameters a sweep can vary. Parameters missing from a configuration take their value from
+# collect_stats.default_values.
+PARAMETERS = ["num_agents", "env_size", "resource_prob", "metabolic_rate", "field_of_vision"]
+
+
+# Expands a sweep specification into the list of configurations it covers. The specification is
+# either a grid, a dictionary mapping parameters to lists of values whose full-factorial product is
+# taken, or a list of configurations. Every configuration is completed with the default values.
+def expand(spec, defaults=default_values):
+    for parameter in (spec if isinstance(spec, dict) else itertools.chain.from_iterable(spec)):
+        if parameter not in PARAMETERS:
+            raise ValueError("Unknown sweep parameter: " + str(parameter))
+
+    if isinstance(spec, dict):
+        names = list(spec)
+        configs = [dict(zip(names, values)) for values in itertools.product(*[spec[name] for name in names])]
+    else:
+        configs = spec
+    return [{parameter: config.get(parameter, defaults[parameter]) for parameter in PARAMETERS} for config in configs]
+
+
+# Runs a single simulation to completion (or until one of the stopping rules fires, see
+# stopping.py) and returns its result record. The initial draws are taken in bulk and the moves
+# are memoized in <move_cache> (or in the cache of the worker process, see
+# collect_stats.run_simulation), which gives the same run (see initialization.py and
+# move_cache.py).
+def simulate(config, seed, stopping_rules=(), move_cache=None):
+    if move_cache is None:
+        move_cache = worker_cache()
+    stats = StreamingStatistics()
+    universe = Universe(seed=seed, debug=False, stopping_rules=stopping_rules, fast_init=True,
+                        move_cache=move_cache, **config)
+    while not universe.is_finished():
+        universe.update(stats)
+    return {
+        "config": config,
+        "seed": seed,
+        "timesteps": universe.timestep,
+        "winner": universe.agents[0].get_id(),
+        "stop_reason": universe.stop_reason,
+        "avg_win_strategy": stats.avg_win_strategy,
+        "avg_win_metabolic_rate": stats.avg_win_metabolic_rate,
+        "avg_lifespans": stats.avg_lifespans,
+    }
+
+
+# Append-only store of run results, one JSON record per line.
+#
+# Each record is flushed as soon as it is added, so an interrupted sweep keeps every run that
+# finished. A partially written last line (from a crash in the middle of a write) is dropped when
+# the store is opened.
+class ResultStore:
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self.completed = set()
+
+        if os.path.exists(path):
+            with open(path, "rb+") as file:
+                content = file.read()
+                if content and not content.endswith(b"\n"):
+                    file.truncate(content.rfind(b"\n") + 1)
+            with open(path) as file:
+                for line in file:
+                    self._index(json.loads(line))
+        self.file = open(path, "a")
+
+    @staticmethod
+    def key(config, seed):
+        return json.dumps([[config[parameter] for parameter in PARAMETERS], seed])
+
+    def _index(self, record):
+        self.records.append(record)
+        self.completed.add(self.key(record["config"], record["seed"]))
+
+    def has(self, config, seed):
+        return self.key(config, seed) in self.completed
+
+    def add(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self._index(record)
+
+    def close(self):
+        self.file.close()
+
+    # Returns, for each of the given configurations, the number of times each strategy has won
+    # (the same histograms as collect_stats)
+    def win_counts(self, configs):
+        win_counts_list = {self.key(config, None): [0 for i in range(21)] for config in configs}
+        for record in self.records:
+            key = self.key(record["config"], None)
+            if key in win_counts_list:
+                win_counts_list[key][int(record["avg_win_strategy"])+10] += 1
+        return list(win_counts_list.values())
+
+
+# Runs every (configuration, seed) pair of the sweep that is not in the store yet and adds its
+# result to the store as soon as it finishes, and to <table> (a columnar.RunTable) if given. Without
+# a store, every pair is simulated. Returns the number of runs that were simulated.
+# The stopping rules are not part of the key of a run in the store, so a store should only hold runs
+# with the same rules.
+def run_sweep(spec, seeds, store, workers=1, table=None, stopping_rules=()):
+    jobs = [(config, seed) for config in expand(spec) for seed in seeds if store is None or not store.has(config, seed)]
+
+    def add(record):
+        if store is not None:
+            store.add(record)
+        if table is not None:
+            table.add(record)
+
+    if workers == 1:
+        move_cache = MoveCache()
+        for config, seed in jobs:
+            add(simulate(config, seed, stopping_rules, move_cache))
+        return len(jobs)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker) as executor:
+        for job in as_completed([executor.submit(simulate, config, seed, stopping_rules) for config, seed in jobs]):
+            add(job.result())
+    return len(jobs)
+
+
+# Usage: python sweep.py <spec.json> <results.jsonl> [N] [workers] [table]
+# Runs seeds 0 to N-1 (100 by default) for every configuration of the specification in spec.json.
+# Running the same command again after an interruption only simulates the runs that are missing.
+# If a table path is given, every run in the store is then written to it (see columnar.py).
+if __name__ == "__main__":
+    with open(sys.argv[1]) as spec_file:
+        spec = json.load(spec_file)
+    N = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+
+    store = ResultStore(sys.argv[2])
+    print("Simulated", run_sweep(spec, range(N), store, workers), "runs,", len(store.records), "runs completed")
+    store.close()
+    if len(sys.argv) > 5:
+        table = RunTable(sys.argv[5])
+        for record in store.records:
+            table.add(record)
+        table.close()
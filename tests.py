@@ -1,7 +1,33 @@
+import gc
+import json
+import math
+import os
+from multiprocessing import shared_memory
+import numpy as np
 from universe import Universe
+from array_universe import ArrayUniverse, AGENT_CELL, BARRIER_CELL, EMPTY_CELL, RESOURCE_CELL
+from scoring import FIELD_DTYPE, MOVES, window_scores
+from batch import UniverseBatch
+import rng
+from rng import AgentStreams, CACHED_STREAMS, RandomStream, draw_block, first_blocks
+from randomgen import PCG64
 from agent import Agent
 from util import print_environment
-from statistics import Statistics
+from statistics import Statistics, StreamingStatistics, strategy_class
+from collect_stats import ci_width, collect_runs, collect_stats, collect_stats_adaptive, default_path, default_values
+from columnar import PARQUET, RunTable, load_runs, win_counts
+from sweep import ResultStore, expand, run_sweep
+from benchmarks import bench_update, compare_results
+from checkpoint import load_checkpoint, read_checkpoint, save_checkpoint, GRID_AGENT, GRID_RESOURCE
+from trajectory import TrajectoryReader, TrajectoryRecorder
+from instrumentation import CallbackSink, CSVSink, MemorySink, PrintSink, FIELDS
+from regeneration import Constant, Diffusion, Logistic, ResourceField, Respawn
+from resource import Resource
+from move_cache import MoveCache, encode
+from shards import ShardedUniverse, initial_state, resolve_conflicts
+from compare_rules import compare_rules
+from stopping import MaxTicks, OneStrategyClass, Stagnation, Unreachable
+from sweep import simulate
 
 
 def test_single_agent():
@@ -41,6 +67,23 @@ def test_simulation_run():
         print_environment(universe)
 
 
+def test_find_restricted_env():
+    print("### test_find_restricted_env() ###")
+    universe = Universe(1, 5, 0.0, field_of_vision=2, debug=False)
+    agent = universe.agents[0]
+    # Move the agent to the top left corner of the environment
+    universe.environment[universe.agents_loc[agent]] = Universe.EMPTY_CELL
+    universe.agents_loc[agent] = (universe.halo, universe.halo)
+    universe.environment[universe.halo, universe.halo] = agent
+
+    restricted_env = universe.find_restricted_env(agent)
+    assert restricted_env.shape == (5, 5)
+    assert restricted_env.base is universe.environment  # A view, not a copy
+    assert restricted_env[2, 2] is agent
+    assert all(restricted_env[i, j] == Universe.BARRIER_CELL for i in range(5) for j in range(5) if i < 2 or j < 2)
+    assert agent.find_best_move(restricted_env) in ([0, 0], [0, 1], [1, 1])
+
+
 def test_find_best_move():
     print("### test_find_best_move() ###")
     agent = Agent(id=1, fov_radius=1, resources=10, metabolic_rate=1, strategy=0, seed=0)
@@ -59,8 +102,746 @@ def test_find_best_move():
     assert agent._find_best_move(scores) == [0, 0]
 
 
+# Run a universe to completion and return everything needed to compare two runs
+def run_to_completion(universe):
+    stats = Statistics()
+    while not universe.is_finished():
+        universe.update(stats)
+    lifespans = sorted((agent.get_id(), agent.time_alive) for agent in stats.dead_agents + list(stats.living_agents))
+    return (universe.timestep, [agent.get_id() for agent in universe.agents], lifespans,
+            stats.avg_win_strategy, stats.avg_lifespans)
+
+
+def test_spatial_index():
+    print("### test_spatial_index() ###")
+    # A sparse universe, where the indexes are searched, and a dense one, where windows are scanned
+    for args in [(30, 60, 0.02, 1, 6), (20, 10, 0.4, 1, 2)]:
+        universe = Universe(*args, seed=5)
+        stats = Statistics()
+        while not universe.is_finished() and universe.timestep < 20:
+            universe.update(stats)
+            # The objects found with the indexes are the ones in the environment
+            for agent in universe.agents:
+                x, y = universe.agents_loc[agent]
+                found = (universe.agent_index.query(x, y, agent.fov_radius),
+                         universe.resource_index.query(x, y, agent.fov_radius))
+                scanned = agent.scan_environment(universe.find_restricted_env(agent))
+                assert sorted(found[0], key=str) == sorted(scanned[0] + [((agent.fov_radius,)*2, agent)], key=str)
+                assert sorted(found[1], key=str) == sorted(scanned[1], key=str)
+                assert sorted(universe.find_visible(agent)[0], key=str) == sorted(scanned[0], key=str)
+
+
+def test_checkpoint(tmp_path="."):
+    print("### test_checkpoint() ###")
+    path = os.path.join(str(tmp_path), "test_checkpoint.bin")
+    for args, ticks in [((30, 20, 0.4), 0), ((30, 20, 0.4), 12), ((60, 20, 0.4, 1, 3), 25)]:
+        expected = run_to_completion(Universe(*args, seed=11))
+
+        universe = Universe(*args, seed=11)
+        stats = Statistics()
+        while universe.timestep < ticks:
+            universe.update(stats)
+        save_checkpoint(path, universe, stats)
+
+        header, arrays = read_checkpoint(path)
+        assert header["timestep"] == ticks
+        assert (arrays["grid"] == GRID_AGENT).sum() == len(universe.agents)
+        assert (arrays["grid"] == GRID_RESOURCE).sum() == len(universe.resources)
+
+        # Every run resumed from the checkpoint continues like the original one
+        for mmap in (True, False):
+            resumed, resumed_stats = load_checkpoint(path, mmap=mmap)
+            while not resumed.is_finished():
+                resumed.update(resumed_stats)
+            lifespans = sorted((agent.get_id(), agent.time_alive)
+                               for agent in resumed_stats.dead_agents + list(resumed_stats.living_agents))
+            assert (resumed.timestep, [agent.get_id() for agent in resumed.agents], lifespans,
+                    resumed_stats.avg_win_strategy, resumed_stats.avg_lifespans) == expected
+
+    # A resumed universe is set up like a new one, e.g. debug=True prints the counts of every update
+    resumed, resumed_stats = load_checkpoint(path, debug=True)
+    assert isinstance(resumed.sink, PrintSink) and isinstance(Universe(30, 20, 0.4, debug=True).sink, PrintSink)
+    os.remove(path)
+
+    # Streaming statistics do not keep the dead agents, so they cannot be checkpointed
+    universe, stats = Universe(30, 20, 0.4, seed=11), StreamingStatistics()
+    universe.update(stats)
+    try:
+        save_checkpoint(path, universe, stats)
+        assert False, "StreamingStatistics were checkpointed"
+    except TypeError:
+        pass
+    assert not os.path.exists(path)
+
+
+def test_trajectory(tmp_path="."):
+    print("### test_trajectory() ###")
+    path = os.path.join(str(tmp_path), "test_trajectory.traj")
+    recorder = TrajectoryRecorder(path, keyframe_interval=7)
+    sink = MemorySink()
+    universe = Universe(30, 20, 0.4, seed=4, sink=sink, recorder=recorder)
+    stats = Statistics()
+    states = []
+    while True:
+        states.append((sorted([agent.get_id(), x - universe.halo, y - universe.halo, agent.resources]
+                              for agent, (x, y) in universe.agents_loc.items()),
+                       sorted([x - universe.halo, y - universe.halo, universe.environment[x, y].get_amount()]
+                              for row in universe.resource_index.buckets for bucket in row for x, y in bucket.values())))
+        if universe.is_finished():
+            break
+        universe.update(stats)
+    recorder.close()
+
+    # The state after every tick can be read, in any order
+    reader = TrajectoryReader(path)
+    assert reader.last_tick == universe.timestep
+    for tick in reversed(range(universe.timestep + 1)):
+        state = reader.state(tick)
+        assert (state["agents"].tolist(), state["resources"].tolist()) == states[tick]
+    for row in sink.rows:
+        events = reader.events(row["timestep"])
+        assert [len(events["fights"]), len(events["pickups"]), len(events["deaths"])] == \
+            [row["fights"], row["pickups"], row["deaths"]]
+
+    # A partially written chunk is ignored
+    with open(path, "rb+") as file:
+        file.truncate(os.path.getsize(path) - 10)
+    truncated = TrajectoryReader(path)
+    assert len(truncated.chunks) == len(reader.chunks) - 1
+    state = truncated.state(truncated.last_tick)
+    assert (state["agents"].tolist(), state["resources"].tolist()) == states[truncated.last_tick]
+
+    # A universe that is finished when it is created still has its initial state recorded
+    recorder = TrajectoryRecorder(path)
+    universe = Universe(1, 10, 0.4, seed=4, recorder=recorder)
+    recorder.close()
+    reader = TrajectoryReader(path)
+    assert universe.is_finished() and reader.last_tick == 0
+    state = reader.state(0)
+    assert [agent[0] for agent in state["agents"].tolist()] == [1]
+    assert len(state["resources"]) == len(universe.resources)
+    os.remove(path)
+
+
+def test_instrumentation(tmp_path="."):
+    print("### test_instrumentation() ###")
+    expected = run_to_completion(Universe(20, 10, 0.4, seed=3))
+    sink = MemorySink()
+    assert run_to_completion(Universe(20, 10, 0.4, seed=3, sink=sink)) == expected
+
+    # One row per tick, and every agent but the winner died
+    assert [row["timestep"] for row in sink.rows] == list(range(1, expected[0] + 1))
+    totals = sink.totals()
+    assert totals["deaths"] == 19
+    assert totals["fights"] <= totals["deaths"]
+    assert all(row["agents"] > 1 and min(row[phase] for phase in FIELDS[2:7]) >= 0 for row in sink.rows)
+
+    rows = []
+    run_to_completion(Universe(20, 10, 0.4, seed=3, sink=CallbackSink(rows.append)))
+    assert rows == [dict(row, **{phase: rows[i][phase] for phase in FIELDS[2:7]}) for i, row in enumerate(sink.rows)]
+
+    path = os.path.join(str(tmp_path), "test_instrumentation.csv")
+    csv_sink = CSVSink(path)
+    run_to_completion(Universe(20, 10, 0.4, seed=3, sink=csv_sink))
+    csv_sink.close()
+    with open(path) as file:
+        lines = file.read().splitlines()
+    assert lines[0] == ",".join(FIELDS)
+    assert len(lines) == expected[0] + 1
+    os.remove(path)
+
+
+def test_streaming_statistics():
+    print("### test_streaming_statistics() ###")
+    merged = StreamingStatistics()
+    lifespans = []
+    for seed in range(5):
+        universe = Universe(20, 10, 0.4, seed=seed)
+        stats = Statistics()
+        streaming = StreamingStatistics(bucket_width=5)
+        while not universe.is_finished():
+            universe.update(stats)
+        # Same averages as Statistics, from the same run
+        universe = Universe(20, 10, 0.4, seed=seed)
+        while not universe.is_finished():
+            universe.update(streaming)
+        assert (streaming.avg_win_strategy, streaming.avg_win_metabolic_rate, streaming.avg_lifespans) == \
+            (stats.avg_win_strategy, stats.avg_win_metabolic_rate, stats.avg_lifespans)
+        assert sum(streaming.counts) == 20 and streaming.runs == 1
+
+        run_lifespans = [agent.time_alive for agent in stats.dead_agents + list(stats.living_agents)]
+        lifespans += run_lifespans
+        curve = streaming.survival_curve()
+        assert curve == [sum(1 for lifespan in run_lifespans if lifespan >= 5*k) for k in range(len(curve))]
+        merged.merge(streaming)
+
+    # Merged aggregates are over all the runs
+    assert merged.runs == 5 and sum(merged.win_counts) == 5 and merged.final
+    in_progress = StreamingStatistics()
+    in_progress.set_agents(Universe(10, 10, 0.4, seed=0).agents)
+    assert not StreamingStatistics().merge(in_progress).final and not in_progress.merge(merged).final
+    assert sum(merged.lifespan_sums) == sum(lifespans)
+    assert merged.survival_curve()[0] == 100
+
+
+def test_array_universe_matches_universe():
+    print("### test_array_universe_matches_universe() ###")
+    configs = [
+        dict(num_agents=20, env_size=10, resource_prob=0.4),
+        dict(num_agents=30, env_size=12, resource_prob=0.3, field_of_vision=3),
+        dict(num_agents=60, env_size=10, resource_prob=0.6, metabolic_rate=3, field_of_vision=2),
+    ]
+    for config in configs:
+        for seed in range(3):
+            expected = run_to_completion(Universe(seed=seed, **config))
+            assert run_to_completion(ArrayUniverse(seed=seed, **config)) == expected
+
+
+def test_compiled_matches_python():
+    print("### test_compiled_matches_python() ###")
+    configs = [
+        dict(num_agents=100, env_size=30, resource_prob=0.4),
+        dict(num_agents=60, env_size=10, resource_prob=0.6, metabolic_rate=3, field_of_vision=2),
+    ]
+    for config in configs:
+        for seed in range(3):
+            expected = run_to_completion(Universe(seed=seed, **config))
+            assert run_to_completion(ArrayUniverse(seed=seed, compiled=True, **config)) == expected
+
+
+def test_universe_batch():
+    print("### test_universe_batch() ###")
+    config = dict(num_agents=30, env_size=12, resource_prob=0.3, field_of_vision=2)
+    batch = UniverseBatch(range(6), **config)
+    all_stats = batch.run()
+    for seed, (member, stats) in enumerate(zip(batch.members, all_stats)):
+        lifespans = sorted((agent.get_id(), agent.time_alive) for agent in stats.dead_agents + list(stats.living_agents))
+        result = (member.timestep, [agent.get_id() for agent in member.agents], lifespans,
+                  stats.avg_win_strategy, stats.avg_lifespans)
+        assert result == run_to_completion(Universe(seed=seed, **config))
+
+    args = {"num_agents": 10, "env_size": 8, "resource_prob": 0.4, "metabolic_rate": 1, "field_of_vision": 1}
+    assert collect_stats("num_agents", [5, 10], dict(args), N=6, batched=True) == \
+        collect_stats("num_agents", [5, 10], dict(args), N=6)
+
+
+def test_random_streams():
+    print("### test_random_streams() ###")
+    for seed in (0, 7, 1000):
+        generator = PCG64(seed, 0).generator
+        stream = RandomStream(seed)
+        streams = AgentStreams(seed + 1)
+        # Enough draws to go through many blocks, with every number of tied moves
+        for i in range(500):
+            moves = MOVES[:i % len(MOVES) + 1]
+            expected = generator.choice(moves).tolist()
+            assert list(stream.choice(moves)) == expected
+            assert list(moves[streams.randint(seed, len(moves))]) == expected
+
+    # Drawing for many streams at once gives the same values as drawing for each in turn
+    streams, expected = AgentStreams(50), AgentStreams(50)
+    for i in range(200):
+        indices = np.arange(i % 5, 50, 3)
+        n = (indices*i) % 8 + 1
+        assert streams.draw(indices, n).tolist() == [expected.randint(index, m) for index, m in
+                                                     zip(indices.tolist(), n.tolist())]
+
+    # The same holds for the streams of a batch, where the streams are (row, index) pairs
+    streams, expected = AgentStreams(20, batch_size=3), AgentStreams(20, batch_size=3)
+    for i in range(200):
+        indices = np.arange(i % 4, 20, 2)
+        rows = (indices + i) % 3
+        n = (indices*i) % 8 + 1
+        assert streams.draw(indices, n, rows).tolist() == [expected.randint((row, index), m) for row, index, m in
+                                                           zip(rows.tolist(), indices.tolist(), n.tolist())]
+
+    # The first blocks of the streams beyond the cached ones are drawn, and not kept
+    blocks = first_blocks(CACHED_STREAMS + 3)
+    assert len(blocks) == CACHED_STREAMS + 3 and np.array_equal(blocks[-1], draw_block(CACHED_STREAMS + 2, 0))
+    assert len(rng._first_blocks) == CACHED_STREAMS
+
+
+def test_batch_scores():
+    print("### test_batch_scores() ###")
+    universe = ArrayUniverse(30, 12, 0.4, field_of_vision=3, seed=1)
+    stats = Statistics()
+    for i in range(5):
+        universe.update(stats)
+
+    batch = universe.score_all()
+    r = universe.halo
+    for row, index in enumerate(universe.order.tolist()):
+        # Score the agent's move cells by scanning its window, as Agent.find_best_move does
+        x, y = universe.position[index]
+        kind = universe.kind[x-r:x+r+1, y-r:y+r+1]
+        amount = universe.amount[x-r:x+r+1, y-r:y+r+1]
+        strategy = int(universe.strategy[index])
+        expected = []
+        for move_x, move_y in MOVES:
+            i, j = r + move_x, r + move_y
+            if kind[i][j] == BARRIER_CELL:
+                expected.append(-math.inf)
+                continue
+            score = 0
+            for a in range(2*r + 1):
+                for b in range(2*r + 1):
+                    distance = max(abs(a-i), abs(b-j))
+                    if kind[a][b] == AGENT_CELL and (a, b) != (r, r) and strategy != 0:
+                        score += strategy + distance if strategy < 0 else strategy - distance
+                    elif kind[a][b] == RESOURCE_CELL:
+                        score += amount[a][b] - distance
+            expected.append(score)
+
+        assert universe.fields.scores(x, y, strategy).tolist() == expected
+        assert batch[row].tolist() == expected
+
+
+def test_parallel_collect_stats():
+    print("### test_parallel_collect_stats() ###")
+    args = {"num_agents": 10, "env_size": 8, "resource_prob": 0.4, "metabolic_rate": 1, "field_of_vision": 1}
+    serial = collect_stats("num_agents", [5, 10], dict(args), N=6)
+    assert collect_stats("num_agents", [5, 10], dict(args), N=6, workers=3) == serial
+    assert [sum(win_counts) for win_counts in serial] == [6, 6]
+
+
+def test_resumable_sweep(tmp_path="."):
+    print("### test_resumable_sweep() ###")
+    path = os.path.join(str(tmp_path), "test_sweep.jsonl")
+    if os.path.exists(path):
+        os.remove(path)
+    spec = {"num_agents": [5, 10], "env_size": [8], "resource_prob": [0.2, 0.4]}
+    assert len(expand(spec)) == 4
+
+    # Interrupt the sweep after a few runs, in the middle of writing a record
+    store = ResultStore(path)
+    assert run_sweep([expand(spec)[0]], range(3), store) == 3
+    store.close()
+    with open(path, "a") as file:
+        file.write('{"config": {"num_agents"')
+
+    store = ResultStore(path)
+    assert len(store.records) == 3
+    assert run_sweep(spec, range(3), store) == 9
+    assert run_sweep(spec, range(3), store, workers=2) == 0
+    store.close()
+
+    store = ResultStore(path)
+    args = dict(default_values, env_size=8, resource_prob=0.2)
+    configs = [config for config in expand(spec) if config["resource_prob"] == 0.2]
+    assert store.win_counts(configs) == collect_stats("num_agents", [5, 10], args, N=3)
+    store.close()
+    os.remove(path)
+
+
+def test_benchmark_compare():
+    print("### test_benchmark_compare() ###")
+    config = {"num_agents": 10, "env_size": 8, "resource_prob": 0.4, "metabolic_rate": 1, "field_of_vision": 1}
+    metrics = bench_update(config, ticks=5, repeat=1)
+    assert set(metrics) == {"ticks_per_sec", "run_time", "run_ticks_per_sec"}
+
+    baseline = {"results": {"a": {"ticks_per_sec": 100.0, "run_time": 1.0}, "b": {"run_time": 1.0}}}
+    # Rates regress when they drop, times when they grow, and missing benchmarks are skipped
+    current = {"results": {"a": {"ticks_per_sec": 85.0, "run_time": 1.05}, "c": {"run_time": 5.0}}}
+    assert compare_results(baseline, current, 0.1) == [("a", "ticks_per_sec", 100.0, 85.0)]
+    assert compare_results(baseline, current, 0.2) == []
+    current["results"]["a"]["run_time"] = 1.5
+    assert compare_results(baseline, current, 0.2) == [("a", "run_time", 1.0, 1.5)]
+
+
+def test_run_table(tmp_path="."):
+    print("### test_run_table() ###")
+    args = dict(default_values, env_size=8)
+    expected = collect_stats("num_agents", [5, 10], dict(args), N=5)
+    paths = [os.path.join(str(tmp_path), "test_runs.npzdir")]
+    if PARQUET:
+        paths.append(os.path.join(str(tmp_path), "test_runs.parquet"))
+    for path in paths:
+        collect_runs("num_agents", [5, 10], args, N=5, workers=2, path=path)
+        runs = load_runs(path)
+        assert len(runs["seed"]) == 10
+        assert sorted(zip(runs["num_agents"].tolist(), runs["seed"].tolist())) == \
+            [(num_agents, seed) for num_agents in (5, 10) for seed in range(5)]
+        assert (runs["env_size"] == 8).all() and (runs["winner"] >= 1).all()
+        assert win_counts(runs, "num_agents", [5, 10]) == expected
+        with open(os.path.splitext(path)[0] + ".txt") as file:
+            assert [[int(count) for count in line.split()] for line in file] == expected
+        os.remove(os.path.splitext(path)[0] + ".txt")
+
+    # Rows are written in batches
+    table = RunTable(paths[0], batch_size=3)
+    records = [{"config": {"num_agents": 5, "env_size": 8, "resource_prob": 0.4, "metabolic_rate": 1,
+                           "field_of_vision": 1},
+                "seed": seed, "timesteps": 10, "winner": 1, "avg_win_strategy": -2.0, "avg_win_metabolic_rate": 1.0,
+                "avg_lifespans": [3.0, 0, 5.0]} for seed in range(7)]
+    for record in records:
+        table.add(record)
+    assert table.parts == 2
+    table.close()
+    assert load_runs(paths[0])["seed"].tolist() == list(range(7))
+    for path in paths:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            os.rmdir(path)
+        else:
+            os.remove(path)
+
+
+def test_stopping_rules():
+    print("### test_stopping_rules() ###")
+    config = {"num_agents": 20, "env_size": 10, "resource_prob": 0.3, "metabolic_rate": 1, "field_of_vision": 1}
+
+    # Without rules the runs are unchanged
+    record = simulate(config, 3)
+    assert record["stop_reason"] == "last_agent"
+    assert simulate(config, 3, [MaxTicks(10**6)]) == record
+
+    # The run stops after the tick at which a rule fires, and the survivors are the winners
+    universe = Universe(seed=3, stopping_rules=[MaxTicks(5)], **config)
+    stats = StreamingStatistics()
+    while not universe.is_finished():
+        universe.update(stats)
+    assert universe.timestep == 5 and universe.stop_reason == "max_ticks"
+    assert stats.winners == len(universe.agents) > 1
+    assert stats.avg_win_strategy == sum(agent.strategy for agent in universe.agents)/len(universe.agents)
+
+    # The runs with stopping rules, whose winning strategies are averages, are kept apart from the
+    # default tables
+    assert default_path("num_agents", [MaxTicks(5)]) != default_path("num_agents")
+
+    universe = Universe(seed=3, stopping_rules=[OneStrategyClass()], **config)
+    stats = StreamingStatistics()
+    while not universe.is_finished():
+        universe.update(stats)
+    assert len(set(strategy_class(agent.strategy) for agent in universe.agents)) == 1
+
+    # Two agents in opposite corners without resources starve before they can meet, unless
+    # resources can respawn
+    def corners(universe):
+        for agent, (x, y) in zip(list(universe.agents), [(0, 0), (29, 29)]):
+            old = universe.agents_loc[agent]
+            universe.environment[old] = Universe.EMPTY_CELL
+            universe.agent_index.remove(agent, *old)
+            universe.agents_loc[agent] = (x + universe.halo, y + universe.halo)
+            universe.environment[x + universe.halo, y + universe.halo] = agent
+            universe.agent_index.add(agent, x + universe.halo, y + universe.halo)
+            agent.resources = 5
+        return universe
+
+    universe = corners(Universe(2, 30, 0.0, seed=1, stopping_rules=[Unreachable()]))
+    universe.update(StreamingStatistics())
+    assert universe.stop_reason == "unreachable" and universe.timestep == 1
+    universe = corners(Universe(2, 30, 0.0, seed=1, stopping_rules=[Unreachable()], regeneration=[Respawn(0.001)]))
+    stats = StreamingStatistics()
+    universe.update(stats)
+    assert not universe.resources and not universe.is_finished()
+    while not universe.is_finished():
+        universe.update(stats)
+    assert universe.stop_reason == "last_agent"
+
+    universe = Universe(2, 30, 0.0, seed=1, stopping_rules=[Stagnation(3)])
+    stats = StreamingStatistics()
+    while not universe.is_finished():
+        universe.update(stats)
+    assert universe.stop_reason == "stagnation" and universe.timestep - universe.last_event == 3
+
+    # The reason is recorded with the run
+    assert simulate(config, 3, [MaxTicks(5)])["stop_reason"] == "max_ticks"
+
+
+def test_adaptive_collect_stats(tmp_path="."):
+    print("### test_adaptive_collect_stats() ###")
+    args = dict(default_values, env_size=8)
+    log = os.path.join(str(tmp_path), "test_adaptive.jsonl")
+    win_counts_list, runs, decisions = collect_stats_adaptive("num_agents", [5, 10, 20], dict(args), batch_size=5,
+                                                              target_width=0.45, max_runs=30, log=log)
+
+    # Every value is simulated until it converges or runs out of runs, with the seeds collect_stats uses
+    for j, num_agents in enumerate([5, 10, 20]):
+        assert runs[j] % 5 == 0 and 5 <= runs[j] <= 30
+        assert win_counts_list[j] == collect_stats("num_agents", [num_agents], dict(args), N=runs[j])[0]
+        last = [decision for decision in decisions if decision["value"] == num_agents][-1]
+        assert last["runs"] == runs[j]
+        assert last["decision"] == ("converged" if ci_width(win_counts_list[j]) <= 0.45 else "max_runs")
+    with open(log) as file:
+        assert [json.loads(line) for line in file] == decisions
+    os.remove(log)
+
+    # The decisions do not depend on the number of workers
+    assert collect_stats_adaptive("num_agents", [5, 10, 20], dict(args), batch_size=5, target_width=0.45,
+                                  max_runs=30, workers=2) == (win_counts_list, runs, decisions)
+
+    # The budget goes to the values with the widest intervals first
+    win_counts_list, runs, decisions = collect_stats_adaptive("num_agents", [5, 10, 20], dict(args), batch_size=5,
+                                                              target_width=0.0, budget=22)
+    assert sum(runs) == 22 and sorted(runs) == [5, 7, 10]
+    assert all(decision["decision"] == "budget" for decision in decisions[-3:])
+
+    # A stable mode also ends a value
+    win_counts_list, runs, decisions = collect_stats_adaptive("num_agents", [5], dict(args), batch_size=5,
+                                                              target_width=0.0, mode_patience=2, max_runs=100)
+    assert decisions[-1]["decision"] == "converged"
+    assert len(set(decision["mode"] for decision in decisions[-3:])) == 1
+
+
+def test_regeneration():
+    print("### test_regeneration() ###")
+    generator = PCG64(0, 4).generator
+    agents = np.array([[0, 0], [3, 4]])
+    field = ResourceField(6, [Constant(4, capacity=10)], generator)
+    field.set(1, 1, 9)
+    changed, amounts = field.step(agents)
+    assert field.amount[1, 1] == 10 and field.amount[2, 2] == 4 and field.amount[0, 0] == 0
+    assert len(changed) == 6*6 - 2 and sorted(set(amounts.tolist())) == [4, 10]
+    changed, amounts = field.step(agents)
+    assert len(changed) == 6*6 - 3 and set(amounts.tolist()) == {8}
+
+    # Depleted cells do not grow logistically, and diffusion keeps the total amount
+    field = ResourceField(6, [Logistic(0.5), Diffusion(0.2)], generator)
+    field.set(2, 2, 4)
+    field.step(np.empty((0, 2), dtype=np.int64))
+    assert math.isclose(field.amount.sum(), 4 + 0.5*4*(1 - 4/10))
+    field = ResourceField(6, [Respawn(0.5)], generator)
+    field.set(1, 1, 3)
+    field.step(agents)
+    assert field.amount[0, 0] == 0 and field.amount[3, 4] == 0 and field.amount[1, 1] == 3
+    assert set(np.unique(field.amount).tolist()) == {0, 3, 10}
+
+    # The resources of the universe always match the field, and runs are reproducible
+    def run(seed):
+        universe = Universe(20, 15, 0.1, seed=seed, regeneration=[Logistic(0.2), Diffusion(0.1), Respawn(0.01)])
+        stats = StreamingStatistics()
+        while not universe.is_finished() and universe.timestep < 60:
+            universe.update(stats)
+            halo, size = universe.halo, universe.env_size
+            for x in range(size):
+                for y in range(size):
+                    cell = universe.environment[x + halo, y + halo]
+                    assert universe.resource_field.visible[x, y] == (cell.get_amount() if isinstance(cell, Resource) else 0)
+            assert len(universe.resources) == (universe.resource_field.visible > 0).sum() == \
+                sum(len(bucket) for row in universe.resource_index.buckets for bucket in row)
+        return universe.timestep, sorted((agent.get_id(), agent.resources) for agent in universe.agents)
+    assert run(5) == run(5)
+
+
+def test_sharded_universe():
+    print("### test_sharded_universe() ###")
+    # The initial state is the one of Universe, drawn in bulk
+    for num_agents, env_size, resource_prob, seed in [(20, 10, 0.4, 3), (630, 30, 0.2, 1)]:
+        universe = Universe(num_agents, env_size, resource_prob, seed=seed)
+        positions, strategies, resources = initial_state(num_agents, env_size, resource_prob, seed)
+        assert [universe.agents_loc[agent] for agent in universe.agents] == \
+            [(x + universe.halo, y + universe.halo) for x, y in positions.tolist()]
+        assert [agent.strategy for agent in universe.agents] == strategies.tolist()
+        assert len(universe.resources) == resources.sum()
+
+    # Scores gathered from the windows are the ones of the score fields
+    for fov in (1, 3):
+        universe, stats = ArrayUniverse(40, 15, 0.4, field_of_vision=fov, seed=3), Statistics()
+        for i in range(3):
+            universe.update(stats)
+        x, y = universe.position[universe.order].T
+        assert np.array_equal(window_scores(universe.kind, universe.amount, x, y, universe.strategy[universe.order],
+                                            fov, AGENT_CELL, RESOURCE_CELL, BARRIER_CELL),
+                              universe.score_all())
+
+    # Runs do not depend on the number of shards or workers, and the grid always matches the agents
+    def run(shards, workers, check=False):
+        with ShardedUniverse(200, 25, 0.4, field_of_vision=2, seed=4, shards=shards, workers=workers) as universe:
+            stats = StreamingStatistics()
+            while not universe.is_finished():
+                universe.update(stats)
+                if check:
+                    alive = np.flatnonzero(universe.alive)
+                    assert (universe.occupant[tuple(universe.position[alive].T)] == alive).all()
+                    assert (universe.kind == AGENT_CELL).sum() == len(alive)
+                    assert (universe.kind == RESOURCE_CELL).sum() == universe.num_resources
+            return universe.timestep, universe.order.tolist(), universe.time_alive.tolist(), stats.avg_win_strategy
+    expected = run(1, 1, check=True)
+    assert run(3, 1) == expected and run(4, 2) == expected
+
+    # The shared memory is released when the universe is closed, or garbage collected without being
+    # closed
+    for closed in (True, False):
+        universe = ShardedUniverse(5, 5, 0.4, seed=0)
+        names = [memory.name for memory in universe.memory]
+        if closed:
+            universe.close()
+        del universe
+        gc.collect()
+        for name in names:
+            try:
+                shared_memory.SharedMemory(name=name).close()
+                assert False, name + " was not unlinked"
+            except FileNotFoundError:
+                pass
+
+    # Conflicts: the most resources wins, then the occupant, then the lowest id
+    with ShardedUniverse(5, 5, 0.0, seed=0) as universe:
+        cells = [(2, 2), (1, 1), (1, 2), (3, 3), (3, 2)]
+        universe.occupant[:] = -1
+        universe.kind[1:6, 1:6] = EMPTY_CELL
+        for i, (x, y) in enumerate(cells):
+            universe.position[i] = (x + 1, y + 1)
+            universe.kind[x + 1, y + 1] = AGENT_CELL
+            universe.occupant[x + 1, y + 1] = i
+        universe.kind[1, 1], universe.amount[1, 1] = RESOURCE_CELL, 10
+        universe.agent_resources[:] = [5, 5, 4, 5, 3]
+        # Agents 1 and 2 attack agent 0, which stays; agent 3 attacks agent 4, which collects a resource
+        targets = [(2, 2), (2, 2), (2, 2), (3, 2), (0, 0)]
+        universe.target[:] = [(x + 1, y + 1) for x, y in targets]
+        losers, collected = resolve_conflicts(universe.arrays, 0, 0, 7)
+        assert sorted(losers.tolist()) == [1, 2] and collected == 1
+        universe.set_current(1)
+        assert universe.agent_resources.tolist()[:1] + universe.agent_resources.tolist()[3:] == [14, 5, 13]
+        assert universe.occupant[3, 3] == 0 and universe.occupant[4, 3] == 3 and universe.occupant[1, 1] == 4
+        assert universe.kind[4, 4] == EMPTY_CELL and universe.kind[2, 2] == EMPTY_CELL
+
+
+def test_synchronous_update():
+    print("### test_synchronous_update() ###")
+    # The synchronous rule of ArrayUniverse gives the runs of ShardedUniverse
+    for seed, fov in [(0, 1), (1, 2)]:
+        universe, stats = ArrayUniverse(100, 20, 0.4, field_of_vision=fov, seed=seed, update_rule="synchronous"), Statistics()
+        sharded_stats = Statistics()
+        with ShardedUniverse(100, 20, 0.4, field_of_vision=fov, seed=seed, shards=3) as sharded:
+            while not universe.is_finished():
+                universe.update(stats)
+                sharded.update(sharded_stats)
+                assert np.array_equal(universe.kind, sharded.kind) and np.array_equal(universe.occupant, sharded.occupant)
+                assert np.array_equal(universe.agent_resources, sharded.agent_resources)
+            assert sharded.is_finished() and universe.time_alive.tolist() == sharded.time_alive.tolist()
+        assert stats.avg_win_strategy == sharded_stats.avg_win_strategy
+
+    # The comparison gives the win counts of both rules, the sequential ones being those of collect_stats
+    args = dict(default_values, env_size=8)
+    comparison = compare_rules("num_agents", [5, 10], args, N=5)
+    assert [row["sequential"] for row in comparison] == collect_stats("num_agents", [5, 10], dict(args), N=5)
+    for row in comparison:
+        assert sum(row["synchronous"]) == 5 and 0 <= row["distance"] <= 1
+        assert row["sequential_mean_timesteps"] > 0 and row["synchronous_mean_timesteps"] > 0
+    assert compare_rules("num_agents", [5, 10], args, N=5, workers=2) == comparison
+
+
+def test_compact_objects():
+    print("### test_compact_objects() ###")
+    # Agents and resources have no per-instance dictionary and keep their accessors
+    agent = Agent(id=3, fov_radius=1, resources=10, metabolic_rate=2, strategy=-4, seed=3)
+    assert not hasattr(agent, "__dict__")
+    agent.add_resources(5)
+    assert agent.get_id() == 3 and agent.get_resources() == 15 and agent.update_resources() == 13
+    resource, regrowing = Resource(10), Resource(10, lambda: 2)
+    assert not hasattr(resource, "__dict__")
+    resource.update()
+    regrowing.update()
+    assert resource.get_amount() == 10 and regrowing.get_amount() == 12
+
+    # The score fields are 32-bit and give the same runs as Universe
+    universe = ArrayUniverse(20, 15, 0.4, field_of_vision=2, seed=1)
+    assert universe.fields.agents.dtype == universe.fields.resources.dtype == FIELD_DTYPE
+    reference, stats, reference_stats = Universe(20, 15, 0.4, field_of_vision=2, seed=1), Statistics(), Statistics()
+    while not universe.is_finished():
+        universe.update(stats)
+        reference.update(reference_stats)
+    assert reference.is_finished() and universe.timestep == reference.timestep
+    assert stats.avg_win_strategy == reference_stats.avg_win_strategy
+
+
+def test_fast_init():
+    print("### test_fast_init() ###")
+    # The bulk initial draws give the same universes, from sparse to full grids, and the same runs
+    for num_agents, env_size, resource_prob, fov in [(10, 30, 0.4, 1), (630, 30, 0.9, 2), (100, 10, 0.5, 1)]:
+        for seed in range(3):
+            args = dict(field_of_vision=fov, seed=seed)
+            universe = Universe(num_agents, env_size, resource_prob, **args)
+            fast = Universe(num_agents, env_size, resource_prob, fast_init=True, **args)
+            assert [(agent.get_id(), agent.strategy, universe.agents_loc[agent]) for agent in universe.agents] == \
+                [(agent.get_id(), agent.strategy, fast.agents_loc[agent]) for agent in fast.agents]
+            assert np.array_equal(*[np.vectorize(lambda cell: type(cell).__name__)(u.environment) for u in (universe, fast)])
+            assert len(fast.resources) == len(universe.resources)
+
+            array_universe = ArrayUniverse(num_agents, env_size, resource_prob, **args)
+            array_fast = ArrayUniverse(num_agents, env_size, resource_prob, fast_init=True, **args)
+            for name in ("kind", "occupant", "amount", "strategy", "position"):
+                assert np.array_equal(getattr(array_universe, name), getattr(array_fast, name))
+            assert array_fast.num_resources == array_universe.num_resources == len(universe.resources)
+            assert np.array_equal(array_universe.fields.agents, array_fast.fields.agents)
+            assert np.array_equal(array_universe.fields.resources, array_fast.fields.resources)
+
+            if num_agents < env_size*env_size:
+                results = []
+                for run in (universe, fast, array_fast):
+                    stats = Statistics()
+                    while not run.is_finished():
+                        run.update(stats)
+                    results.append((run.timestep, stats.avg_win_strategy))
+                assert results[0] == results[1] == results[2]
+
+
+def test_move_cache():
+    print("### test_move_cache() ###")
+    # Runs are the same with a cache, whether the views are encoded, too large to encode (resources
+    # of 20 units from the regeneration, or a field of vision of 2) or evicted from a small table
+    for fov, regeneration, capacity in [(1, (), 1 << 16), (1, [Respawn(0.01, size=20)], 1 << 16), (2, (), 1 << 16),
+                                        (1, (), 50)]:
+        cache = MoveCache(capacity)
+        for seed in range(3):
+            runs = []
+            for move_cache in (None, cache):
+                universe = Universe(50, 20, 0.4, field_of_vision=fov, seed=seed, regeneration=regeneration,
+                                    stopping_rules=[MaxTicks(200)], move_cache=move_cache)
+                stats = Statistics()
+                while not universe.is_finished():
+                    universe.update(stats)
+                runs.append((universe.timestep, sorted((agent.get_id(), agent.resources) for agent in universe.agents),
+                             stats.avg_win_strategy))
+            assert runs[0] == runs[1]
+        assert len(cache.table) <= capacity
+        if fov == 2:
+            assert cache.hits == cache.misses == 0 and cache.fallbacks > 0
+        else:
+            assert cache.hits > cache.misses > 0 and 0 < cache.hit_rate() < 1
+            assert (cache.fallbacks > 0) == bool(regeneration) and (cache.evictions > 0) == (capacity == 50)
+
+    # Views differ in their key when a cell or the strategy differs, and resources beyond 13 units
+    # are not encoded
+    view = np.array([[Resource(10), 0, -1], [0, Agent(1, 1, 10, 1, 0, 0), 0], [0, 0, 0]], dtype=object)
+    assert encode(view, 3) != encode(view, 4)
+    keys = {encode(view, 3)}
+    view[1, 0] = Resource(13)
+    keys.add(encode(view, 3))
+    view[1, 0] = Agent(2, 1, 10, 1, 0, 1)
+    keys.add(encode(view, 3))
+    assert None not in keys and len(keys) == 3
+    view[1, 0] = Resource(14)
+    assert encode(view, 3) is None
+
+
 if __name__ == "__main__":
     test_find_best_move()
+    test_find_restricted_env()
     test_single_agent()
     test_two_agents()
     test_simulation_run()
+    test_spatial_index()
+    test_checkpoint()
+    test_trajectory()
+    test_instrumentation()
+    test_streaming_statistics()
+    test_array_universe_matches_universe()
+    test_compiled_matches_python()
+    test_universe_batch()
+    test_random_streams()
+    test_batch_scores()
+    test_parallel_collect_stats()
+    test_resumable_sweep()
+    test_benchmark_compare()
+    test_run_table()
+    test_stopping_rules()
+    test_adaptive_collect_stats()
+    test_regeneration()
+    test_sharded_universe()
+    test_synchronous_update()
+    test_compact_objects()
+    test_fast_init()
+    test_move_cache()
@@ -0,0 +1,180 @@
+import io
+import numpy as np
+
+# Trajectory of a run: the state of the universe after every tick, stored as per-tick deltas.
+#
+# The file starts with MAGIC and is followed by chunks. A chunk starts with a keyframe, the full
+# state after tick <first_tick>, followed by the events of the next ticks, so the state after any
+# tick is found by reading a single chunk and applying its events up to that tick. Each chunk is
+# framed by three little-endian int64 (first_tick, number of ticks of events, payload size) and
+# its payload is a compressed NPZ archive with the arrays:
+# - agent: (id, x, y, resources, metabolic_rate) of every living agent in the keyframe
+# - resource: (x, y, amount) of every resource in the keyframe
+# - counts: number of (moves, fights, pickups, deaths) of every tick
+# - moves: (id, x, y) of every agent that moved, in the order they moved
+# - fights: (attacker id, defender id, winner id, resources taken by the winner)
+# - pickups: (id, x, y, amount) of every resource collected
+# - deaths: id of every agent removed from the universe
+# Locations exclude the barrier halo. Resources are not stored for every tick: each living agent
+# loses its metabolic rate once per tick and gains what it picks up or takes in fights, so the
+# reader sums these. A keyframe is also written after the last tick.
+MAGIC = b"CATRAJ01"
+FRAME = np.dtype("<i8")
+EVENTS = ["moves", "fights", "pickups", "deaths"]
+EVENT_COLUMNS = {"moves": (3,), "fights": (4,), "pickups": (4,), "deaths": ()}
+
+
+# Records the trajectory of a Universe created with recorder=<the recorder> to <path>. Events are
+# kept in memory until a chunk is complete, so memory use is bounded by the keyframe interval.
+class TrajectoryRecorder:
+    def __init__(self, path, keyframe_interval=100):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.keyframe_interval = keyframe_interval
+        self.halo = 0
+        self.chunk = None
+        self.recorded = None
+
+    # Starts a chunk with the state of <universe> as its keyframe
+    def keyframe(self, universe):
+        self.halo = universe.halo
+        agents = [(agent.get_id(), x - self.halo, y - self.halo, agent.resources, agent.metabolic_rate)
+                  for agent, (x, y) in universe.agents_loc.items()]
+        resources = [(x - self.halo, y - self.halo, resource.get_amount())
+                     for row in universe.resource_index.buckets for bucket in row
+                     for resource, (x, y) in bucket.items()]
+        self.chunk = {
+            "first_tick": universe.timestep,
+            "agent": np.array(agents, dtype=np.int64).reshape(-1, 5),
+            "resource": np.array(resources, dtype=np.int64).reshape(-1, 3),
+            "counts": [],
+        }
+        for event in EVENTS:
+            self.chunk[event] = []
+        self.recorded = [0 for event in EVENTS]  # Number of events of each kind before the current tick
+
+    def move(self, agent, x, y):
+        self.chunk["moves"].append((agent.get_id(), x - self.halo, y - self.halo))
+
+    def fight(self, attacker, defender, winner, amount):
+        self.chunk["fights"].append((attacker.get_id(), defender.get_id(), winner.get_id(), amount))
+
+    def pickup(self, agent, x, y, amount):
+        self.chunk["pickups"].append((agent.get_id(), x - self.halo, y - self.halo, amount))
+
+    # Ends the current tick of <universe>, where the agents in <deaths> were removed
+    def end_tick(self, universe, deaths):
+        self.chunk["deaths"].extend(agent.get_id() for agent in deaths)
+        counts = [len(self.chunk[event]) for event in EVENTS]
+        self.chunk["counts"].append([count - before for count, before in zip(counts, self.recorded)])
+        self.recorded = counts
+        if universe.timestep % self.keyframe_interval == 0 or universe.is_finished():
+            self.flush()
+            self.keyframe(universe)
+            if universe.is_finished():
+                self.flush()
+
+    # Writes the current chunk to the file
+    def flush(self):
+        chunk = self.chunk
+        arrays = {"agent": chunk["agent"], "resource": chunk["resource"],
+                  "counts": np.array(chunk["counts"], dtype=np.int64).reshape(-1, len(EVENTS))}
+        for event in EVENTS:
+            arrays[event] = np.array(chunk[event], dtype=np.int64).reshape((-1,) + EVENT_COLUMNS[event])
+        payload = io.BytesIO()
+        np.savez_compressed(payload, **arrays)
+        payload = payload.getvalue()
+        self.file.write(np.array([chunk["first_tick"], len(chunk["counts"]), len(payload)], dtype=FRAME).tobytes())
+        self.file.write(payload)
+        self.file.flush()
+        self.chunk = None
+
+    # Writes the pending chunk, if any (the initial keyframe of a universe that never updated, or
+    # the ticks since the last keyframe of a run that was stopped before it finished)
+    def close(self):
+        if self.chunk is not None:
+            self.flush()
+        self.file.close()
+
+
+# Reads a trajectory written by TrajectoryRecorder. Only the frames of the chunks are read when it
+# is opened, and a chunk is only decompressed when one of its ticks is requested. A partially
+# written last chunk (from an interrupted run) is ignored.
+class TrajectoryReader:
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []    # (first_tick, number of ticks of events, payload offset, payload size)
+        self.cached = None  # Index and arrays of the last chunk read
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " is not a trajectory")
+            size = file.seek(0, io.SEEK_END)
+            offset = len(MAGIC)
+            while offset + 3*FRAME.itemsize <= size:
+                file.seek(offset)
+                first_tick, num_ticks, nbytes = np.frombuffer(file.read(3*FRAME.itemsize), dtype=FRAME).tolist()
+                offset += 3*FRAME.itemsize
+                if offset + nbytes > size:
+                    break
+                self.chunks.append((first_tick, num_ticks, offset, nbytes))
+                offset += nbytes
+
+    # Last tick whose state can be read
+    @property
+    def last_tick(self):
+        first_tick, num_ticks = self.chunks[-1][:2]
+        return first_tick + num_ticks
+
+    def read_chunk(self, k):
+        if self.cached is None or self.cached[0] != k:
+            with open(self.path, "rb") as file:
+                file.seek(self.chunks[k][2])
+                payload = file.read(self.chunks[k][3])
+            with np.load(io.BytesIO(payload)) as archive:
+                self.cached = (k, {name: archive[name] for name in archive.files})
+        return self.cached[1]
+
+    # Index of the chunk whose keyframe is the last one at or before <tick>
+    def find_chunk(self, tick):
+        if not self.chunks[0][0] <= tick <= self.last_tick:
+            raise IndexError("tick %d is not in the trajectory" % tick)
+        k = len(self.chunks) - 1
+        while self.chunks[k][0] > tick:
+            k -= 1
+        return k
+
+    # Returns the events of <tick> (the update that led to the state after <tick>), a dictionary
+    # mapping each name of EVENTS to its array
+    def events(self, tick):
+        k = self.find_chunk(tick - 1)
+        chunk = self.read_chunk(k)
+        start = np.cumsum(chunk["counts"], axis=0) - chunk["counts"]
+        i = tick - 1 - self.chunks[k][0]
+        return {event: chunk[event][start[i, e]:start[i, e] + chunk["counts"][i, e]] for e, event in enumerate(EVENTS)}
+
+    # Returns the state after <tick>: a dictionary with the (id, x, y, resources) of the living
+    # agents ("agents", sorted by id) and the (x, y, amount) of the resources ("resources", sorted
+    # by location)
+    def state(self, tick):
+        k = self.find_chunk(tick)
+        chunk = self.read_chunk(k)
+        agents = {row[0]: row[1:] for row in chunk["agent"].tolist()}
+        resources = {(x, y): amount for x, y, amount in chunk["resource"].tolist()}
+        ends = np.cumsum(chunk["counts"], axis=0)
+        for i in range(tick - self.chunks[k][0]):
+            start = ends[i] - chunk["counts"][i]
+            for agent, x, y in chunk["moves"][start[0]:ends[i, 0]].tolist():
+                agents[agent][0:2] = [x, y]
+            for attacker, defender, winner, amount in chunk["fights"][start[1]:ends[i, 1]].tolist():
+                agents[winner][2] += amount
+            for agent, x, y, amount in chunk["pickups"][start[2]:ends[i, 2]].tolist():
+                agents[agent][2] += amount
+                del resources[(x, y)]
+            for agent in chunk["deaths"][start[3]:ends[i, 3]].tolist():
+                del agents[agent]
+            for state in agents.values():
+                state[2] -= state[3]
+        return {
+            "agents": np.array([[agent] + agents[agent][:3] for agent in sorted(agents)], dtype=np.int64).reshape(-1, 4),
+            "resources": np.array([[x, y, resources[(x, y)]] for x, y in sorted(resources)], dtype=np.int64).reshape(-1, 3),
+        }
@@ -1,6 +1,13 @@
+import time
+import numpy as np
 from resource import Resource
 from agent import Agent
 from randomgen import PCG64
+from spatial import SpatialIndex
+from regeneration import ResourceField
+from initialization import initial_state
+from instrumentation import PHASES, METABOLISM, FIND_RESTRICTED_ENV, FIND_BEST_MOVE, RESOLVE_MOVEMENT, REMOVAL, \
+    PrintSink, lap
 
 
 class Universe:
@@ -12,18 +19,22 @@ class Universe:
     # - env_size: integer size of the environment
     # - resource_prob: the probability that, given any empty cell in the environment, 
     #   a resources resides there.
+    # - sink: if given, receives the time spent in each phase of every update and the number of
+    #   fights, pickups and deaths (see instrumentation.py). debug=True prints these counts.
+    # - recorder: if given, a trajectory.TrajectoryRecorder that records every move, fight, pickup
+    #   and death
+    # - stopping_rules: rules that end the simulation before a single agent is left (see stopping.py)
+    # - regeneration: growth rules of the resources, applied at the start of every update (see
+    #   regeneration.py). Without rules, resources do not regrow.
+    # - fast_init: take the initial draws in bulk (see initialization.py). The initial state is the same.
+    # - move_cache: if given, a move_cache.MoveCache that memoizes the best moves of agents with a
+    #   field of vision of 1. The moves are the same.
     def __init__(self, num_agents, env_size, resource_prob, metabolic_rate=1, field_of_vision=1,
-                 seed=1234567, debug=False):
-        self.timestep = 0
-        self.agents = list()
-        self.resources = list()
-        self.agents_loc = dict()
-        self.environment = [[self.EMPTY_CELL for x in range(env_size)] for y in range(env_size)]
-        self.env_size = env_size
-        self.debug = debug
-        
-        # Keep track of agents that have been eliminated in the current turn to remove them from the universe
-        self.agents_to_remove = []
+                 seed=1234567, debug=False, sink=None, recorder=None, stopping_rules=(), regeneration=(),
+                 fast_init=False, move_cache=None):
+        self._set_up(env_size, field_of_vision, debug, sink, recorder, stopping_rules, move_cache)
+        if num_agents == 1:
+            self.stop_reason = "last_agent"
 
         # Four streams:
         # 0. To place agents randomly in the environment
@@ -32,30 +43,116 @@ class Universe:
         # 3. To shuffle the list of agents
         self.streams = [PCG64(seed, stream) for stream in range(4)]
 
-        # Place agents randomly in the environment
-        for i in range(num_agents):
-            rand_start_x = self.streams[0].generator.randint(0, env_size-1, closed=True)
-            rand_start_y = self.streams[0].generator.randint(0, env_size-1, closed=True)
-            while self.environment[rand_start_x][rand_start_y] != self.EMPTY_CELL:
-                rand_start_x = self.streams[0].generator.randint(0, env_size-1, closed=True)
-                rand_start_y = self.streams[0].generator.randint(0, env_size-1, closed=True)
-
-            self.agents.append(Agent(id=i+1, fov_radius=field_of_vision, resources=10, metabolic_rate=metabolic_rate,
-                                     strategy=self.get_random_strategy(), seed=i))
-
-            self.agents_loc[self.agents[i]] = (rand_start_x, rand_start_y)
-            self.environment[rand_start_x][rand_start_y] = self.agents[i]
+        # Amounts of the regrowing resources. The growth rules draw from a fifth stream, so runs
+        # without regeneration are unchanged.
+        if regeneration:
+            if recorder is not None:
+                raise ValueError("Trajectories of universes with regeneration cannot be recorded")
+            self.resource_field = ResourceField(env_size, regeneration, PCG64(seed, 4).generator)
+
+        if fast_init:
+            positions, strategies, resources = initial_state(num_agents, env_size, resource_prob, seed, self.streams)
+            for i, ((x, y), strategy) in enumerate(zip((positions + self.halo).tolist(), strategies.tolist())):
+                self.place_agent(Agent(id=i+1, fov_radius=field_of_vision, resources=10, metabolic_rate=metabolic_rate,
+                                       strategy=strategy, seed=i), x, y)
+            for i, row in enumerate(resources):
+                for j in np.flatnonzero(row).tolist():
+                    self.place_resource(self.halo + i, self.halo + j)
+        else:
+            # Place agents randomly in the environment
+            for i in range(num_agents):
+                rand_start_x = self.halo + self.streams[0].generator.randint(0, env_size-1, closed=True)
+                rand_start_y = self.halo + self.streams[0].generator.randint(0, env_size-1, closed=True)
+                while self.environment[rand_start_x, rand_start_y] != self.EMPTY_CELL:
+                    rand_start_x = self.halo + self.streams[0].generator.randint(0, env_size-1, closed=True)
+                    rand_start_y = self.halo + self.streams[0].generator.randint(0, env_size-1, closed=True)
+
+                self.place_agent(Agent(id=i+1, fov_radius=field_of_vision, resources=10, metabolic_rate=metabolic_rate,
+                                       strategy=self.get_random_strategy(), seed=i), rand_start_x, rand_start_y)
+
+            # Place resources randomly
+            for i in range(self.halo, self.halo + env_size):
+                for j in range(self.halo, self.halo + env_size):
+                    # If an agent has already been placed here
+                    if self.environment[i, j] != self.EMPTY_CELL:
+                        continue
+                    # With probability resource_prob, place a resource in this cell
+                    if self.streams[2].generator.uniform(0, 1) < resource_prob:
+                        self.place_resource(i, j)
+
+        # The initial state is the keyframe of the first chunk, written even if no update follows
+        if recorder is not None:
+            recorder.keyframe(self)
+
+    # Returns a universe with no agents or resources at the given timestep, whose four streams
+    # have the given PCG64 states, to be filled with place_agent and place_resource (such as a
+    # universe loaded from a checkpoint). The other arguments are the same as the constructor's.
+    @classmethod
+    def from_state(cls, env_size, field_of_vision, timestep, stream_states, stop_reason=None, last_event=0,
+                   debug=False, sink=None, stopping_rules=(), move_cache=None):
+        universe = cls.__new__(cls)
+        universe._set_up(env_size, field_of_vision, debug, sink, None, stopping_rules, move_cache)
+        universe.timestep = timestep
+        universe.stop_reason = stop_reason
+        universe.last_event = last_event
+        universe.streams = [PCG64() for state in stream_states]
+        for stream, state in zip(universe.streams, stream_states):
+            stream.state = state
+        return universe
+
+    # Sets up an empty environment and the attributes shared by the constructor and from_state
+    def _set_up(self, env_size, field_of_vision, debug, sink, recorder, stopping_rules, move_cache):
+        self.timestep = 0
+        self.agents = list()
+        self.resources = set()
+        self.agents_loc = dict()
+        self.env_size = env_size
+        self.debug = debug
+        self.sink = PrintSink() if sink is None and debug else sink
+        self.recorder = recorder
+        self.move_cache = move_cache
+
+        # Number of fights and resource pickups in the current turn
+        self.fights = 0
+        self.pickups = 0
+
+        # Why the simulation ended: "last_agent" or the name of the stopping rule that fired
+        self.stopping_rules = list(stopping_rules)
+        self.stop_reason = None
+        self.last_event = 0  # Last timestep in which an agent died, fought or collected a resource
+
+        # The environment is surrounded by a halo of BARRIER_CELLs as wide as the field of vision, so
+        # the field of vision of any agent is a view into the environment that needs no bounds checks.
+        # Locations (in agents_loc and in the environment) are offset by the width of the halo.
+        self.halo = field_of_vision
+        self.environment = np.full((env_size + 2*self.halo, env_size + 2*self.halo), self.BARRIER_CELL, dtype=object)
+        self.environment[self.halo:self.halo+env_size, self.halo:self.halo+env_size] = self.EMPTY_CELL
+
+        # Positions of the agents and of the resources, kept in sync with the environment, so an agent's
+        # field of vision can be searched in time proportional to the number of objects in it
+        self.agent_index = SpatialIndex(env_size + 2*self.halo, 2*field_of_vision + 1)
+        self.resource_index = SpatialIndex(env_size + 2*self.halo, 2*field_of_vision + 1)
         
-        # Place resources randomly
-        for i in range(env_size):
-            for j in range(env_size):
-                # If an agent has already been placed here
-                if self.environment[i][j] != self.EMPTY_CELL:
-                    continue
-                # With probability resource_prob, place a resource in this cell
-                if self.streams[2].generator.uniform(0, 1) < resource_prob:
-                    self.resources.append(Resource(10))
-                    self.environment[i][j] = self.resources[-1]
+        # Keep track of agents that have been eliminated in the current turn to remove them from the universe.
+        # A dict is used as an ordered set: membership checks are O(1) and agents keep the order they died in.
+        self.agents_to_remove = dict()
+        self.resource_field = None
+
+    # Adds <agent> to the simulation at cell (x, y)
+    def place_agent(self, agent, x, y):
+        self.agents.append(agent)
+        self.agents_loc[agent] = (x, y)
+        self.environment[x, y] = agent
+        self.agent_index.add(agent, x, y)
+
+    # Places a resource of <amount> units in cell (i, j)
+    def place_resource(self, i, j, amount=10):
+        resource = Resource(amount)
+        self.resources.add(resource)
+        self.environment[i, j] = resource
+        self.resource_index.add(resource, i, j)
+        if self.resource_field is not None:
+            self.resource_field.set(i - self.halo, j - self.halo, amount)
 
     def get_random_strategy(self):
         strategy = self.streams[1].generator.normal(loc=0.0, scale=5.0)
@@ -67,15 +164,23 @@ class Universe:
         return strategy
 
     def is_finished(self):
-        if len(self.agents) == 1:
-            return True
-        return False
+        return self.stop_reason is not None
 
     # Updates the agents and resources in the environment
     def update(self, stats):
         if self.timestep == 0:
             stats.set_agents(self.agents)
         self.timestep += 1
+        self.fights = 0
+        self.pickups = 0
+        num_agents = len(self.agents)
+
+        # The phases are only timed when there is a sink to record them
+        timed = self.sink is not None
+        times = [0.0 for phase in PHASES]
+
+        if self.resource_field is not None:
+            self.regrow_resources()
 
         # Move the agents in a random order
         self.streams[3].generator.shuffle(self.agents)
@@ -83,17 +188,38 @@ class Universe:
             # If this agent was eliminated by another agent in this timestep
             if agent in self.agents_to_remove:
                 continue
+            if timed:
+                start = time.perf_counter()
             
             # Update the agents resources based on the agents metabolic rate
             if agent.update_resources() <= 0:
-                self.agents_to_remove.append(agent)
+                self.agents_to_remove[agent] = None
                 loc_x, loc_y = self.agents_loc[agent]
-                self.environment[loc_x][loc_y] = self.EMPTY_CELL
+                self.environment[loc_x, loc_y] = self.EMPTY_CELL
+                self.agent_index.remove(agent, loc_x, loc_y)
+                if timed:
+                    lap(times, METABOLISM, start)
                 continue
+            if timed:
+                start = lap(times, METABOLISM, start)
 
             # Allow the agent to strategically determine its desired move
             # This should be one of [(0,0), (-1, 0), (1, 0), (1, 1), (-1, -1), (1, -1), (-1, 1)]
-            move_x, move_y = agent.find_best_move(self.find_restricted_env(agent))
+            # The agents and resources it can see are found with the spatial indexes rather than by
+            # scanning its restricted environment
+            environment = self.find_restricted_env(agent)
+            if self.move_cache is not None:
+                # The agents and resources are only searched for views that are not in the cache
+                if timed:
+                    start = lap(times, FIND_RESTRICTED_ENV, start)
+                move_x, move_y = self.move_cache.find_best_move(agent, environment, self.find_visible)
+            else:
+                visible_agents, visible_resources = self.find_visible(agent)
+                if timed:
+                    start = lap(times, FIND_RESTRICTED_ENV, start)
+                move_x, move_y = agent.find_best_move_among(environment, visible_agents, visible_resources)
+            if timed:
+                start = lap(times, FIND_BEST_MOVE, start)
             
             # If the agent chose to remain in the current space, no further update required
             if move_x == 0 and move_y == 0:
@@ -102,44 +228,68 @@ class Universe:
             # Get the agents current location
             old_loc_x, old_loc_y = self.agents_loc[agent]
             # Consistency check
-            if self.debug and self.environment[old_loc_x][old_loc_y] != agent:
+            if self.debug and self.environment[old_loc_x, old_loc_y] != agent:
                 print("Agent location does not match environment!")
 
             # Resolve the movement of the agent to the new location
             self.resolve_movement(old_loc_x, old_loc_y, old_loc_x + move_x, old_loc_y + move_y)
+            if timed:
+                lap(times, RESOLVE_MOVEMENT, start)
 
+        if timed:
+            start = time.perf_counter()
         stats.update(False, self.timestep, self.agents_to_remove)
 
         # Remove eliminated agents
+        removed = set()
         for agent in self.agents_to_remove:
             agent.set_time_alive(self.timestep)  # Update the agents time alive
-            self.agents.remove(agent)
+            removed.add(agent)
             del self.agents_loc[agent]
             # If one agent is left, stop removing, remaining agent is the winner
-            if len(self.agents) == 1:
+            if len(self.agents) - len(removed) == 1:
                 break
-        self.agents_to_remove = []
+        if removed:
+            # Filter in a single pass, keeping the order of the remaining agents for the next shuffle
+            self.agents = [agent for agent in self.agents if agent not in removed]
+        self.agents_to_remove = dict()
+
+        if self.fights or self.pickups or removed:
+            self.last_event = self.timestep
+        if len(self.agents) == 1:
+            self.stop_reason = "last_agent"
+        else:
+            for rule in self.stopping_rules:
+                if rule.fired(self):
+                    self.stop_reason = rule.name
+                    break
 
         if self.is_finished():
             for agent in self.agents:
                 agent.set_time_alive(self.timestep+1) # Record the winning agents time alive
             stats.update(True, self.timestep+1, [])
             if self.debug:
-                print("Simulation has ended. Agent", self.agents[0].get_id(), "has won!")
-            return
+                print("Simulation has ended (" + self.stop_reason + "). Agents",
+                      [agent.get_id() for agent in self.agents], "have won!")
+
+        if self.recorder is not None:
+            self.recorder.end_tick(self, removed)
+
+        if timed:
+            lap(times, REMOVAL, start)
+            row = {"timestep": self.timestep, "agents": num_agents}
+            row.update(zip(PHASES, times))
+            row.update(fights=self.fights, pickups=self.pickups, deaths=len(removed))
+            self.sink.record(row)
 
     # Resolves the movement of an agent from its current location to a new location
     def resolve_movement(self, old_x, old_y, new_x, new_y):
-        if self.debug:
-            print("Agent", self.environment[old_x][old_y].get_id(),
-                  "wants to move from (", old_x, ",", old_y, ") to (", new_x, ",", new_y, ")")
-
         # If the agent intends to stay in place
         if old_x == new_x and old_y == new_y:
             return
 
-        old_cell = self.environment[old_x][old_y]
-        new_cell = self.environment[new_x][new_y]
+        old_cell = self.environment[old_x, old_y]
+        new_cell = self.environment[new_x, new_y]
         
         if not isinstance(old_cell, Agent):
             if self.debug:
@@ -148,7 +298,7 @@ class Universe:
 
         # If the agent is moving to attack another agent
         if isinstance(new_cell, Agent):
-            self.environment[new_x][new_y] = self.resolve_agent_collision(old_cell, new_cell, new_x, new_y)
+            self.environment[new_x, new_y] = self.resolve_agent_collision(old_cell, new_cell, new_x, new_y)
 
         # If the agent is moving to collect a resource
         elif isinstance(new_cell, Resource):
@@ -156,77 +306,103 @@ class Universe:
 
         # If the agent is moving into an empty cell
         else:
-            if self.debug and self.environment[new_x][new_y] != self.EMPTY_CELL:
+            if self.debug and self.environment[new_x, new_y] != self.EMPTY_CELL:
                 print("Error: new_cell is not an agent, resource, or an empty cell. (92)")
             self.agents_loc[old_cell] = (new_x, new_y)
-            self.environment[new_x][new_y] = old_cell
+            self.environment[new_x, new_y] = old_cell
+            self.agent_index.move(old_cell, old_x, old_y, new_x, new_y)
+            if self.recorder is not None:
+                self.recorder.move(old_cell, new_x, new_y)
         
         # Set the agents old location to be an empty cell
-        self.environment[old_x][old_y] = self.EMPTY_CELL
+        self.environment[old_x, old_y] = self.EMPTY_CELL
 
     def resolve_agent_collision(self, agent_1, agent_2, new_x, new_y):
+        self.fights += 1
         # Agent 1 wins the fight
         if agent_1.get_resources() > agent_2.get_resources():
+            if self.recorder is not None:
+                self.recorder.fight(agent_1, agent_2, agent_1, agent_2.get_resources())
+                self.recorder.move(agent_1, new_x, new_y)
             # agent_1 consumes agent_2's resources
             agent_1.add_resources(agent_2.get_resources())
+            self.agent_index.remove(agent_2, new_x, new_y)
+            self.agent_index.move(agent_1, *self.agents_loc[agent_1], new_x, new_y)
             # Update agent_1's location in the dictionary
             self.agents_loc[agent_1] = (new_x, new_y)
             # Flag agent_2 as dead
-            self.agents_to_remove.append(agent_2)
-            if self.debug:
-                print("Agent", agent_1.get_id(), "killed Agent", agent_2.get_id())
+            self.agents_to_remove[agent_2] = None
             return agent_1 # Return winner
 
         # Agent 2 wins the fight
         else:
+            if self.recorder is not None:
+                self.recorder.fight(agent_1, agent_2, agent_2, agent_1.get_resources())
             # agent_2 consumes agent_1's resources
             agent_2.add_resources(agent_1.get_resources())
+            self.agent_index.remove(agent_1, *self.agents_loc[agent_1])
             # Update agent_1's location in the dictionary
             self.agents_loc[agent_2] = (new_x, new_y)
             # Flag agent_1 as dead
-            self.agents_to_remove.append(agent_1)
-            if self.debug:
-                print("Agent", agent_2.get_id(), "killed Agent", agent_1.get_id())
+            self.agents_to_remove[agent_1] = None
             return agent_2  # Return the winner
 
     # Resolve a collision between an agent and a resource cell
     def resolve_resource_collision(self, agent, resource, new_x, new_y):
+        self.pickups += 1
+        if self.recorder is not None:
+            self.recorder.pickup(agent, new_x, new_y, resource.get_amount())
+            self.recorder.move(agent, new_x, new_y)
         agent.add_resources(resource.get_amount())
-        self.resources.remove(resource)
+        self.resources.discard(resource)
+        self.resource_index.remove(resource, new_x, new_y)
+        if self.resource_field is not None:
+            self.resource_field.set(new_x - self.halo, new_y - self.halo, 0)
+        self.agent_index.move(agent, *self.agents_loc[agent], new_x, new_y)
         self.agents_loc[agent] = (new_x, new_y)
-        self.environment[new_x][new_y] = agent
-
-    # Given an agent, return its field of vision in the environment based on the agents fov radius
+        self.environment[new_x, new_y] = agent
+
+    # Applies the growth rules of the resource field and writes the resources whose amount changed
+    # back to the environment and the resource index
+    def regrow_resources(self):
+        agents = np.array(list(self.agents_loc.values()), dtype=np.int64).reshape(-1, 2) - self.halo
+        changed, amounts = self.resource_field.step(agents)
+        for (x, y), amount in zip((changed + self.halo).tolist(), amounts.tolist()):
+            cell = self.environment[x, y]
+            if isinstance(cell, Resource):
+                if amount > 0:
+                    cell.set_amount(amount)
+                else:
+                    self.resources.discard(cell)
+                    self.resource_index.remove(cell, x, y)
+                    self.environment[x, y] = self.EMPTY_CELL
+            else:
+                resource = Resource(amount)
+                self.resources.add(resource)
+                self.environment[x, y] = resource
+                self.resource_index.add(resource, x, y)
+
+    # Given an agent, return its field of vision in the environment based on the agents fov radius.
+    # This is a view into the environment (cells outside of it are BARRIER_CELLs from the halo), so it
+    # must not be modified and is only valid until the environment changes.
     def find_restricted_env(self, agent):
         fov = agent.get_field_of_vision()
         x, y = self.agents_loc[agent]
-        restricted_env = [[self.EMPTY_CELL for x in range(2*fov+1)] for y in range(2*fov+1)]
-
-        # Copy the contents of the environment within the agent's fov radius into a restricted environment
-        for i in range(0, fov+1):
-            for j in range(0, fov+1):
-                if self.is_valid_position(x-i, y-j):
-                    restricted_env[fov-i][fov-j] = self.environment[x-i][y-j] 
-                else:
-                    restricted_env[fov-i][fov-j] =  self.BARRIER_CELL
-
-                if self.is_valid_position(x-i, y+j):
-                    restricted_env[fov-i][fov+j] = self.environment[x-i][y+j] 
-                else:
-                    restricted_env[fov-i][fov+j] =  self.BARRIER_CELL
-
-                if self.is_valid_position(x+i, y+j):
-                    restricted_env[fov+i][fov+j] = self.environment[x+i][y+j] 
-                else:
-                    restricted_env[fov+i][fov+j] =  self.BARRIER_CELL
-
-                if self.is_valid_position(x+i, y-j):
-                    restricted_env[fov+i][fov-j] = self.environment[x+i][y-j] 
-                else:
-                    restricted_env[fov+i][fov-j] =  self.BARRIER_CELL
-
-        return restricted_env
+        return self.environment[x-fov:x+fov+1, y-fov:y+fov+1]
+
+    # Given an agent, return the lists of ((i, j), agent) of the other agents and ((i, j), resource) of
+    # the resources in its field of vision, where (i, j) is their location in the view returned by
+    # find_restricted_env.
+    # The spatial indexes are searched unless the buckets around the agent hold more objects than
+    # there are cells in its field of vision, in which case scanning the cells is cheaper.
+    def find_visible(self, agent):
+        fov = agent.get_field_of_vision()
+        x, y = self.agents_loc[agent]
+        if self.agent_index.count(x, y, fov) + self.resource_index.count(x, y, fov) > (2*fov + 1)**2:
+            return agent.scan_environment(self.environment[x-fov:x+fov+1, y-fov:y+fov+1])
+        agents = [(cell, other) for cell, other in self.agent_index.query(x, y, fov) if other is not agent]
+        return agents, self.resource_index.query(x, y, fov)
 
     # Check if the given coordinates are within the bounds environment
     def is_valid_position(self, i, j):
-        return i >= 0 and i < self.env_size and j >=0  and j < self.env_size
+        return self.halo <= i < self.halo + self.env_size and self.halo <= j < self.halo + self.env_size